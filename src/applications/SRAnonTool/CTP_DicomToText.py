@@ -6,11 +6,36 @@
 # Usage: -y default.yaml -i input -o output
 #  -y = path to the default.yaml file to get FileSystemRoot and Mongo
 #  -i = input DICOM file, full path or relative to FileSystemRoot,
-#       or if not found then looked up in the MongoDB.
+#       or if not found then looked up in the MongoDB, as a StudyDate,
+#       a SOPInstanceUID or a list of them separated by commas, or a path.
 #  -o = output filename or directory for the plain text file
+#  --path-list = file containing a list of DICOM file paths, one per line,
+#    ('-' for stdin) to be looked up in the MongoDB in batches, instead of -i.
 #  -m = output filename or directory for metadata json file
 #  --semehr-unique = only extract records from Mongo dicom database
 #    if they are not already in the SemEHR database.
+#  --text-only = only read records from Mongo dicom database which
+#    have a ContentSequence or TextValue.
+#  --parse-cache = directory in which to cache the parsed (unredacted) text
+#    so that CTP_XMLToDicom.py does not need to parse the file again.
+#  --sr-format = write DICOM files in the same format as documents
+#    from MongoDB, using SR_parse, instead of the format for SemEHR.
+#  --jsonl = filename to which one line of JSON is appended for each
+#    document, with the metadata, the text and the span of each value,
+#    instead of writing text and metadata files.
+#  --stats = filename for a JSON summary of the time taken by each
+#    ValueType/VR and of any unexpected tags, which are then not logged.
+#  --from, --to = extract all records from Mongo dicom database with a
+#    StudyDate in this range (inclusive, YYYYMMDD or YYYY/MM/DD), instead of -i.
+#    The range is split into days, and days with more than --partition-size
+#    documents are split into hours, which are run largest first.
+#  -j = number of worker processes, each with its own MongoDB and CHI to EUPI
+#    connections (default 1).
+#  --ensure-indexes = create any missing indexes in the Mongo dicom
+#    database which are used for the lookups, and report them.
+#  --marker-dir = directory in which a .done file is written when each
+#    day or hour is complete, so that it is skipped if run again
+#    (default the output directory), whatever the --partition-size.
 # Needs both dataLoad and dataExtract yaml files because Mongo is
 # defined in the former and the rest in the latter.
 # The Mongo definitions expected in yaml are:
@@ -20,18 +45,28 @@
 #     read from the dicom database already exists in the SemEHR db.
 
 import argparse
+import collections
+import contextlib
+import datetime
+import functools
+import itertools
 import logging, logging.handlers
 import os
+import shutil
 import sys
 import json
+import multiprocessing
+import time
 import yaml
 import pydicom
 import re
 from deepmerge import Merger    # for deep merging yaml dictionaries
 from SmiServices import Mongo
+from SmiServices import Dicom
 from SmiServices import DicomText
 from SmiServices import StructuredReport as SR
 from SmiServices import IdentifierMapper
+from SmiServices import Logger
 
 # List of DICOM SR tags which we want exported in metadata json files
 metadata_fields = [
@@ -57,12 +92,39 @@ def patientid_map(PatientID):
 
 # ---------------------------------------------------------------------
 
-def extract_mongojson(mongojson, output, metadata_output=None):
+def write_jsonl(jsonl, doc, doc_name, metadata, stats=None):
+    """ Append one line to the file jsonl with the metadata of the document,
+    its text as written by SR_parse, and a list of spans
+    [label, start, end, value_type] giving the position of each value.
+    doc - the DICOM in JSON format, or a pydicom Dataset.
+    jsonl must be opened in binary append mode, unbuffered if the file
+    is to be read while it is being written. An unbuffered write may not
+    write the whole line so it is repeated until it has, which means only
+    one process can append to the file (see extract_date_range).
+    """
+    text, spans = SR.SR_render(doc, doc_name, stats)
+    line = memoryview((json.dumps({ 'document': doc_name, 'metadata': metadata, 'text': text, 'spans': spans }) + '\n').encode())
+    while line:
+        line = line[jsonl.write(line):]
+
+
+# ---------------------------------------------------------------------
+
+def extract_mongojson(mongojson, output, metadata_output=None, stats=None, jsonl=None):
     """ Called by extract_mongojson_file
     to parse the JSON from Mongo and write to output.
     mongojson - the DICOM in JSON format.
     output - can be a directory or a filename.
+    stats - optional StructuredReport.SRStats to collect statistics.
+    jsonl - optional open file to append to instead of writing output, see write_jsonl.
     """
+    if jsonl:
+        logging.info('Parse %s' % mongojson.get('header',{}).get('DicomFilePath','<NoFilePath?>'))
+        if 'PatientID' in mongojson:
+            mongojson['PatientID'] = patientid_map(mongojson['PatientID'])
+        write_jsonl(jsonl, mongojson, mongojson['SOPInstanceUID'] + '.txt',
+            {k:mongojson[k] for k in metadata_fields if k in mongojson}, stats)
+        return
     if os.path.isdir(output):
         filename = mongojson['SOPInstanceUID'] + '.txt'
         output = os.path.join(output, filename)
@@ -73,7 +135,7 @@ def extract_mongojson(mongojson, output, metadata_output=None):
     if 'PatientID' in mongojson:
         mongojson['PatientID'] = patientid_map(mongojson['PatientID'])
     with open(output, 'w') as fd:
-        SR.SR_parse(mongojson, filename, fd)
+        SR.SR_parse(mongojson, filename, fd, stats)
     if metadata_output:
         with open(metadata_output, 'w') as fd:
             print(json.dumps({k:mongojson[k] for k in metadata_fields if k in mongojson}), file=fd)
@@ -81,60 +143,350 @@ def extract_mongojson(mongojson, output, metadata_output=None):
     logging.info(f'Wrote {output}')
 
 
-def extract_mongojson_file(input, output, metadata_output=None):
+def extract_mongojson_file(input, output, metadata_output=None, stats=None, jsonl=None):
     """ Read MongoDB data in JSON format from input file
     convert to output, which can be a filename or directory.
     """
     with open(input, 'r') as fd:
         mongojson = json.load(fd)
-    extract_mongojson(mongojson, output, metadata_output=metadata_output)
+    extract_mongojson(mongojson, output, metadata_output=metadata_output, stats=stats, jsonl=jsonl)
+
+
+# ---------------------------------------------------------------------
+
+# A SOPInstanceUID is numbers separated by dots, unlike a date or a path
+sop_instance_uid_re = re.compile('^\\s*\\d+(\\.\\d+)+\\s*$')
+
+def sop_instance_uids(input):
+    """ Return a list of the SOPInstanceUIDs if input is one, or a list
+    of them separated by commas or spaces, otherwise None.
+    """
+    uids = [uid for uid in re.split('[,\\s]+', input) if uid]
+    if uids and all(sop_instance_uid_re.match(uid) for uid in uids):
+        return uids
+    return None
+
+
+def found_documents(path_docs, missing):
+    """ Yield the documents from the (path, document) pairs given by
+    DicomFilePathsToJSON or SOPInstanceUIDsToJSON, logging and appending
+    to missing the paths (or SOPInstanceUIDs) not found.
+    """
+    for path, mongojson in path_docs:
+        if mongojson:
+            yield mongojson
+        else:
+            logging.error(f'Cannot find {path} in MongoDB')
+            missing.append(path)
+
+
+def semehr_unique(mongojsons, mongodb_out, chunk=1000):
+    """ Yield those documents from mongojsons which do not already have
+    their SOPInstanceUID in the SemEHR database mongodb_out,
+    making one query for each chunk of documents rather than one each.
+    """
+    batch = []
+    for mongojson in itertools.chain(mongojsons, [None]):
+        if mongojson:
+            batch.append(mongojson)
+        if batch and (len(batch) >= chunk or not mongojson):
+            done = mongodb_out.findSOPInstanceUIDs(mj['SOPInstanceUID'] for mj in batch if 'SOPInstanceUID' in mj)
+            for mj in batch:
+                if mj.get('SOPInstanceUID') not in done:
+                    yield mj
+            batch = []
+
+
+def check_semehr_index(mongodb_out):
+    """ Warn if the SemEHR database mongodb_out has no index on SOPInstanceUID,
+    without which semehr_unique scans the whole collection for each chunk.
+    """
+    if not mongodb_out.ensureIndexes(['SOPInstanceUID'], create = False)['SOPInstanceUID']:
+        logging.warning('MongoDB/semehr has no index for SOPInstanceUID so --semehr-unique will be slow (see --ensure-indexes)')
 
 
 # ---------------------------------------------------------------------
+# Extract a range of dates in partitions, each being a day or an hour
+# (see Mongo.StudyDateToJSONList) in parallel by a pool of processes.
 
-def extract_dicom_file(input, output, metadata_output=None):
+def study_date(value):
+    """ argparse type for a StudyDate given as YYYYMMDD or YYYY/MM/DD,
+    returned as YYYYMMDD.
+    """
+    date = re.sub('[/ ]*', '', value)
+    try:
+        datetime.datetime.strptime(date, '%Y%m%d')
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'{value} is not a date YYYYMMDD or YYYY/MM/DD')
+    return date
+
+
+def date_range(date_from, date_to):
+    """ Yield each date YYYYMMDD from date_from to date_to inclusive,
+    which can be given as YYYYMMDD or YYYY/MM/DD.
+    """
+    day = datetime.datetime.strptime(re.sub('[/ ]*', '', date_from), '%Y%m%d').date()
+    last = datetime.datetime.strptime(re.sub('[/ ]*', '', date_to), '%Y%m%d').date()
+    while day <= last:
+        yield day.strftime('%Y%m%d')
+        day += datetime.timedelta(days = 1)
+
+
+def date_partitions(mongodb_in, date_from, date_to, partition_size, marker_dir=None):
+    """ Return a list of (StudyDate, hour, count) for the dates in the range,
+    where hour is None for the whole day, or 0 to 23 if the day has more
+    than partition_size documents, and count is the number of documents,
+    largest first so that a pool of workers finishes at about the same time.
+    Partitions without any documents are omitted, as are those already
+    marked done in marker_dir. A day which has any hours marked done is
+    split into hours whatever its size, so the markers of an earlier run
+    are used even if it had a different partition_size.
+    """
+    partitions = []
+    for day in date_range(date_from, date_to):
+        if marker_dir and os.path.exists(partition_marker(marker_dir, (day, None, 0))):
+            logging.info(f'Skipped {day} as already done')
+            continue
+        hours_done = [hour for hour in range(24)
+            if marker_dir and os.path.exists(partition_marker(marker_dir, (day, hour, 0)))]
+        if hours_done:
+            logging.info(f'Skipped {day} hours {hours_done} as already done')
+            count = None
+        else:
+            count = mongodb_in.countStudyDate(day)
+        if count is None or count > partition_size:
+            partitions += [ (day, hour, mongodb_in.countStudyDate(day, hour)) for hour in range(24) if hour not in hours_done ]
+        else:
+            partitions.append( (day, None, count) )
+    return sorted([p for p in partitions if p[2]], key = lambda p: p[2], reverse = True)
+
+
+def partition_marker(marker_dir, partition):
+    """ Return the filename of the completion marker for a partition. """
+    day, hour, count = partition
+    return os.path.join(marker_dir, day + ('' if hour is None else '_%02d' % hour) + '.done')
+
+
+def mongo_options(cfg_dict, store):
+    """ Return (host, user, password, database) for the MongoDB
+    store (eg. DicomStoreOptions) from the yaml dict. """
+    options = cfg_dict.get('MongoDatabases', {}).get(store, {})
+    return tuple(options.get(key, {}) for key in ['HostName', 'UserName', 'Password', 'DatabaseName'])
+
+
+# Connections opened in each worker process by init_partition_worker
+_worker = {}
+
+def init_partition_worker(log_queue, log_level, cfg_dict, text_only):
+    """ Initialise a worker process with its own connections, as they
+    cannot be shared with the parent process, and its logging.
+    An error is kept, rather than raised which would make the pool
+    start another worker, so that every partition then fails.
+    """
+    Logger.init_worker_logging(log_queue, log_level)
+    try:
+        host, user, password, db = mongo_options(cfg_dict, 'DicomStoreOptions')
+        _worker['mongodb_in'] = Mongo.SmiPyMongoCollection(host, user, password)
+        _worker['mongodb_in'].setImageCollection('SR')
+        _worker['mongodb_in'].setProjection(SR.sr_mongo_projection(metadata_fields))
+        if text_only:
+            _worker['mongodb_in'].setFilter(Mongo.SmiPyMongoCollection.text_filter)
+        host, user, password, db = mongo_options(cfg_dict, 'SemEHRStoreOptions')
+        _worker['mongodb_out'] = Mongo.SmiPyMongoCollection(host, user, password)
+        _worker['mongodb_out'].setSemEHRCollection('semehr_results')
+    except Exception as e:
+        logging.exception('Cannot initialise worker process')
+        _worker['error'] = repr(e)
+    # Do not use the connection inherited from the parent process
+    IdentifierMapper.CHItoEUPI.db_connection = None
+    try:
+        IdentifierMapper.CHItoEUPI(cfg_dict)
+    except:
+        logging.warning('Cannot initialise CHI to EUPI mapping (check IdentifierMapperOptions and check database server)')
+
+
+def partition_jsonl(jsonl_filename, partition):
+    """ Return the filename of the temporary file to which the lines
+    for a partition are written before being appended to jsonl_filename. """
+    day, hour, count = partition
+    return '%s.%s%s.tmp' % (jsonl_filename, day, '' if hour is None else '_%02d' % hour)
+
+
+def extract_partition(partition, output, metadata_output=None, jsonl_filename=None, unique=False, stats=False):
+    """ Extract all the documents in a partition (StudyDate, hour, count)
+    using the connections of init_partition_worker. If jsonl_filename is
+    given the lines are written to a temporary file, see partition_jsonl,
+    for the caller to append to it only if the whole partition is done.
+    Any error is logged and the partition fails.
+    Returns a dict { partition, status, extracted, seconds, stats, jsonl }
+    where status is 'done' or 'failed', extracted is the number of documents,
+    stats is a StructuredReport.SRStats or None, and jsonl is the name of
+    the temporary file, if any.
+    """
+    day, hour, count = partition
+    start = time.time()
+    result = { 'partition': partition, 'status': 'failed', 'extracted': 0, 'seconds': 0,
+        'stats': SR.SRStats() if stats else None,
+        'jsonl': partition_jsonl(jsonl_filename, partition) if jsonl_filename else None }
+    if 'error' in _worker:
+        logging.error(f'Cannot extract StudyDate {day} hour {hour} as the worker process was not initialised: {_worker["error"]}')
+        return result
+    try:
+        mongojsons = _worker['mongodb_in'].StudyDateToJSONList(day, hour)
+        if unique:
+            mongojsons = semehr_unique(mongojsons, _worker['mongodb_out'])
+        with (open(result['jsonl'], 'wb') if result['jsonl'] else contextlib.nullcontext()) as jsonl:
+            for mongojson in mongojsons:
+                extract_mongojson(mongojson, output, metadata_output, result['stats'], jsonl)
+                result['extracted'] += 1
+    except Exception:
+        logging.exception(f'Failed to extract StudyDate {day} hour {hour} after {result["extracted"]} of {count} documents')
+        if result['jsonl'] and os.path.exists(result['jsonl']):
+            os.remove(result['jsonl'])
+        return result
+    result['status'] = 'done'
+    result['seconds'] = time.time() - start
+    return result
+
+
+def extract_date_range(cfg_dict, date_from, date_to, output, metadata_output=None, marker_dir=None,
+        unique=False, text_only=False, jsonl_filename=None, stats=None, jobs=1, partition_size=10000):
+    """ Extract all documents in MongoDB with a StudyDate from date_from
+    to date_to inclusive, partitioned by date_partitions and run by
+    a pool of jobs processes, see extract_partition.
+    When a partition is done its lines are appended to jsonl_filename
+    and then a marker file is written in marker_dir, so that it is
+    skipped when the range is run again. A day which was split into hours
+    is also marked when all of its hours are done. A partition which
+    fails is not marked, and none of its lines are kept, so that it is
+    tried again when the range is run again.
+    stats - optional StructuredReport.SRStats into which to merge the statistics.
+    Returns the number of partitions which failed.
+    """
+    host, user, password, db = mongo_options(cfg_dict, 'DicomStoreOptions')
+    mongodb_in = Mongo.SmiPyMongoCollection(host, user, password)
+    mongodb_in.setImageCollection('SR')
+    if text_only:
+        mongodb_in.setFilter(Mongo.SmiPyMongoCollection.text_filter)
+    partitions = date_partitions(mongodb_in, date_from, date_to, partition_size, marker_dir)
+    logging.info(f'Extracting {sum(p[2] for p in partitions)} documents in {len(partitions)} partitions')
+    # The number of hours of each split day which are still to be done
+    hours_left = collections.Counter(day for day, hour, count in partitions if hour is not None)
+    worker = functools.partial(extract_partition, output = output, metadata_output = metadata_output,
+        jsonl_filename = jsonl_filename, unique = unique, stats = stats is not None)
+    # Check the outputs here so that a problem stops the run before it starts
+    if marker_dir and not os.path.isdir(marker_dir):
+        raise NotADirectoryError(f'Marker directory {marker_dir} does not exist')
+    jsonl = open(jsonl_filename, 'ab') if jsonl_filename else contextlib.nullcontext()
+    # The workers log through a queue to the handlers of this process
+    log_queue, listener = Logger.start_queue_listener()
+    failed = 0
+    try:
+        with jsonl, multiprocessing.Pool(jobs, initializer = init_partition_worker,
+                initargs = (log_queue, logging.getLogger().level, cfg_dict, text_only)) as pool:
+            for result in pool.imap_unordered(worker, partitions):
+                day, hour, count = result['partition']
+                if stats is not None and result['stats']:
+                    stats.merge(result['stats'])
+                if result['status'] == 'failed':
+                    failed += 1
+                    hours_left.pop(day, None) # so the day is not marked
+                    continue
+                if result['jsonl']:
+                    with open(result['jsonl'], 'rb') as fd:
+                        shutil.copyfileobj(fd, jsonl)
+                    jsonl.flush()
+                    os.remove(result['jsonl'])
+                logging.info(f'Extracted {result["extracted"]} of {count} documents from {day} hour {hour}')
+                if marker_dir:
+                    with open(partition_marker(marker_dir, result['partition']), 'w') as fd:
+                        print(json.dumps({ 'StudyDate': day, 'hour': hour, 'count': count,
+                            'extracted': result['extracted'], 'seconds': result['seconds'] }), file=fd)
+                if day in hours_left:
+                    hours_left[day] -= 1
+                    if not hours_left[day] and marker_dir:
+                        with open(partition_marker(marker_dir, (day, None, 0)), 'w') as fd:
+                            print(json.dumps({ 'StudyDate': day, 'hour': None }), file=fd)
+    finally:
+        listener.stop()
+    if failed:
+        logging.error(f'{failed} of {len(partitions)} partitions failed and will be tried again if run again')
+    return failed
+
+
+# ---------------------------------------------------------------------
+
+def extract_dicom_file(input, output, metadata_output=None, parse_cache=None, stats=None, sr_format=False, jsonl=None):
     """ Extract text from a DICOM file input
     into the output, which can be a filename,
     or a directory in which case the file is named by SOPInstanceUID.
+    parse_cache - optional DicomText.ParseCache to save the parsed text.
+    stats - optional StructuredReport.SRStats to collect statistics.
+    sr_format - use SR_parse, as for MongoDB, instead of DicomText.
+    jsonl - optional open file to append to instead of writing output,
+    see write_jsonl, in which case the text is as for sr_format.
     """
 
-    # Extract text using DicomText class
-    dicomtext = DicomText.DicomText(input)
-    dicomtext.parse()
+    if jsonl:
+        dataset = pydicom.dcmread(input, stop_before_pixels = True)
+        # JSON values which have a single element are unwrapped as from MongoDB
+        metadata_json = {}
+        for k in metadata_fields:
+            value = Dicom.tag_val(dataset, k)
+            if value:
+                metadata_json[k] = value[0] if isinstance(value, list) and len(value) == 1 else value
+        metadata_json['PatientID'] = patientid_map(metadata_json.get('PatientID',''))
+        if 'PatientID' in dataset:
+            dataset.PatientID = metadata_json['PatientID']
+        write_jsonl(jsonl, dataset, dataset.SOPInstanceUID + '.txt', metadata_json, stats)
+        return
 
-    if os.path.isdir(output):
-        filename = dicomtext.SOPInstanceUID() + '.txt'
-        output = os.path.join(output, filename)
-    if metadata_output and os.path.isdir(metadata_output):
-        filename = dicomtext.SOPInstanceUID() + '.json'
-        metadata_output = os.path.join(metadata_output, filename)
-    with open(output, 'w') as fd:
-        fd.write(dicomtext.text())
-    if metadata_output:
-        with open(metadata_output, 'w') as fd:
-            metadata_json = {k:dicomtext.tag(k) for k in metadata_fields if dicomtext.tag(k)}
-            metadata_json['PatientID'] = patientid_map(metadata_json.get('PatientID',''))
-            print(json.dumps(metadata_json), file=fd)
-        logging.info(f'Wrote {metadata_output}')
+    # Extract text using DicomText class
+    # (lazy so that pixel data and other large elements are not read)
+    with DicomText.DicomText(input, lazy = True) as dicomtext:
+        if os.path.isdir(output):
+            filename = dicomtext.SOPInstanceUID() + '.txt'
+            output = os.path.join(output, filename)
+        if metadata_output and os.path.isdir(metadata_output):
+            filename = dicomtext.SOPInstanceUID() + '.json'
+            metadata_output = os.path.join(metadata_output, filename)
+        if sr_format:
+            # SR_parse reads the Dataset directly, with the same result as
+            # from MongoDB, but not the PixelData which it does not need
+            dataset = pydicom.dcmread(input, stop_before_pixels = True)
+            if 'PatientID' in dataset:
+                dataset.PatientID = patientid_map(dataset.PatientID)
+            with open(output, 'w') as fd:
+                SR.SR_parse(dataset, os.path.basename(output), fd, stats)
+        else:
+            # The text is written as it is parsed rather than kept in memory
+            with open(output, 'w') as fd:
+                dicomtext.parse(parse_cache, writer = fd, stats = stats)
+        if metadata_output:
+            with open(metadata_output, 'w') as fd:
+                metadata_json = {k:dicomtext.tag(k) for k in metadata_fields if dicomtext.tag(k)}
+                metadata_json['PatientID'] = patientid_map(metadata_json.get('PatientID',''))
+                print(json.dumps(metadata_json), file=fd)
+            logging.info(f'Wrote {metadata_output}')
     logging.info(f'Wrote {output}')
 
 
 # ---------------------------------------------------------------------
 
-def extract_file(input, output, metadata_output=None):
+def extract_file(input, output, metadata_output=None, parse_cache=None, stats=None, sr_format=False, jsonl=None):
     """ If it's a readable DICOM file then extract it
     otherwise try to find it in MongoDB.
     """
     try:
-        pydicom.dcmread(input)
+        pydicom.dcmread(input, stop_before_pixels = True, specific_tags = ['SOPInstanceUID'])
         is_dcm = True
     except:
         is_dcm = False
 
     if is_dcm:
-        extract_dicom_file(input, output, metadata_output)
+        extract_dicom_file(input, output, metadata_output, parse_cache, stats, sr_format, jsonl)
     else:
-        extract_mongojson_file(input, output, metadata_output)
+        extract_mongojson_file(input, output, metadata_output, stats, jsonl)
 
 
 
@@ -145,11 +497,27 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='SR-to-Anon')
     parser.add_argument('-y', dest='yamlfile', action="append", help='path to yaml config file (can be used more than once)')
     parser.add_argument('-i', dest='input', action="store", help='SOPInstanceUID or path to raw DICOM file from which text will be redacted')
+    parser.add_argument('--path-list', dest='path_list', action="store", help='path to file listing DicomFilePaths to extract from MongoDB, or - for stdin')
     parser.add_argument('-o', dest='output_dir', action="store", help='path to directory where extracted text will be written')
     parser.add_argument('-m', dest='metadata_dir', action="store", help='path to directory where extracted metadata will be written')
     parser.add_argument('--semehr-unique', dest='semehr_unique', action="store_true", help='only extract from MongoDB/dicom if not already in MongoDB/semehr')
+    parser.add_argument('--text-only', dest='text_only', action="store_true", help='only extract from MongoDB/dicom if the document has a ContentSequence or TextValue')
+    parser.add_argument('--parse-cache', dest='parse_cache', action="store", help='path to directory where parsed DICOM text is cached for CTP_XMLToDicom (the text is not redacted so keep it private and remove it after use)')
+    parser.add_argument('--sr-format', dest='sr_format', action="store_true", help='write DICOM files in the same format as documents from MongoDB')
+    parser.add_argument('--jsonl', dest='jsonl', action="store", help='path to file where one line of JSON per document is appended instead of writing text and metadata files')
+    parser.add_argument('--stats', dest='stats', action="store", help='path to file where statistics are written as JSON at the end')
+    parser.add_argument('--from', dest='date_from', action="store", type=study_date, help='first StudyDate to extract from MongoDB, YYYYMMDD or YYYY/MM/DD')
+    parser.add_argument('--to', dest='date_to', action="store", type=study_date, help='last StudyDate to extract from MongoDB (default same as --from)')
+    parser.add_argument('-j', dest='jobs', action="store", type=int, default=1, help='number of worker processes for --from/--to (default 1)')
+    parser.add_argument('--partition-size', dest='partition_size', action="store", type=int, default=10000, help='split days with more than this many documents into hours (default 10000)')
+    parser.add_argument('--ensure-indexes', dest='ensure_indexes', action="store_true", help='create any missing indexes in MongoDB/dicom and MongoDB/semehr used for lookups')
+    parser.add_argument('--marker-dir', dest='marker_dir', action="store", help='path to directory where a marker is written when each day or hour is done (default output directory)')
     args = parser.parse_args()
-    if not args.input:
+    if args.date_to and not args.date_from:
+        parser.error('--to needs --from')
+    if args.date_from and args.date_to and args.date_to < args.date_from:
+        parser.error('--to is before --from')
+    if not args.input and not args.path_list and not args.date_from and not args.ensure_indexes:
         parser.print_help()
         exit(1)
     if not args.output_dir:
@@ -194,34 +562,126 @@ if __name__ == '__main__':
             logging.warning('Cannot initialise CHI to EUPI mapping (check IdentifierMapperOptions and check database server)')
 
     # ---------------------------------------------------------------------
-    if os.path.isfile(args.input):
+    parse_cache = DicomText.ParseCache(args.parse_cache) if args.parse_cache else None
+    stats = SR.SRStats() if args.stats else None
+    jsonl = open(args.jsonl, 'ab', buffering = 0) if args.jsonl else None
+
+    # ---------------------------------------------------------------------
+    if args.ensure_indexes:
+        if mongo_dicom_db == {}:
+            logging.error('Cannot create indexes as MongoDB not configured')
+            exit(1)
+        mongodb_in = Mongo.SmiPyMongoCollection(mongo_dicom_host, mongo_dicom_user, mongo_dicom_pass)
+        mongodb_in.setImageCollection('SR')
+        for field, index in mongodb_in.ensureIndexes().items():
+            logging.info(f'MongoDB index for {field} is {index}')
+        if mongo_semehr_db != {}:
+            mongodb_out = Mongo.SmiPyMongoCollection(mongo_semehr_host, mongo_semehr_user, mongo_semehr_pass)
+            mongodb_out.setSemEHRCollection('semehr_results')
+            for field, index in mongodb_out.ensureIndexes(['SOPInstanceUID']).items():
+                logging.info(f'MongoDB/semehr index for {field} is {index}')
+        if not args.input and not args.path_list and not args.date_from:
+            exit(0)
+
+    # ---------------------------------------------------------------------
+    failed = 0 # partitions of the date range which failed
+    if args.date_from:
+        if mongo_dicom_db == {}:
+            logging.error(f'Cannot extract from {args.date_from} as MongoDB not configured')
+            exit(1)
+        if args.semehr_unique:
+            mongodb_out = Mongo.SmiPyMongoCollection(mongo_semehr_host, mongo_semehr_user, mongo_semehr_pass)
+            mongodb_out.setSemEHRCollection('semehr_results')
+            check_semehr_index(mongodb_out)
+        failed = extract_date_range(cfg_dict, args.date_from, args.date_to or args.date_from,
+            args.output_dir, args.metadata_dir, args.marker_dir or args.output_dir,
+            args.semehr_unique, args.text_only, args.jsonl, stats, args.jobs, args.partition_size)
+    elif args.path_list:
+        if mongo_dicom_db == {}:
+            logging.error(f'Cannot read {args.path_list} as MongoDB not configured')
+            exit(1)
+        mongodb_in = Mongo.SmiPyMongoCollection(mongo_dicom_host, mongo_dicom_user, mongo_dicom_pass)
+        mongodb_in.setImageCollection('SR')
+        mongodb_in.setProjection(SR.sr_mongo_projection(metadata_fields))
+        if args.text_only:
+            mongodb_in.setFilter(Mongo.SmiPyMongoCollection.text_filter)
+        mongodb_out = Mongo.SmiPyMongoCollection(mongo_semehr_host, mongo_semehr_user, mongo_semehr_pass)
+        mongodb_out.setSemEHRCollection('semehr_results')
+        if args.semehr_unique:
+            check_semehr_index(mongodb_out)
+        missing = []
+        with (sys.stdin if args.path_list == '-' else open(args.path_list)) as fd:
+            # The paths are looked up in batches as they are read
+            paths = (line.strip() for line in fd if line.strip())
+            mongojsons = found_documents(mongodb_in.DicomFilePathsToJSON(paths), missing)
+            # If it's already in the annotation database then don't bother extracting.
+            if args.semehr_unique:
+                mongojsons = semehr_unique(mongojsons, mongodb_out)
+            for mongojson in mongojsons:
+                extract_mongojson(mongojson, args.output_dir, args.metadata_dir, stats, jsonl)
+        if missing:
+            logging.error(f'{len(missing)} paths in {args.path_list} not found in MongoDB')
+    elif os.path.isfile(args.input):
         # actual path to DICOM
-        extract_file(args.input, args.output_dir, args.metadata_dir)
+        extract_file(args.input, args.output_dir, args.metadata_dir, parse_cache, stats, args.sr_format, jsonl)
     elif os.path.isfile(os.path.join(root_dir, args.input)):
         # relative to FileSystemRoot
-        extract_file(os.path.join(root_dir, args.input), args.output_dir, args.metadata_dir)
+        extract_file(os.path.join(root_dir, args.input), args.output_dir, args.metadata_dir, parse_cache, stats, args.sr_format, jsonl)
     elif os.path.isdir(args.input):
         # Recurse directory
         for root, dirs, files in os.walk(args.input, topdown=False):
             for name in files:
-                extract_file(os.path.join(root, name), args.output_dir, args.metadata_dir)
+                extract_file(os.path.join(root, name), args.output_dir, args.metadata_dir, parse_cache, stats, args.sr_format, jsonl)
     elif mongo_dicom_db != {}:
-        # Only DicomFilePath and StudyDate are indexed in MongoDB.
-        # Passing a SOPInstanceUID would be handy but no point if not indexed.
+        # DicomFilePath, StudyDate and SOPInstanceUID should be indexed in MongoDB,
+        # see --ensure-indexes, otherwise each lookup is a scan of the collection.
         mongodb_in = Mongo.SmiPyMongoCollection(mongo_dicom_host, mongo_dicom_user, mongo_dicom_pass)
         mongodb_in.setImageCollection('SR')
+        mongodb_in.setProjection(SR.sr_mongo_projection(metadata_fields))
+        if args.text_only:
+            mongodb_in.setFilter(Mongo.SmiPyMongoCollection.text_filter)
         mongodb_out = Mongo.SmiPyMongoCollection(mongo_semehr_host, mongo_semehr_user, mongo_semehr_pass)
         mongodb_out.setSemEHRCollection('semehr_results')
+        if args.semehr_unique:
+            check_semehr_index(mongodb_out)
+        uids = sop_instance_uids(args.input)
         # If it looks like a date YYYY/MM/DD or YYYYMMDD extract all on that day:
-        if re.match('^\\s*\\d+/\\d+/\\d+\\s*$|^\\s*\\d{8}\\s*$', args.input):
-            for mongojson in mongodb_in.StudyDateToJSONList(args.input):
-                # If it's already in the annotation database then don't bother extracting.
-                if not args.semehr_unique or not mongodb_out.findSOPInstanceUID(mongojson['SOPInstanceUID']):
-                    extract_mongojson(mongojson, args.output_dir, args.metadata_dir)
+        if uids:
+            if not mongodb_in.ensureIndexes(['SOPInstanceUID'], create = False)['SOPInstanceUID']:
+                logging.warning('MongoDB has no index for SOPInstanceUID so lookups will be slow (see --ensure-indexes)')
+            missing = []
+            mongojsons = found_documents(mongodb_in.SOPInstanceUIDsToJSON(uids), missing)
+            if args.semehr_unique:
+                mongojsons = semehr_unique(mongojsons, mongodb_out)
+            for mongojson in mongojsons:
+                extract_mongojson(mongojson, args.output_dir, args.metadata_dir, stats, jsonl)
+            if missing:
+                logging.error(f'{len(missing)} SOPInstanceUIDs not found in MongoDB')
+        elif re.match('^\\s*\\d+/\\d+/\\d+\\s*$|^\\s*\\d{8}\\s*$', args.input):
+            mongojsons = mongodb_in.StudyDateToJSONList(args.input)
+            # If it's already in the annotation database then don't bother extracting.
+            # The SemEHR database is queried for a batch of documents at a time.
+            if args.semehr_unique:
+                mongojsons = semehr_unique(mongojsons, mongodb_out)
+            for mongojson in mongojsons:
+                extract_mongojson(mongojson, args.output_dir, args.metadata_dir, stats, jsonl)
         # Otherwise assume a DICOM file path which can be retrieved from MongoDB
         else:
             mongojson = mongodb_in.DicomFilePathToJSON(args.input)
-            extract_mongojson(mongojson, args.output_dir, args.metadata_dir)
+            extract_mongojson(mongojson, args.output_dir, args.metadata_dir, stats, jsonl)
     else:
         logging.error(f'Cannot find {args.input} as file and MongoDB not configured')
         exit(1)
+
+    if jsonl:
+        jsonl.close()
+        logging.info(f'Wrote {args.jsonl}')
+
+    if stats:
+        with open(args.stats, 'w') as fd:
+            stats.dump(fd)
+        logging.info(f'Wrote {args.stats}')
+
+    # Exit with an error so that a failed date range can be run again
+    if failed:
+        exit(1)
@@ -50,6 +50,8 @@ tidy_exit()
 	  if [ -d "${semehr_input_dir}" ]; then rmdir "${semehr_input_dir}"; fi
 	  if [ -d "${semehr_output_dir}" ]; then rm -f "${semehr_output_dir}/"*; fi
 	  if [ -d "${semehr_output_dir}" ]; then rmdir "${semehr_output_dir}"; fi
+	  if [ -d "${parse_cache_dir}" ]; then rm -f "${parse_cache_dir}/"*; fi
+	  if [ -d "${parse_cache_dir}" ]; then rmdir "${parse_cache_dir}"; fi
 	fi
 	# Tell user where log file is when failure occurs
 	if [ $rc -ne 0 ]; then echo "See log file $log" >&2; fi
@@ -104,12 +106,16 @@ fi
 # Determine the SemEHR filenames - create per-process directories
 semehr_input_dir=$(mktemp  -d -t input_docs.XXXX --tmpdir=${semehr_dir}/data)
 semehr_output_dir=$(mktemp -d -t anonymised.XXXX --tmpdir=${semehr_dir}/data)
+parse_cache_dir=$(mktemp -d -t parse_cache.XXXX --tmpdir=${semehr_dir}/data)
 if [ "$semehr_input_dir" == "" ]; then
 	tidy_exit 8 "Cannot create temporary directory in ${semehr_dir}/data"
 fi
 if [ "$semehr_output_dir" == "" ]; then
 	tidy_exit 9 "Cannot create temporary directory in ${semehr_dir}/data"
 fi
+if [ "$parse_cache_dir" == "" ]; then
+	tidy_exit 10 "Cannot create temporary directory in ${semehr_dir}/data"
+fi
 
 doc_filename=$(basename "$input_dcm")
 input_doc="${semehr_input_dir}/${doc_filename}"
@@ -119,13 +125,14 @@ anon_xml="${semehr_output_dir}/${doc_filename}.knowtator.xml"
 # ---------------------------------------------------------------------
 # Convert DICOM to text
 #  Reads  $input_dcm
-#  Writes $input_doc
+#  Writes $input_doc, and the parsed text into $parse_cache_dir
 if [ $verbose -gt 0 ]; then
-	echo "RUN: CTP_DicomToText.py  -y $default_yaml0 -y $default_yaml1 -i ${input_dcm} -o ${input_dcm}.SRtext"
+	echo "RUN: CTP_DicomToText.py  -y $default_yaml0 -y $default_yaml1 -i ${input_dcm} -o ${input_dcm}.SRtext --parse-cache ${parse_cache_dir}"
 fi
 CTP_DicomToText.py  -y $default_yaml0 -y $default_yaml1 \
 	-i "${input_dcm}" \
-	-o "${input_doc}"  || tidy_exit 4 "Error $? from CTP_DicomToText.py while converting ${input_dcm} to ${input_doc}"
+	-o "${input_doc}" \
+	--parse-cache "${parse_cache_dir}"  || tidy_exit 4 "Error $? from CTP_DicomToText.py while converting ${input_dcm} to ${input_doc}"
 
 # ---------------------------------------------------------------------
 # Run the SemEHR anonymiser using a set of private directories
@@ -140,14 +147,17 @@ fi
 
 # ---------------------------------------------------------------------
 # Convert XML back to DICOM
-#  Reads  $input_dcm and $anon_xml
+#  Reads  $input_dcm and $anon_xml, and the parsed text from $parse_cache_dir,
+#  and $input_doc, the text which SemEHR annotated, to align the annotations
 #  Writes $output_dcm (must already exist)
 if [ $verbose -gt 0 ]; then
-	echo "RUN: CTP_XMLToDicom.py -y $default_yaml1 	-i $input_dcm -x $anon_xml -o $output_dcm"
+	echo "RUN: CTP_XMLToDicom.py -y $default_yaml1 	-i $input_dcm -x $anon_xml -o $output_dcm -t $input_doc --parse-cache $parse_cache_dir"
 fi
 CTP_XMLToDicom.py -y $default_yaml1 \
 	-i "$input_dcm" \
 	-x "$anon_xml" \
-	-o "$output_dcm"   || tidy_exit 7 "Error $? from CTP_XMLToDicom.py while redacting $output_dcm with $anon_xml"
+	-o "$output_dcm" \
+	-t "$input_doc" \
+	--parse-cache "$parse_cache_dir"   || tidy_exit 7 "Error $? from CTP_XMLToDicom.py while redacting $output_dcm with $anon_xml"
 
 tidy_exit 0 "Finished with ${input_dcm}"
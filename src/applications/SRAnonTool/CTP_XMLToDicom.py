@@ -7,10 +7,15 @@
 # in the same way it was originally generated,
 # calculating the offset as it goes,
 # and replacing sections which match annotations.
-# Usage: -y default.yaml -i input.dcm -x input.xml -o output.dcm
+# Usage: -y default.yaml -i input.dcm -x input.xml -o output.dcm [-t input.txt] [--parse-cache dir] [--fail-on-leak]
+#    or: -y default.yaml -m manifest.txt [-j jobs] [-s summary.json] [--parse-cache dir] [--fail-on-leak]
+# where the manifest has one line per file: input.dcm input.xml output.dcm [input.txt]
 
 import os, sys
+import json
+import multiprocessing
 import argparse
+import functools
 import logging, logging.handlers
 import xml.etree.ElementTree    # untangle and xmltodict not available in NSH
 from deepmerge import Merger    # for deep merging dictionaries
@@ -24,6 +29,125 @@ if 'SMI_ROOT' in os.environ:     # $SMI_ROOT/lib/python3
 from SmiServices import Knowtator
 from SmiServices import Dicom
 from SmiServices import DicomText
+from SmiServices import Logger
+
+
+# ---------------------------------------------------------------------
+# Redact one DICOM file. Returns the exit code, 0 if successful,
+# 1 if a file is missing, 2 if annotated text remains (and fail_on_leak).
+
+def redact_file(input_dcm, input_xml, output_dcm, input_txt = None, parse_cache = None, fail_on_leak = False):
+    """ Redact the text in input_dcm using the annotations in input_xml
+    and write the redacted text into output_dcm (which must exist).
+    input_txt is the text which was annotated, if known.
+    parse_cache is the directory where CTP_DicomToText cached the text.
+    Returns 0 if successful, otherwise an exit code.
+    """
+    # ---------------------------------------------------------------------
+    # Check all files exist
+    if not os.path.exists(input_dcm):
+        logging.error('ERROR: no such file named {}'.format(input_dcm))
+        return 1
+    if not os.path.exists(input_xml):
+        logging.error('ERROR: no such file named {}'.format(input_xml))
+        return 1
+    if not os.path.exists(output_dcm):
+        logging.error('ERROR: no such file named {} (redacted text is written into this so it must exist)'.format(output_dcm))
+        return 1
+    if input_txt and not os.path.exists(input_txt):
+        logging.error('ERROR: no such file named {}'.format(input_txt))
+        return 1
+
+    # ---------------------------------------------------------------------
+    # Read the original DICOM file and parse the original text
+    # (lazy so that pixel data and other large elements are not read)
+    # (reusing the parse from CTP_DicomToText if it was cached)
+    with DicomText.DicomText(input_dcm, lazy = True) as dicomtext:
+        dicomtext.parse(DicomText.ParseCache(parse_cache) if parse_cache else None)
+
+        # Read the annotated XML file
+        xmlroot = xml.etree.ElementTree.parse(input_xml).getroot()
+        xmldictlist = Knowtator.annotation_xml_to_dict(xmlroot)
+        #if xmldictlist == []:
+        #    print('WARNING: empty document in {}'.format(input_xml))
+        #for annot in xmldictlist:
+        #    print('REMOVE {} from DICOM at {}'.format(annot['text'], annot['start_char']))
+
+        # Read the text which was annotated, if given, so the offsets can be aligned
+        semehr_text = None
+        if input_txt:
+            with open(input_txt) as fd:
+                semehr_text = fd.read()
+
+        # Redact the annotations from the DICOM
+        dicomtext.redact(xmldictlist, semehr_text = semehr_text)
+        #print('ORIG %s' % dicomtext.text())
+        #print('THE REDACTED TEXT IS:\n%s' % dicomtext.redacted_text())
+
+        dicomtext.write_redacted_text_into_dicom_file(output_dcm)
+        #print(f'dcm2json {redacted_dcmname} | jq \'..|select(.vr=="UT")?|.Value|.[]\'')
+        logging.info(f'Wrote {output_dcm}')
+
+        # Check that none of the annotated text remains in the output
+        report = dicomtext.verify_redacted_dicom_file(output_dcm)
+        if report['leaks']:
+            logging.error('ERROR: annotated text remains in {}: {}'.format(output_dcm, json.dumps(report)))
+            if fail_on_leak:
+                return 2
+    return 0
+
+
+# ---------------------------------------------------------------------
+# Manifest mode, many files redacted by a pool of processes.
+# Each item is a list of [input_dcm, input_xml, output_dcm, input_txt]
+# (input_txt is optional) and an error in one does not affect the others;
+# its exit code is 3 if an exception was raised, or 1 if the line is invalid.
+
+def read_manifest(fd):
+    """ Yield a list of the paths on each line of the manifest, which are
+    separated by tabs, or by spaces if there are no tabs.
+    Blank lines and lines starting with # are ignored.
+    """
+    for line in fd:
+        line = line.rstrip('\r\n')
+        if not line.strip() or line.startswith('#'):
+            continue
+        yield line.split('\t') if '\t' in line else line.split()
+
+def redact_manifest_item(item, parse_cache = None, fail_on_leak = False):
+    """ Redact one item from the manifest, catching all errors.
+    Returns a dict for the summary { input_dcm, input_xml, output_dcm, rc, error }.
+    """
+    summary = { 'input_dcm': item[0], 'input_xml': item[1] if len(item) > 1 else None,
+        'output_dcm': item[2] if len(item) > 2 else None, 'rc': 0, 'error': None }
+    if len(item) < 3 or len(item) > 4:
+        summary['rc'] = 1
+        summary['error'] = 'manifest line needs input.dcm input.xml output.dcm [input.txt]'
+        logging.error('ERROR: {} in {}'.format(summary['error'], item))
+        return summary
+    try:
+        summary['rc'] = redact_file(*item, parse_cache = parse_cache, fail_on_leak = fail_on_leak)
+    except Exception as e:
+        logging.exception('ERROR: redacting {}'.format(item[0]))
+        summary['rc'] = 3
+        summary['error'] = repr(e)
+    return summary
+
+def redact_manifest(items, jobs = None, parse_cache = None, fail_on_leak = False):
+    """ Redact every item using a pool of jobs processes (default one per CPU).
+    Returns the summary { total, failed, items } where items
+    is the list of dicts from redact_manifest_item in the same order.
+    """
+    func = functools.partial(redact_manifest_item, parse_cache = parse_cache, fail_on_leak = fail_on_leak)
+    # The workers log through a queue to the handlers of this process
+    queue, listener = Logger.start_queue_listener()
+    try:
+        with multiprocessing.Pool(jobs, initializer = Logger.init_worker_logging,
+                initargs = (queue, logging.getLogger().level)) as pool:
+            results = list(pool.imap(func, items))
+    finally:
+        listener.stop()
+    return { 'total': len(results), 'failed': len([r for r in results if r['rc']]), 'items': results }
 
 
 # ---------------------------------------------------------------------
@@ -35,8 +159,14 @@ if __name__ == "__main__":
     parser.add_argument('-i', dest='input_dcm', action="store", help='Path to raw DICOM file')
     parser.add_argument('-x', dest='input_xml', action="store", help='Path to annotation XML file')
     parser.add_argument('-o', dest='output_dcm', action="store", help='Path to anonymised DICOM file to have redacted text inserted')
+    parser.add_argument('-t', dest='input_txt', action="store", help='Path to the text file which was annotated, to align the annotation offsets')
+    parser.add_argument('-m', dest='manifest', action="store", help='Path to manifest file (or - for stdin) with one line per file: input.dcm input.xml output.dcm [input.txt]')
+    parser.add_argument('-j', dest='jobs', action="store", type=int, help='Number of processes for manifest mode (default one per CPU)')
+    parser.add_argument('-s', dest='summary', action="store", help='Path to JSON file where a summary of the manifest mode results is written')
+    parser.add_argument('--parse-cache', dest='parse_cache', action="store", help='Path to directory where CTP_DicomToText cached the parsed text (which is not redacted)')
+    parser.add_argument('--fail-on-leak', dest='fail_on_leak', action="store_true", help='Exit with an error if any annotated text remains in the output DICOM file')
     args = parser.parse_args()
-    if not args.input_dcm or not args.input_xml or not args.output_dcm:
+    if not args.manifest and (not args.input_dcm or not args.input_xml or not args.output_dcm):
         parser.print_help()
         exit(1)
 
@@ -60,37 +190,21 @@ if __name__ == "__main__":
         format='[%(asctime)s] {%(filename)s:%(lineno)d} %(levelname)s - %(message)s')
 
     # ---------------------------------------------------------------------
-    # Check all files exist
-    if not os.path.exists(args.input_dcm):
-        logging.error('ERROR: no such file named {}'.format(args.input_dcm))
-        exit(1)
-    if not os.path.exists(args.input_xml):
-        logging.error('ERROR: no such file named {}'.format(args.input_xml))
-        exit(1)
-    if not os.path.exists(args.output_dcm):
-        logging.error('ERROR: no such file named {} (redacted text is written into this so it must exist)'.format(args.output_dcm))
-        exit(1)
+    # Single file mode
+    if not args.manifest:
+        exit(redact_file(args.input_dcm, args.input_xml, args.output_dcm, args.input_txt,
+            parse_cache = args.parse_cache, fail_on_leak = args.fail_on_leak))
 
     # ---------------------------------------------------------------------
-    # Read the original DICOM file and parse the original text
-    dicomtext = DicomText.DicomText(args.input_dcm)
-    dicomtext.parse()
-
-    # Read the annotated XML file
-    xmlroot = xml.etree.ElementTree.parse(args.input_xml).getroot()
-    xmldictlist = Knowtator.annotation_xml_to_dict(xmlroot)
-    #if xmldictlist == []:
-    #    print('WARNING: empty document in {}'.format(args.input_xml))
-    #for annot in xmldictlist:
-    #    print('REMOVE {} from DICOM at {}'.format(annot['text'], annot['start_char']))
-
-    # Redact the annotations from the DICOM
-    dicomtext.redact(xmldictlist)
-    #print('ORIG %s' % dicomtext.text())
-    #print('THE REDACTED TEXT IS:\n%s' % dicomtext.redacted_text())
-
-    dicomtext.write_redacted_text_into_dicom_file(args.output_dcm)
-    #print(f'dcm2json {redacted_dcmname} | jq \'..|select(.vr=="UT")?|.Value|.[]\'')
-    logging.info(f'Wrote {args.output_dcm}')
-
-    exit(0)
+    # Manifest mode, exit 1 if any file failed
+    if args.manifest == '-':
+        items = list(read_manifest(sys.stdin))
+    else:
+        with open(args.manifest) as fd:
+            items = list(read_manifest(fd))
+    summary = redact_manifest(items, args.jobs, parse_cache = args.parse_cache, fail_on_leak = args.fail_on_leak)
+    if args.summary:
+        with open(args.summary, 'w') as fd:
+            json.dump(summary, fd, indent=1)
+    logging.info('Redacted {} of {} files from {}'.format(summary['total'] - summary['failed'], summary['total'], args.manifest))
+    exit(1 if summary['failed'] else 0)
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+
+# Tests of CTP_DicomToText.py, run in this directory with
+#   python3 -m pytest CTP_DicomToText_test.py
+# (name the file, CTP_SRAnonTool_test.py is a script not a pytest module)
+
+from os.path import join, abspath, dirname
+import argparse
+import io
+import os
+import json
+import sys
+import tempfile
+import pydicom
+import pytest
+from SmiServices import StructuredReport as SR
+
+sys.path.append(join(abspath(dirname(__file__)), '..'))
+import CTP_DicomToText
+from CTP_DicomToText import write_jsonl, found_documents, semehr_unique, check_semehr_index
+from CTP_DicomToText import sop_instance_uids, study_date, date_range, date_partitions, partition_marker, extract_partition
+
+
+class ShortWriter(io.BytesIO):
+    """ A binary file which, like an unbuffered one, may write fewer bytes
+    than it is given, here at most 100 at a time. """
+    def write(self, data):
+        return super().write(bytes(data[:100]))
+
+
+class FakeSemEHR:
+    """ The SemEHR collection, just the SOPInstanceUIDs and any indexes """
+    def __init__(self, uids, indexes = None):
+        self.uids = set(uids)
+        self.indexes = indexes or {}
+        self.queries = []
+    def findSOPInstanceUIDs(self, uids):
+        uids = list(uids)
+        self.queries.append(uids)
+        return self.uids.intersection(uids)
+    def ensureIndexes(self, fields, create = True):
+        return { field: self.indexes.get(field) for field in fields }
+
+
+class FakeStudyDates:
+    """ The image collection, just the StudyTimes of the documents for each StudyDate """
+    def __init__(self, times):
+        self.times = times
+        self.counted = []
+    def countStudyDate(self, day, hour = None):
+        self.counted.append( (day, hour) )
+        return len([ t for t in self.times.get(day, []) if hour is None or int(t[:2]) == hour ])
+    def StudyDateToJSONList(self, day, hour = None):
+        for t in self.times.get(day, []):
+            if hour is None or int(t[:2]) == hour:
+                yield { 'SOPInstanceUID': '%s.%s' % (day, t), 'StudyDate': day, 'StudyTime': t, 'TextValue': 'text' }
+
+
+def test_write_jsonl():
+    ds = pydicom.dcmread(join(abspath(dirname(__file__)), 'report10html.dcm'))
+    text, spans = SR.SR_render(ds, 'report10html.txt')
+    metadata = { 'SOPInstanceUID': ds.SOPInstanceUID }
+    for jsonl in [ io.BytesIO(), ShortWriter() ]:
+        write_jsonl(jsonl, ds, 'report10html.txt', metadata)
+        write_jsonl(jsonl, ds, 'report10html.txt', metadata)
+        lines = jsonl.getvalue().decode().split('\n')
+        assert(len(lines) == 3 and lines[2] == '')
+        assert(lines[0] == lines[1])
+        assert(json.loads(lines[0]) == { 'document': 'report10html.txt', 'metadata': metadata,
+            'text': text, 'spans': json.loads(json.dumps(spans)) })
+
+
+def test_found_documents():
+    docs = [ { 'SOPInstanceUID': '1.1' }, { 'SOPInstanceUID': '1.3' } ]
+    missing = []
+    assert(list(found_documents([ ('a', docs[0]), ('b', None), ('c', docs[1]), ('d', None) ], missing)) == docs)
+    assert(missing == ['b', 'd'])
+
+
+def test_semehr_unique():
+    docs = [ { 'SOPInstanceUID': '1.%d' % ii } for ii in range(5) ] + [ { 'PatientID': 'x' } ]
+    mongodb_out = FakeSemEHR(['1.1', '1.4', '1.9'])
+    assert(list(semehr_unique(iter(docs), mongodb_out, chunk = 2)) == [ docs[0], docs[2], docs[3], docs[5] ])
+    assert(mongodb_out.queries == [ ['1.0', '1.1'], ['1.2', '1.3'], ['1.4'] ])
+    assert(list(semehr_unique([], mongodb_out)) == [])
+    assert(len(mongodb_out.queries) == 3)
+
+def test_check_semehr_index(caplog):
+    check_semehr_index(FakeSemEHR([], { 'SOPInstanceUID': 'SOPInstanceUID_1' }))
+    assert(caplog.records == [])
+    check_semehr_index(FakeSemEHR([]))
+    assert('no index for SOPInstanceUID' in caplog.text)
+
+
+def test_study_date():
+    assert(study_date('20200131') == '20200131')
+    assert(study_date('2020/01/31') == '20200131')
+    for value in [ '20200132', '2020/1', 'today' ]:
+        with pytest.raises(argparse.ArgumentTypeError):
+            study_date(value)
+
+def test_date_range():
+    assert(list(date_range('2020/02/28', '20200302')) == [ '20200228', '20200229', '20200301', '20200302' ])
+    assert(list(date_range('20200101', '20200101')) == [ '20200101' ])
+    assert(list(date_range('20200102', '20200101')) == [])
+
+def test_partition_marker():
+    assert(partition_marker('m', ('20200101', None, 3)) == os.path.join('m', '20200101.done'))
+    assert(partition_marker('m', ('20200101', 7, 3)) == os.path.join('m', '20200101_07.done'))
+
+def test_date_partitions():
+    mongodb_in = FakeStudyDates({ '20200101': [ '010000' ],
+        '20200102': [ '010000', '020000', '020000', '230000' ],
+        '20200104': [ '120000', '120000' ] })
+    # A day over the partition size is split into hours, without the empty ones,
+    # and the empty day 20200103 is omitted, largest first
+    assert(date_partitions(mongodb_in, '20200101', '20200104', 3) ==
+        [ ('20200102', 2, 2), ('20200104', None, 2), ('20200101', None, 1), ('20200102', 1, 1), ('20200102', 23, 1) ])
+    with tempfile.TemporaryDirectory() as marker_dir:
+        for partition in [ ('20200101', None, 1), ('20200102', 2, 2), ('20200104', 3, 0) ]:
+            open(partition_marker(marker_dir, partition), 'w').close()
+        # A day with any hour done is split whatever its size, and the days and hours done are skipped
+        mongodb_in.counted = []
+        assert(date_partitions(mongodb_in, '20200101', '20200104', 10, marker_dir) ==
+            [ ('20200104', 12, 2), ('20200102', 1, 1), ('20200102', 23, 1) ])
+        assert(('20200101', None) not in mongodb_in.counted)
+        assert(('20200102', 2) not in mongodb_in.counted)
+
+def test_extract_partition(monkeypatch):
+    monkeypatch.setattr(CTP_DicomToText, '_worker', { 'mongodb_in': FakeStudyDates({ '20200102': [ '010000', '013000', '020000' ] }) })
+    with tempfile.TemporaryDirectory() as tmpdir:
+        jsonl_filename = os.path.join(tmpdir, 'out.jsonl')
+        result = extract_partition(('20200102', 1, 2), tmpdir, jsonl_filename = jsonl_filename, stats = True)
+        assert(result['status'] == 'done' and result['extracted'] == 2 and result['stats'])
+        assert(result['jsonl'] == jsonl_filename + '.20200102_01.tmp')
+        with open(result['jsonl']) as fd:
+            assert([ json.loads(line)['document'] for line in fd ] == [ '20200102.010000.txt', '20200102.013000.txt' ])
+        assert(not os.path.exists(jsonl_filename))
+        # A failure part way through fails the partition and removes its file
+        def fail(*args):
+            raise ValueError('fail')
+        monkeypatch.setattr(CTP_DicomToText, 'extract_mongojson', fail)
+        result = extract_partition(('20200102', None, 3), tmpdir, jsonl_filename = jsonl_filename)
+        assert(result['status'] == 'failed' and result['extracted'] == 0)
+        assert(sorted(os.listdir(tmpdir)) == [ 'out.jsonl.20200102_01.tmp' ])
+    # A worker which could not be initialised fails every partition
+    monkeypatch.setattr(CTP_DicomToText, '_worker', { 'error': 'ConnectionFailure()' })
+    assert(extract_partition(('20200102', None, 3), None)['status'] == 'failed')
+
+
+def test_sop_instance_uids():
+    assert(sop_instance_uids('1.2.3') == [ '1.2.3' ])
+    assert(sop_instance_uids(' 1.2.3, 1.2.4  1.2.5,\n') == [ '1.2.3', '1.2.4', '1.2.5' ])
+    for value in [ '', '123', '2020/01/02', '/PACS/2020/1.2.3.dcm', '1.2.3,x.y', '1..2' ]:
+        assert(sop_instance_uids(value) is None)
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+
+# Tests of the manifest mode of CTP_XMLToDicom.py, run in this directory with
+#   python3 -m pytest CTP_XMLToDicom_test.py
+# (name the file, CTP_SRAnonTool_test.py is a script not a pytest module)
+
+from os.path import join, abspath, dirname
+import sys
+from SmiServices import DicomText
+
+sys.path.append(join(abspath(dirname(__file__)), '..'))
+from CTP_XMLToDicom import read_manifest, redact_manifest_item, redact_manifest
+
+
+def test_read_manifest():
+    lines = [ '# comment\n', 'a.dcm\ta b.xml\tc.dcm\n', '\n', 'a.dcm b.xml c.dcm d.txt\r\n', 'a.dcm b.xml\n' ]
+    assert(list(read_manifest(lines)) == [ ['a.dcm', 'a b.xml', 'c.dcm'],
+        ['a.dcm', 'b.xml', 'c.dcm', 'd.txt'], ['a.dcm', 'b.xml'] ])
+
+def test_redact_manifest():
+    import shutil, tempfile
+    dcm = join(abspath(dirname(__file__)), 'report10html.dcm')
+    with tempfile.TemporaryDirectory() as tmpdir:
+        good_xml = join(tmpdir, 'good.xml')
+        with open(good_xml, 'w') as fd:
+            fd.write('<annotations><annotation><span start="335" end="340"/>'
+                '<spannedText>Baker</spannedText></annotation></annotations>')
+        bad_xml = join(tmpdir, 'bad.xml')
+        open(bad_xml, 'w').close()
+        outputs = [join(tmpdir, 'out%d.dcm' % ii) for ii in range(2)]
+        for output in outputs:
+            shutil.copy(dcm, output)
+        # A malformed line gives rc 1 without trying to redact
+        summary = redact_manifest_item([dcm, good_xml])
+        assert(summary['rc'] == 1 and summary['output_dcm'] is None and summary['error'])
+        # An exception, here an empty XML file, gives rc 3
+        summary = redact_manifest_item([dcm, bad_xml, outputs[1]])
+        assert(summary['rc'] == 3 and 'ParseError' in summary['error'])
+        # Each item is summarised in order and only the failures are counted
+        items = [ [dcm, good_xml, outputs[0]], [dcm, good_xml], [dcm, bad_xml, outputs[1]],
+            [join(tmpdir, 'missing.dcm'), good_xml, outputs[0]] ]
+        summary = redact_manifest(items, jobs = 2)
+        assert(summary['total'] == 4 and summary['failed'] == 3)
+        assert([item['rc'] for item in summary['items']] == [0, 1, 3, 1])
+        assert(summary['items'][0]['output_dcm'] == outputs[0])
+        # The first of the three occurrences of the annotated text is redacted
+        dicomtext = DicomText.DicomText(outputs[0])
+        dicomtext.parse()
+        assert(dicomtext.text().count('Baker') == 2)
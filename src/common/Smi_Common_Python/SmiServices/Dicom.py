@@ -4,6 +4,7 @@
 from collections.abc import Mapping
 import re
 import pydicom
+import pydicom.jsonrep
 
 
 # Hex string (without 0x prefix) for the tag number
@@ -28,12 +29,9 @@ DICOM_ContentSequence_TagString = '0040A730'
 def tag_alt(tag):
     """ Return the alternative representation for a tag name
     so 8-digit uppercase hex string or a name string.
+    Returns None if the name is not known.
     """
-    if re.match('^[0-9a-fA-F]{8}$', tag):
-        return pydicom.datadict.keyword_for_tag(tag)
-    # Need to ensure it's 8 digits with leading zeros
-    alt = '{:0>8X}'.format(pydicom.datadict.tag_for_keyword(tag))
-    return(alt)
+    return _tag_resolver.alt(tag)
 
 def tag_val(dicomdict, tagname):
     """ Look up dicomdict['tagname']
@@ -42,44 +40,337 @@ def tag_val(dicomdict, tagname):
       Returns the value of the tag, but if the tag contains
       keys called 'vr' and 'Value' then returns the value of 'Value'
     """
-    retval = None
-    alt_tagname = tag_alt(tagname)
-    if tagname in dicomdict:
-        retval = dicomdict[tagname]
-    elif alt_tagname in dicomdict:
-        retval = dicomdict[alt_tagname]
-    # The dcm2jsom or pydicom style has 'vr' and 'Value' keys
-    # so extract the Value (also sometimes has vr but no Value).
-    if isinstance(retval, Mapping):
-        if 'vr' in retval:
-            val = retval.get('Value', '') # pydicom and dcm2json write Value
-            if val == '':
-                val = retval.get('val', '') # but I've also seen val
-            retval = val
-    # Single element list reduced to just the first element
-    # but doing this breaks the assertions below.
-    #if isinstance(retval, list) and len(retval)==1:
-    #	retval = retval[0]
-    return(retval)
+    return _tag_resolver.tag_val(dicomdict, tagname)
 
 def tag_is(tagA, tagB):
     """ Test if tagA is the same as tagB
     where tags can be a number or a name.
     Tries converting tagA from number to name too"""
     # XXX only converts the first one
-    if re.match('^[0-9a-fA-F]{8}$', tagA):
-        tagA = pydicom.datadict.keyword_for_tag(tagA)
-    return(tagA == tagB)
+    return _tag_resolver.keyword(tagA) == tagB
 
 def has_tag(dicomdict, tagname):
     """ Test is tagname is in the dict,
     where tagname can be a number or a name"""
-    if tagname in dicomdict:
+    return _tag_resolver.has_tag(dicomdict, tagname)
+
+
+# ---------------------------------------------------------------------
+# TagResolver does the work of the above functions using tables
+# of keyword <-> hex string, eg. "PatientName" <-> "00100010",
+# which are filled in advance with the tags used in Structured Reports
+# and otherwise when first needed, including names which are unknown,
+# so the pydicom datadict is consulted at most once for each name.
+
+_hex_tag_re = re.compile('^[0-9a-fA-F]{8}$')
+
+def _is_mapping(value):
+    """ Same as isinstance(value, Mapping) but quicker for the usual types.
+    """
+    if isinstance(value, dict):
         return True
-    alt_tagname = tag_alt(tagname)
-    if alt_tagname in dicomdict:
+    if value is None or isinstance(value, (list, str)):
+        return False
+    return isinstance(value, Mapping)
+
+class TagResolver:
+    """ Converts between tag names and hex strings, remembering the results.
+    """
+    _sr_tags = [ 'ConceptCodeSequence', 'ConceptNameCodeSequence', 'CodeMeaning', 'CodeValue',
+        'ContentSequence', 'Date', 'DateTime', 'MeasuredValueSequence', 'MeasurementUnitsCodeSequence',
+        'NumericValue', 'PersonName', 'ReferencedSOPClassUID', 'ReferencedSOPInstanceUID',
+        'ReferencedSOPSequence', 'RelationshipType', 'SourceImageSequence', 'TextValue', 'Time',
+        'UID', 'ValueType' ]
+
+    def __init__(self, tags = _sr_tags):
+        self._alt = {}      # name -> hex, hex -> name (or None if unknown)
+        self._keyword = {}  # hex -> name, name -> itself
+        for tag in tags:
+            self.alt(tag)
+
+    def alt(self, tag):
+        """ Return the alternative representation for a tag name,
+        as tag_alt, or None if the name is not known.
+        """
+        try:
+            return self._alt[tag]
+        except KeyError:
+            pass
+        if _hex_tag_re.match(tag):
+            alt = pydicom.datadict.keyword_for_tag(tag)
+            if alt and tag.upper() == tag:
+                self._alt.setdefault(alt, tag)
+        else:
+            # Need to ensure it's 8 digits with leading zeros
+            number = pydicom.datadict.tag_for_keyword(tag)
+            alt = None if number is None else '{:0>8X}'.format(number)
+            if alt:
+                self._alt.setdefault(alt, tag)
+        self._alt[tag] = alt
+        return alt
+
+    def keyword(self, tag):
+        """ Return the name of a tag given a hex string or a name.
+        """
+        try:
+            return self._keyword[tag]
+        except KeyError:
+            pass
+        keyword = pydicom.datadict.keyword_for_tag(tag) if _hex_tag_re.match(tag) else tag
+        self._keyword[tag] = keyword
+        return keyword
+
+    def tag_val(self, dicomdict, tagname):
+        """ See tag_val above.
+        """
+        if isinstance(dicomdict, pydicom.Dataset):
+            elem = self._dataset_element(dicomdict, tagname)
+            return None if elem is None else element_value(elem)
+        if tagname in dicomdict:
+            retval = dicomdict[tagname]
+        else:
+            alt_tagname = self._alt[tagname] if tagname in self._alt else self.alt(tagname)
+            retval = dicomdict[alt_tagname] if alt_tagname and alt_tagname in dicomdict else None
+        # The dcm2jsom or pydicom style has 'vr' and 'Value' keys
+        # so extract the Value (also sometimes has vr but no Value).
+        if _is_mapping(retval):
+            if 'vr' in retval:
+                val = retval.get('Value', '') # pydicom and dcm2json write Value
+                if val == '':
+                    val = retval.get('val', '') # but I've also seen val
+                retval = val
+        # Single element list reduced to just the first element
+        # but doing this breaks the assertions below.
+        #if isinstance(retval, list) and len(retval)==1:
+        #	retval = retval[0]
+        return retval
+
+    def has_tag(self, dicomdict, tagname):
+        """ See has_tag above.
+        """
+        if isinstance(dicomdict, pydicom.Dataset):
+            return self._dataset_element(dicomdict, tagname) is not None
+        if tagname in dicomdict:
+            return True
+        alt_tagname = self._alt[tagname] if tagname in self._alt else self.alt(tagname)
+        return bool(alt_tagname) and alt_tagname in dicomdict
+
+    def _dataset_element(self, dataset, tagname):
+        """ Return the DataElement for a tag name or hex string
+        in a pydicom Dataset, or None if not present.
+        """
+        hex_tag = tagname if _hex_tag_re.match(tagname) else self.alt(tagname)
+        if not hex_tag:
+            return None
+        tag = int(hex_tag, 16)
+        return dataset[tag] if tag in dataset else None
+
+_tag_resolver = TagResolver()
+
+def test_TagResolver():
+    resolver = TagResolver(tags = [])
+    assert(resolver.alt('PatientName') == '00100010')
+    assert(resolver.alt('00100010') == 'PatientName')
+    assert(resolver.alt('0040a730') == 'ContentSequence')
+    assert(resolver.alt('NotATag') == None)
+    assert(resolver.alt('00091001') == '')
+    assert(resolver.keyword('0040A730') == 'ContentSequence')
+    assert(resolver.keyword('NotATag') == 'NotATag')
+    assert(resolver.keyword('PatientName') == 'PatientName')
+    assert(tag_is('0040A730', 'ContentSequence'))
+    assert(tag_is('ContentSequence', 'ContentSequence'))
+    assert(not tag_is('0040A730', 'TextValue'))
+    dicomdict = { '0040A160': { 'vr': 'UT', 'Value': ['text'] }, 'ValueType': 'TEXT', 'NotATag': 1 }
+    assert(tag_val(dicomdict, 'TextValue') == ['text'])
+    assert(tag_val(dicomdict, '0040A160') == ['text'])
+    assert(tag_val(dicomdict, '0040A040') == 'TEXT')
+    assert(tag_val(dicomdict, 'NotATag') == 1)
+    assert(tag_val(dicomdict, 'PatientName') == None)
+    assert(tag_val({ 'PersonName': { 'vr': 'PN' } }, 'PersonName') == '')
+    assert(has_tag(dicomdict, 'TextValue'))
+    assert(has_tag(dicomdict, '0040A040'))
+    assert(not has_tag(dicomdict, 'PatientName'))
+    assert(not has_tag(dicomdict, 'AlsoNotATag'))
+    dataset = pydicom.Dataset()
+    dataset.TextValue = 'text'
+    dataset.add_new(0x00091001, 'LO', 'private')
+    assert(tag_val(dataset, 'TextValue') == ['text'])
+    assert(tag_val(dataset, '00091001') == ['private'])
+    assert(tag_val(dataset, 'PatientName') == None)
+    assert(has_tag(dataset, '0040A160'))
+    assert(not has_tag(dataset, 'PatientName'))
+    assert(not has_tag(dataset, 'NotATag'))
+
+
+# ---------------------------------------------------------------------
+# An adapter so that a pydicom Dataset can be used in place of the dict
+# from dataset.to_json_dict(None, 0) without creating that dict.
+# The value of each element is the same as tag_val would return from the
+# JSON, except that a sequence is a list of Datasets, and binary values,
+# which are written as InlineBinary rather than Value, are empty.
+
+_binary_VRs = frozenset([ 'OB', 'OD', 'OF', 'OL', 'OV', 'OW', 'UN',
+    'OB or OW', 'US or OW', 'US or SS or OW' ])
+
+def element_value(elem):
+    """ Return the value of a pydicom DataElement in the form used in JSON.
+    """
+    if elem.VR == 'SQ':
+        return list(elem.value)
+    if elem.VR in _binary_VRs or elem.is_empty:
+        return ''
+    values = elem.value if elem.VM > 1 else [elem.value]
+    if elem.VR == 'PN':
+        values = [ dict(zip(('Alphabetic', 'Ideographic', 'Phonetic'), value.components)) for value in values ]
+    elif elem.VR == 'AT':
+        values = [ format(value, '08X') for value in values ]
+    else:
+        values = pydicom.jsonrep.convert_to_python_number(list(values), elem.VR)
+    return values
+
+def _dataset_items(dataset):
+    """ Yield (name, value) for each element of a pydicom Dataset, in the
+    same order as to_json_dict, where name is the keyword if known
+    otherwise the hex string.
+    """
+    for tag in dataset.keys():
+        elem = dataset[tag]
+        yield (elem.keyword or '{:0>8X}'.format(tag), element_value(elem))
+
+# ---------------------------------------------------------------------
+# canonicalise rewrites a document from MongoDB or dcm2json/pydicom,
+# which can be keyed by hex string or name, and where values may be
+# wrapped in { 'vr', 'Value' }, into a tree of SRNode keyed by name with
+# the values unwrapped (as tag_val would return them) so that it only
+# needs to be done once however many times the document is read.
+# The tags used in Structured Reports are attributes, eg. node.TextValue
+# (if present), others are only accessible as node['Name']; both can
+# be used with tag_val and has_tag. The document order is kept.
+
+class SRNode:
+    """ One dataset (or sequence item) of a canonical document.
+    """
+    __slots__ = tuple(TagResolver._sr_tags) + ('_keys', '_other')
+    _slot_tags = frozenset(TagResolver._sr_tags)
+
+    def __init__(self):
+        self._keys = []
+        self._other = {}
+
+    def __setitem__(self, key, value):
+        if key not in self:
+            self._keys.append(key)
+        if key in SRNode._slot_tags:
+            setattr(self, key, value)
+        else:
+            self._other[key] = value
+
+    def __getitem__(self, key):
+        if key in SRNode._slot_tags:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        return self._other[key]
+
+    def __contains__(self, key):
+        if key in SRNode._slot_tags:
+            return hasattr(self, key)
+        return key in self._other
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    def get(self, key, default = None):
+        return self[key] if key in self else default
+
+    def keys(self):
+        return list(self._keys)
+
+    def items(self):
+        return [(key, self[key]) for key in self._keys]
+
+def _is_dataset(item):
+    """ Test if item is a dict representing a dataset (a sequence item)
+    rather than a value such as a PersonName { 'Alphabetic': name }.
+    """
+    if isinstance(item, pydicom.Dataset):
         return True
-    return False
+    return _is_mapping(item) and any(_tag_resolver.alt(key) for key in item)
+
+def canonicalise(json_dict):
+    """ Return a tree of SRNode representing the document json_dict,
+    or a pydicom Dataset, with names instead of hex strings (except for
+    unknown tags), unwrapped values, and sequences as lists of SRNode.
+    """
+    if isinstance(json_dict, SRNode):
+        return json_dict
+    root = SRNode()
+    slot_tags = SRNode._slot_tags
+    keyword = _tag_resolver.keyword
+    # Each dict is converted into its (empty) node when it is taken from
+    # the stack, rather than by recursion, so any depth of nesting is allowed
+    stack = [ (json_dict, root) ]
+    while stack:
+        json_dict, node = stack.pop()
+        # Fill in the node directly, rather than by node[key] = value,
+        # as this is done for every item in every document
+        keys = node._keys
+        other = node._other
+        items = _dataset_items(json_dict) if isinstance(json_dict, pydicom.Dataset) else json_dict.items()
+        for key, value in items:
+            is_sequence = False
+            if _is_mapping(value) and 'vr' in value:
+                is_sequence = (value['vr'] == 'SQ')
+                val = value.get('Value', '') # as tag_val
+                if val == '':
+                    val = value.get('val', '')
+                value = val
+            if isinstance(value, list) and value and (is_sequence or _is_dataset(value[0])):
+                items = []
+                for item in value:
+                    if (_is_mapping(item) and not isinstance(item, SRNode)) or isinstance(item, pydicom.Dataset):
+                        stack.append( (item, SRNode()) )
+                        item = stack[-1][1]
+                    items.append(item)
+                value = items
+            key = keyword(key) or key
+            if key in slot_tags:
+                if not hasattr(node, key):
+                    keys.append(key)
+                setattr(node, key, value)
+            else:
+                if key not in other:
+                    keys.append(key)
+                other[key] = value
+    return root
+
+def test_canonicalise():
+    doc = { '0040A730': { 'vr': 'SQ', 'Value': [
+                { '0040A040': { 'vr': 'CS', 'Value': ['TEXT'] }, '0040A160': { 'vr': 'UT', 'Value': ['text'] },
+                  '0040A123': { 'vr': 'PN', 'Value': [ { 'Alphabetic': 'A^B' } ] } } ] },
+            '00100010': { 'vr': 'PN' },
+            '00091001': 'private',
+            'header': { 'DicomFilePath': 'x' } }
+    node = canonicalise(doc)
+    assert(list(node) == ['ContentSequence', 'PatientName', '00091001', 'header'])
+    item = node.ContentSequence[0]
+    assert(isinstance(item, SRNode))
+    assert(item.ValueType == ['TEXT'] and item.TextValue == ['text'])
+    assert(item.PersonName == [ { 'Alphabetic': 'A^B' } ])
+    assert(node['PatientName'] == '' and node['header'] == { 'DicomFilePath': 'x' })
+    assert('Date' not in item and not has_tag(item, 'Date'))
+    assert(tag_val(item, '0040A160') == ['text'])
+    assert(canonicalise(node) is node)
+    # Mongo style documents are already unwrapped
+    node = canonicalise({ 'ContentSequence': [ { 'ValueType': 'TEXT', 'TextValue': 'text' } ] })
+    assert(node.ContentSequence[0].TextValue == 'text')
 
 
 # ---------------------------------------------------------------------
@@ -1,11 +1,23 @@
 """ Functions to assist with decoding text in DICOM files
 """
 
+import copy
+import difflib
+import functools
+import hashlib
+import json
+import mmap
 import os
 import pydicom
+from pydicom.filebase import DicomBytesIO
+from pydicom.filewriter import write_data_element
 import re
 import random
-from SmiServices.StructuredReport import sr_keys_to_extract, sr_keys_to_ignore
+import time
+from bisect import bisect_left, bisect_right
+from operator import itemgetter
+from SmiServices.StructuredReport import sr_keys_to_extract, sr_tag_policy
+from SmiServices.IsIdentifiable import AhoCorasick
 
 
 # ---------------------------------------------------------------------
@@ -22,6 +34,82 @@ def test_string_match():
     assert(string_match('hello\r\nworld', 'hello \nworld'))
 
 # ---------------------------------------------------------------------
+# Compiled patterns for redact_html_tags_in_string.
+# Each of the original regex passes is kept, in the same order, so the
+# output is unchanged, but each is done with a forward-only scan so
+# the time is linear in the length of the string even when a <script>
+# or <style> is never closed.
+
+_html_tag_names = '.DOCTYPE|a|abbr|acronym|address|applet|area|article|aside|audio|b|base|basefont|bdi|bdo|big|blockquote|body|br|button|canvas|caption|center|cite|code|col|colgroup|data|datalist|dd|del|details|dfn|dialog|dir|div|dl|dt|em|embed|fieldset|figcaption|figure|font|footer|form|frame|frameset|h1|h2|h3|h4|h5|h6|head|header|hr|html|i|iframe|img|input|ins|kbd|label|legend|li|link|main|map|mark|meta|meter|nav|noframes|noscript|object|ol|optgroup|option|output|p|param|picture|pre|progress|q|rp|rt|ruby|s|samp|script|section|select|small|source|span|strike|strong|style|sub|summary|sup|svg|table|tbody|td|template|textarea|tfoot|th|thead|time|title|tr|track|tt|u|ul|var|video|wbr'
+_html_tag_name_re = re.compile('(?:%s)' % _html_tag_names, re.IGNORECASE)
+# Any tag-like <name attr> where the name is checked afterwards
+# (the . in .DOCTYPE can match any character, even space or >)
+_html_tag_re = re.compile('<(/?)(.DOCTYPE|[^ <>]*)( [^<>]*)?>', re.IGNORECASE)
+
+@functools.lru_cache(maxsize=1024)
+def _html_tag_name_valid(name, slash):
+    """ Test if name is one of the known tag names, or, if it was preceded by
+    a slash, whether the slash and name match eg. </DOCTYPE> matches .DOCTYPE
+    """
+    return bool(_html_tag_name_re.fullmatch(name) or
+        (slash and _html_tag_name_re.fullmatch('/' + name)))
+
+_html_block_re = {
+    'script': (re.compile('<script', re.IGNORECASE), re.compile('</script>', re.IGNORECASE)),
+    'style':  (re.compile('<style',  re.IGNORECASE), re.compile('</style>',  re.IGNORECASE)),
+}
+
+def _redact_html_empty_element(html_str, tagname, replchar):
+    """ Replace every <tagname.../> (case sensitive) with replchar,
+    equivalent to re.sub('<tagname[^>]*/>') but without the backtracking.
+    """
+    opener = '<' + tagname
+    rc = []
+    pos = 0
+    gt = -1
+    while True:
+        start = html_str.find(opener, pos)
+        if start < 0:
+            break
+        # The element ends at the first > which must be preceded by /
+        if gt < start:
+            gt = html_str.find('>', start + len(opener))
+            if gt < 0:
+                break
+        if html_str[gt-1] == '/' and gt-1 >= start + len(opener):
+            rc.append(html_str[pos:start])
+            rc.append(replchar * (gt + 1 - start))
+            pos = gt + 1
+        else:
+            rc.append(html_str[pos:start+1])
+            pos = start + 1
+    rc.append(html_str[pos:])
+    return ''.join(rc)
+
+def _redact_html_block(html_str, tagname, replchar):
+    """ Replace every <tagname...>...</tagname> (case insensitive) with replchar,
+    equivalent to re.sub('<tagname[^>]*>.*?</tagname>', flags=re.I|re.S).
+    If an element has no closing tag then no later one can have either
+    so the scan stops rather than searching to the end for each one.
+    """
+    open_re, close_re = _html_block_re[tagname]
+    rc = []
+    pos = 0
+    while True:
+        start = open_re.search(html_str, pos)
+        if not start:
+            break
+        gt = html_str.find('>', start.end())
+        if gt < 0:
+            break
+        end = close_re.search(html_str, gt + 1)
+        if not end:
+            break
+        rc.append(html_str[pos:start.start()])
+        rc.append(replchar * (end.end() - start.start()))
+        pos = end.end()
+    rc.append(html_str[pos:])
+    return ''.join(rc)
 
 def redact_html_tags_in_string(html_str):
     """ Replace the HTML tags in a string with equal length of a
@@ -35,18 +123,25 @@ def redact_html_tags_in_string(html_str):
     """
     replchar = '.'
     def replfunc(s):
-        return replchar.rjust(len(s.group(0)), replchar)
-    # Use re.I (ignore case) re.M (multi-line) re.S (dot matches all)
-    # re.S needed to match CR/LF when scripts are multi-line.
+        # The tag name must be in the list, otherwise leave it alone, eg. <1 month>
+        if _html_tag_name_valid(s.group(2), s.group(1)):
+            return replchar * len(s.group(0))
+        return s.group(0)
+    # Replacing &nbsp; first gives the same result as the original order
+    # because none of the tag patterns can start or end inside it
+    if '&' in html_str:
+        html_str = html_str.replace('&nbsp;', '      ')
+    # Plain text needs no more work
+    if '<' not in html_str:
+        return html_str
     # First replace single-instance tags <script.../> and <style.../>
-    html_str = re.sub('<script[^>]*/>', replfunc, html_str)
-    html_str = re.sub('<style[^>]*/>',  replfunc, html_str)
-    html_str = re.sub('&nbsp;', '      ', html_str)
+    html_str = _redact_html_empty_element(html_str, 'script', replchar)
+    html_str = _redact_html_empty_element(html_str, 'style', replchar)
     # Now replace the whole <script>...</script> and style sequence
-    html_str = re.sub('<script[^>]*>.*?</script>', replfunc, html_str, flags=re.I|re.M|re.S)
-    html_str = re.sub('<style[^>]*>.*?</style>', replfunc, html_str, flags=re.I|re.M|re.S)
+    html_str = _redact_html_block(html_str, 'script', replchar)
+    html_str = _redact_html_block(html_str, 'style', replchar)
     # Finally remove single-instance tags like <p> and <br>
-    html_str = re.sub('</{0,1}(.DOCTYPE|a|abbr|acronym|address|applet|area|article|aside|audio|b|base|basefont|bdi|bdo|big|blockquote|body|br|button|canvas|caption|center|cite|code|col|colgroup|data|datalist|dd|del|details|dfn|dialog|dir|div|dl|dt|em|embed|fieldset|figcaption|figure|font|footer|form|frame|frameset|h1|h2|h3|h4|h5|h6|head|header|hr|html|i|iframe|img|input|ins|kbd|label|legend|li|link|main|map|mark|meta|meter|nav|noframes|noscript|object|ol|optgroup|option|output|p|param|picture|pre|progress|q|rp|rt|ruby|s|samp|script|section|select|small|source|span|strike|strong|style|sub|summary|sup|svg|table|tbody|td|template|textarea|tfoot|th|thead|time|title|tr|track|tt|u|ul|var|video|wbr)( [^<>]*){0,1}>', replfunc, html_str, flags=re.IGNORECASE)
+    html_str = _html_tag_re.sub(replfunc, html_str)
     return(html_str)
 
 def test_redact_html_tags_in_string():
@@ -55,15 +150,228 @@ def test_redact_html_tags_in_string():
     # changing the \r to a space in the expected string also tests the string_match function
     expected = '.................... ..................................... text1 <1 month \n....text2 .......................... text3      ....'
     assert(string_match(dest, expected))
+    # Tag names must be known, but .DOCTYPE matches any character
+    assert(redact_html_tags_in_string('<p class="x">a<1 month>b</DOCTYPE>< DOCTYPE>') == '.............a<1 month>b....................')
+    assert(redact_html_tags_in_string('<style <script/>') == '<style .........')
+    # Unclosed script or style elements are left for the single tag pass
+    assert(redact_html_tags_in_string('<script>x' * 3) == '........x' * 3)
+    assert(redact_html_tags_in_string('<style x' * 3) == '<style x' * 3)
+
+# ---------------------------------------------------------------------
+# Alignment of the character offsets in SemEHR annotations with the
+# offsets in the text found by parse. An alignment is a pair of sorted
+# lists (positions, deltas) such that offset p in SemEHR's text is at
+# p + deltas[i] in ours, where positions[i] is the last one <= p,
+# so an annotation is translated by bisection whatever the drift.
+
+_crlf_to_space = str.maketrans('\r\n', '  ')
+
+def _alignment_from_anchors(anchors):
+    """ Given a list of (position in SemEHR text, position in our text)
+    sorted by the former, keep the longest chain of anchors which are in
+    the same order in both texts (so one misplaced anchor can't upset
+    its neighbours) and return the alignment.
+    """
+    tails = []       # index of the anchor ending the best chain of length n+1
+    tail_dests = []  # and its position in our text
+    previous = []    # index of the anchor before each anchor in its chain
+    for ii, (_, dest) in enumerate(anchors):
+        nn = bisect_left(tail_dests, dest)
+        previous.append(tails[nn-1] if nn > 0 else None)
+        if nn == len(tails):
+            tails.append(ii)
+            tail_dests.append(dest)
+        else:
+            tails[nn] = ii
+            tail_dests[nn] = dest
+    chain = []
+    ii = tails[-1] if tails else None
+    while ii is not None:
+        chain.append(anchors[ii])
+        ii = previous[ii]
+    chain.reverse()
+    if not chain:
+        return ([0], [0])
+    return ([src for src, _ in chain], [dest - src for src, dest in chain])
+
+def text_alignment(src_text, dest_windows):
+    """ Align the text which SemEHR annotated with our text, given as
+    a sequence of (offset, text) windows which each end with a newline,
+    eg. one for each segment found by parse, by matching whole lines.
+    Only a hash of each of our lines is kept, not the text.
+    Carriage returns are treated as spaces, as in string_match.
+    Returns an alignment for translate_offset.
+    """
+    src_hashes = []
+    src_at = []
+    at = 0
+    for line in src_text.replace('\r', ' ').split('\n'):
+        src_hashes.append(hash(line))
+        src_at.append(at)
+        at += len(line) + 1
+    dest_hashes = []
+    dest_at = []
+    for offset, text in dest_windows:
+        at = offset
+        for line in text.replace('\r', ' ').split('\n')[:-1]:
+            dest_hashes.append(hash(line))
+            dest_at.append(at)
+            at += len(line) + 1
+    matcher = difflib.SequenceMatcher(None, src_hashes, dest_hashes, autojunk = False)
+    return _alignment_from_anchors([ (src_at[aa], dest_at[bb])
+        for aa, bb, size in matcher.get_matching_blocks() if size ])
+
+def annotation_alignment(annots, dest_windows):
+    """ Align the offsets of the annotations with our text, given as
+    a sequence of (offset, text) windows, eg. one for each segment found
+    by parse, which must already have carriage returns and newlines
+    replaced by spaces, using as anchors the annotations whose text
+    occurs exactly once (text spanning two windows is not found).
+    Returns an alignment for translate_offset.
+    """
+    starts = []
+    for annot in annots:
+        text = annot['text'].translate(_crlf_to_space)
+        if len(text) == annot['end_char'] - annot['start_char']:
+            starts.append( (annot['start_char'], text) )
+    # One pass over each window whatever the number of annotations
+    automaton = AhoCorasick(ignore_case = False, whole_words = False)
+    for text in set([text for _, text in starts]):
+        automaton.add(text, text)
+    found = {} # position of each text, or None if found more than once
+    for offset, window in dest_windows:
+        for at, _, text in automaton.finditer(window):
+            found[text] = offset + at if text not in found else None
+    anchors = sorted([ (start, found[text]) for start, text in starts if found.get(text) is not None ])
+    return _alignment_from_anchors(anchors)
+
+def translate_offset(alignment, offset):
+    """ Return the offset in our text of the given offset in SemEHR's text.
+    """
+    positions, deltas = alignment
+    return offset + deltas[max(bisect_right(positions, offset) - 1, 0)]
+
+def test_text_alignment():
+    src = 'extra line\nhello world\r\nsecond line\nthird\n'
+    dest = 'hello world\n\nsecond line\nthird\n'
+    alignment = text_alignment(src, [(0, 'hello world\n\n'), (13, 'second line\nthird\n')])
+    assert(translate_offset(alignment, src.index('world')) == dest.index('world'))
+    assert(translate_offset(alignment, src.index('third')) == dest.index('third'))
+    assert(text_alignment(dest, [(0, dest)]) == ([0], [0]))
+    # Unique texts are anchors, the out-of-order one is ignored
+    annots = [ { 'start_char': 100, 'end_char': 105, 'text': 'hello' },
+        { 'start_char': 150, 'end_char': 155, 'text': 'world' },
+        { 'start_char': 160, 'end_char': 165, 'text': 'third' } ]
+    alignment = annotation_alignment(annots, [(0, 'xx third '), (9, 'hello world')])
+    assert(alignment == ([100, 150], [-91, -135]))
+    assert(translate_offset(alignment, 50) == -41)
+    assert(translate_offset(alignment, 160) == 25)
 
 # ---------------------------------------------------------------------
+# Verification that the annotated text has gone from a redacted dataset.
+# All of the annotations are put into one automaton so each text element
+# of the dataset is searched once whatever the number of annotations.
+
+_text_VRs = ['LO', 'LT', 'PN', 'SH', 'ST', 'UC', 'UT']
+
+def _dataset_leaks(dataset, path, automaton, leaks):
+    """ Search the text elements of dataset, recursing into sequences,
+    and append a dict to leaks for each annotated text found.
+    """
+    for data_element in dataset:
+        name = path + (data_element.keyword or str(data_element.tag))
+        if data_element.VR == 'SQ':
+            for ii, item in enumerate(data_element.value):
+                _dataset_leaks(item, '%s[%d].' % (name, ii), automaton, leaks)
+        elif data_element.VR in _text_VRs and data_element.value:
+            values = data_element.value if data_element.VM > 1 else [data_element.value]
+            for value in values:
+                value = str(value).translate(_crlf_to_space)
+                for start, end, text in automaton.finditer(value):
+                    leaks.append( { 'element': name, 'start': start, 'end': end, 'text': text } )
+
+def redaction_leaks(dataset, annot_list):
+    """ Search every text element of the dataset for the text of any
+    of the annotations (whole words, matching case) which should have
+    been redacted. Returns a list of dicts { element, start, end, text }
+    where element is a path like ContentSequence[0].TextValue.
+    """
+    automaton = AhoCorasick(ignore_case = False)
+    texts = set([(annot['text'] or '').translate(_crlf_to_space).strip() for annot in annot_list])
+    for text in sorted(texts):
+        # Ignore text which can't be told apart from redacted text
+        if text.strip(DicomText._redact_char + DicomText._redact_char_digit + ' '):
+            automaton.add(text, text)
+    leaks = []
+    if len(automaton):
+        _dataset_leaks(dataset, '', automaton, leaks)
+    return leaks
+
+# ---------------------------------------------------------------------
+# Functions used to patch the values of data elements in place in a file.
+
+def _encoded_value(data_element, encodings):
+    """ Return the bytes which pydicom would write for the value of
+    data_element in a little endian file, including any padding.
+    """
+    fp = DicomBytesIO()
+    fp.is_little_endian = True
+    fp.is_implicit_VR = True
+    write_data_element(fp, data_element, encodings)
+    # Implicit VR header is just the tag and length, 8 bytes
+    return fp.getvalue()[8:]
+
+def _dataset_raw_values(dataset, path, raw_values, base = 0):
+    """ Fill the dict raw_values with the file offset and the original
+    bytes of every data element in the dataset, recursing into sequences.
+    The key is a path of tags and item numbers, eg. (ContentSequence, 0, TextValue).
+    The offset is None if the element has already been converted.
+    pydicom reads the items of a defined length sequence from a copy of its
+    value so their offsets are relative to that, base is where it starts.
+    """
+    for tag in dataset.keys():
+        raw = dataset.get_item(tag)
+        data_element = dataset[tag]
+        if data_element.VR == 'SQ':
+            # Undefined length sequences are read directly so keep the base
+            item_base = base
+            if isinstance(raw.value, bytes) or not raw.is_undefined_length:
+                # value_tell while still raw, file_tell once converted
+                seq_tell = raw.value_tell if isinstance(raw.value, bytes) else raw.file_tell
+                item_base = None if seq_tell is None or base is None else base + seq_tell
+            for ii, item in enumerate(data_element.value):
+                _dataset_raw_values(item, path + (int(tag), ii), raw_values, item_base)
+        else:
+            value_tell = getattr(raw, 'value_tell', None)
+            if value_tell is not None and base is not None:
+                value_tell += base
+            else:
+                value_tell = None
+            raw_values[path + (int(tag),)] = (value_tell, raw.value)
+
+def _dataset_changed_values(dataset, path, text_tags, encodings, changed_values, in_text = False):
+    """ Fill the dict changed_values with the encoded value of every
+    data element which may have been changed by redaction, i.e. those
+    inside the text_tags and any PN or DA. The key is the full path as above,
+    even outside the text, so nested names can't be mistaken for top-level ones.
+    """
+    for data_element in dataset:
+        tag = int(data_element.tag)
+        in_element = in_text or tag in text_tags
+        if data_element.VR == 'SQ':
+            if in_element:
+                changed_values[path + (tag,)] = None
+            for ii, item in enumerate(data_element.value):
+                _dataset_changed_values(item, path + (tag, ii), text_tags, encodings, changed_values, in_element)
+        elif in_element or data_element.VR in ['PN', 'DA']:
+            changed_values[path + (tag,)] = _encoded_value(data_element, encodings)
 
 
 class DicomText:
     """ A class holding a DICOM file which can be parsed to extract the
     text, and can be redacted given a list of annotations.
     Typical usage:
-    dicomtext = Dicom.DicomText(dcmname) # Reads the raw DICOM file
+    dicomtext = Dicom.DicomText(dcmname) # Reads the raw DICOM file (or use with ... as dicomtext:)
     dicomtext.parse()                    # Analyses the text inside the ContentSequence
     xmldictlist = Knowtator.annotation_xml_to_dict(xml.etree.ElementTree.parse(xmlfilename).getroot())
     dicomtext.redact(xmldictlist)        # Redacts the parsed text using the annotations
@@ -79,6 +387,9 @@ class DicomText:
     but do not use random length unless you are sure the change in string length won't
     break something else (eg. the string is inside a file format where length matters,
     or we need to keep the SemEHR annotations around, with their char offsets, for other reasons).
+    Lazy loading reads only the tags which are needed to extract the text,
+    skipping pixel data and large binary elements, and leaves character set
+    decoding until an element is actually used; optionally via memory-mapping.
     """
     _include_header = True           # SemEHR uses some header fields to give context to body
     _include_unexpected_tags = False # SemEHR does not use unknown tags anyway so ignore them
@@ -87,29 +398,80 @@ class DicomText:
     _redact_random_length = False    # do not use True unless you're sure the change in length won't break something
     _redact_char = 'X'               # character used to redact text
     _redact_char_digit = '9'         # character used to redact digits in text
+    _redact_offset_window = 32       # how far SemEHR annotation offsets may slip from ours
+    _lazy_load = False               # only read the tags needed for the text
+    _patch_in_place = True           # overwrite redacted values in the file if lengths are unchanged
+    _lazy_defer_size = '64 KB'       # when lazy, values larger than this are read only if used
+    _lazy_tags = [ 'SpecificCharacterSet', 'SOPClassUID', 'SOPInstanceUID',
+        'StudyInstanceUID', 'SeriesInstanceUID', 'ModalitiesInStudy',
+        'TextValue', 'ContentSequence' ] # read when lazy, in addition to sr_keys_to_extract
 
     def __init__(self, filename, \
         include_header = _include_header, \
-        replace_HTML_entities = _replace_HTML_entities):
+        replace_HTML_entities = _replace_HTML_entities, \
+        lazy = _lazy_load, \
+        memory_map = False):
         """ The DICOM file is read during construction.
+        If lazy then only the tags in sr_keys_to_extract and _lazy_tags
+        are read (others are read on demand by the tag method).
+        If memory_map then the file is memory-mapped rather than read.
         """
-        self._p_text = '' # maintain string progress during plaintext walk
-        self._r_text = '' # maintain string progress during redaction walk
-        self._redacted_text = ''
+        self._p_chunks = [] # the text found by parse, joined only when needed
+        self._redacted_chunks = [] # and the redacted text of each segment
+        self._writer = None # where the text is written instead, if streaming
+        self._stats = None # StructuredReport.SRStats being collected by parse
+        self._parsed = False
         self._redact_offset = 0
-        self._offset_list = [] # XXX not used
+        self._segments = [] # text elements found by parse, used by redact
         self._annotations = []
         self._filename = filename
-        self._dicom_raw = pydicom.dcmread(filename)
         # Copy class settings to instance settings with overrides
         self._include_header = include_header
         self._replace_HTML_entities = replace_HTML_entities
-        # XXX do we need to decode the text?
-        self._dicom_raw.decode()
+        self._lazy = lazy
+        self._lazy_tags_read = None # set of tags read when lazy, None if all
+        self._mmap = None
+        fp = filename
+        if memory_map:
+            with open(filename, 'rb') as fd:
+                self._mmap = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+            fp = self._mmap
+        if self._lazy:
+            # Unexpected tags can only be found by reading all of them
+            specific_tags = None
+            if not (DicomText._include_unexpected_tags or DicomText._warn_unexpected_tag):
+                specific_tags = [srkey['tag'] for srkey in sr_keys_to_extract] + DicomText._lazy_tags
+                self._lazy_tags_read = set([pydicom.datadict.tag_for_keyword(t) for t in specific_tags])
+            # The file (or mmap) is kept so that deferred values can be read later
+            self._dicom_raw = pydicom.dcmread(fp, stop_before_pixels = True,
+                defer_size = DicomText._lazy_defer_size, specific_tags = specific_tags)
+        else:
+            self._dicom_raw = pydicom.dcmread(fp)
+            # XXX do we need to decode the text?
+            self._dicom_raw.decode()
+            if self._mmap:
+                self._mmap.close()
+                self._mmap = None
 
     def __repr__(self):
         return f'<DicomText: {self._filename}>'
 
+    def close(self):
+        """ Release the memory-mapped file, if any, after which values
+        which were deferred by a lazy load can no longer be read.
+        Can also be done by using the object as a context manager.
+        """
+        if self._mmap:
+            self._mmap.close()
+            self._mmap = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
     def SOPInstanceUID(self):
         """ Simply returns the SOPInstanceUID from the DICOM file
         in case you need to uniquely identify this input file.
@@ -124,74 +486,218 @@ class DicomText:
         tagcode = pydicom.datadict.tag_for_keyword(tagname)
         if tagcode in self._dicom_raw:
             return self._dicom_raw[tagcode].value
-        else:
-            return ''
+        if self._lazy_tags_read and tagcode not in self._lazy_tags_read:
+            # Not read during a lazy load so read just this tag
+            dicom_tag = pydicom.dcmread(self._filename, stop_before_pixels = True, specific_tags = [tagcode])
+            if tagcode in dicom_tag:
+                return dicom_tag[tagcode].value
+        return ''
 
-    def _dataset_read_callback(self, dataset, data_element):
-        """ Internal function called during a walk of the dataset.
-        Builds a class-member string _p_text as it goes.
+    def _element_text(self, data_element):
+        """ Return the string which represents data_element in the text,
+        i.e. its value followed by a newline, or the empty string if
+        the element type is not wanted in the text.
         """
-        rc = ''
         if data_element.VR in ['SH', 'CS', 'SQ', 'UI']:
             # "SH" Short String, "CS" Code String, "SQ" Sequence, "UI" UID ignored
-            pass
-        elif data_element.VR == 'LO':
+            return ''
+        if data_element.VR == 'LO':
             # "LO" Long String typically used for headings
-            rc = rc + ('# %s' % str(data_element.value)) + '\n'
+            return ('# %s' % str(data_element.value)) + '\n'
+        return ('%s' % (str(data_element.value))) + '\n'
+
+    def _add_segment(self, path, data_element, rc):
+        """ Record the position of the string rc, the text of data_element,
+        in the segment table so that redact can find the element which
+        contains a given annotation without walking the whole dataset.
+        Offsets are relative to the text which is sent to SemEHR,
+        i.e. the TextValue followed by the ContentSequence without
+        any of the header lines or [[markers]].
+        The path is the list of tags and item numbers leading to the element.
+        Only the offset and length are kept, the text is read back from
+        the element when needed, see _segment_text.
+        Returns the text with HTML tags removed.
+        """
+        offset = self._segments[-1]['offset'] + self._segments[-1]['length'] if self._segments else 0
+        self._segments.append( { 'element': data_element, 'path': path,
+            'offset': offset, 'length': len(rc) } )
+        return self._plain_text(rc)
+
+    def _plain_text(self, rc):
+        """ Return the text rc with HTML tags replaced by spaces, if wanted.
+        """
+        return redact_html_tags_in_string(rc) if self._replace_HTML_entities else rc
+
+    def _segment_text(self, segment):
+        """ Return the text of a segment, from the value of its element.
+        """
+        return self._element_text(segment['element'])
+
+    def _segment_windows(self, crlf_to_space = True):
+        """ Yield (offset, text without HTML) for each segment, one at a time,
+        with carriage returns and newlines replaced by spaces if requested.
+        """
+        for segment in self._segments:
+            plain = self._plain_text(self._segment_text(segment))
+            yield (segment['offset'], plain.translate(_crlf_to_space) if crlf_to_space else plain)
+
+    def _walk(self, dataset, path, callback):
+        """ Same as dataset.walk(callback) but the callback is given
+        the path to the data element instead of the dataset.
+        """
+        for tag in sorted(dataset.keys()):
+            data_element = dataset[tag]
+            callback(path + [int(tag)], data_element)
+            if data_element.VR == 'SQ':
+                for ii, item in enumerate(data_element.value):
+                    self._walk(item, path + [int(tag), ii], callback)
+
+    def _dataset_read_callback(self, path, data_element):
+        """ Internal function called during a walk of the dataset.
+        Emits the text as it goes.
+        """
+        if self._stats:
+            start = time.perf_counter()
+        rc = self._element_text(data_element)
+        if rc != '':
+            plain = self._add_segment(path, data_element, rc)
+            # Replace HTML tags with spaces, but not in the headings
+            if data_element.VR != 'LO':
+                rc = plain
+            self._emit(rc)
+        if self._stats:
+            self._stats.count('VR', data_element.VR, time.perf_counter() - start)
+
+    def _emit(self, chunk):
+        """ Append a chunk to the text, or write it if streaming.
+        """
+        if self._writer:
+            self._writer.write(chunk)
         else:
-            rc = rc + ('%s' % (str(data_element.value))) + '\n'
-            # Replace HTML tags with spaces
-            if self._replace_HTML_entities:
-                rc = redact_html_tags_in_string(rc)
-        if rc == '':
-            return
-        self._offset_list.append( { 'offset':len(self._p_text), 'string': rc} )
-        self._p_text = self._p_text + rc
+            self._p_chunks.append(chunk)
 
-    def parse(self):
+    def parse(self, cache = None, writer = None, stats = None):
         """ Walk the dataset to extract the text which can then be
         returned via the text() method.
+        If a ParseCache is given then the text is taken from there
+        if this file has already been parsed, otherwise it's added.
+        If a writer (anything with a write method, eg. a file) is given
+        then the text is written to it in chunks as it is found instead
+        of being kept, so text() returns the empty string, but redact
+        can still be used.
+        If a StructuredReport.SRStats is given then the number of elements
+        of each VR and the time taken are added to it, and unexpected tags
+        are counted there instead of printing a warning (after a lazy
+        load the header is read again so that all of them are counted).
         """
-        self._p_text = ''
+        start = time.perf_counter()
+        self._stats = stats
+        if cache:
+            cache_key = cache.key(self)
+            if not self._restore_parse(cache.load(cache_key)):
+                self._parse()
+                cache.store(cache_key, self._saved_parse())
+        else:
+            self._writer = writer
+            try:
+                self._parse()
+            finally:
+                self._writer = None
+        if writer and self._p_chunks:
+            writer.writelines(self._p_chunks)
+            self._p_chunks = []
+        self._stats = None
+        if stats:
+            stats.documents += 1
+            stats.seconds += time.perf_counter() - start
+
+    def _parse(self):
+        """ Walk the dataset to extract the text, see parse.
+        """
+        self._p_chunks = []
+        self._segments = []
+        self._parsed = True
         # Start by enumerating all known desired tags (whitelist)
         #  except explicitly do not include TextValue, handled below
-        list_of_tagname_desired = [ k['tag'] for k in sr_keys_to_extract ]
         if self._include_header:
             for srkey in sr_keys_to_extract:
                 if srkey['tag'] in self._dicom_raw and srkey['tag'] != 'TextValue':
                     line = '[[%s]] %s\n' % (srkey['label'], srkey['decode_func'](str(self._dicom_raw[srkey['tag']].value)))
-                    self._p_text = self._p_text + line
+                    self._emit(line)
         # Now read ALL tags and use a blacklist (and ignore already done in whitelist).
         # Private tags will have tagname='' so ignore those too.
-        if self._include_header:
-            for drkey in self._dicom_raw:
-                tagname = pydicom.datadict.keyword_for_tag(drkey.tag)
-                if not drkey.VR == 'SQ' and not tagname in sr_keys_to_ignore and not tagname in list_of_tagname_desired and not tagname == '':
+        # Check the name before the value so that ignored values, which may be
+        # large or deferred, are never read, and don't bother if they'd be unused.
+        if self._include_header and (DicomText._include_unexpected_tags or DicomText._warn_unexpected_tag or self._stats):
+            header = self._dicom_raw
+            if self._lazy_tags_read:
+                # A lazy load skipped the unexpected tags, so read them all for the stats
+                header = pydicom.dcmread(self._filename, stop_before_pixels = True,
+                    defer_size = DicomText._lazy_defer_size)
+            for drtag in header.keys():
+                if sr_tag_policy.tag_can_be_ignored(drtag):
+                    continue
+                tagname = pydicom.datadict.keyword_for_tag(drtag)
+                drkey = header[drtag]
+                if not drkey.VR == 'SQ':
+                    if self._stats:
+                        self._stats.unexpected_key('tag', tagname, drkey.value)
                     if DicomText._include_unexpected_tags:
                         line = '[[%s]] %s\n' % (tagname, drkey.value)
-                        self._p_text = self._p_text + line
-                        if DicomText._warn_unexpected_tag:
+                        self._emit(line)
+                        if DicomText._warn_unexpected_tag and not self._stats:
                             print('Warning: including unexpected tag "%s" = "%s"' % (tagname, str(drkey.value)[0:20]))
                     else:
-                        if DicomText._warn_unexpected_tag:
+                        if DicomText._warn_unexpected_tag and not self._stats:
                             print('Warning: ignored unexpected tag "%s" = "%s"' % (tagname, str(drkey.value)[0:20]))
         # Now handle the TextValue tag
         # Wrap the text with [[Text]] and [[EndText]] for SemEHR
         if 'TextValue' in self._dicom_raw:
             textval = str(self._dicom_raw['TextValue'].value + '\n')
-            self._p_text = self._p_text + '[[Text]]\n'
-            if self._replace_HTML_entities:
-                self._p_text = self._p_text + redact_html_tags_in_string(textval)
-            else:
-                self._p_text = self._p_text + textval
-            self._p_text = self._p_text + '[[EndText]]\n'
+            self._emit('[[Text]]\n')
+            self._emit(self._add_segment([int(self._dicom_raw['TextValue'].tag)], self._dicom_raw['TextValue'], textval))
+            self._emit('[[EndText]]\n')
         # Now the text in the ContentSequence
         # Wrap the text with [[ContentSequence]] and [[EndContentSequence]] for SemEHR
         if 'ContentSequence' in self._dicom_raw:
-            self._p_text = self._p_text + '[[ContentSequence]]\n'
-            for content_sequence_item in self._dicom_raw.ContentSequence:
-                content_sequence_item.walk(self._dataset_read_callback)
-            self._p_text = self._p_text + '[[EndContentSequence]]\n'
+            self._emit('[[ContentSequence]]\n')
+            cs_tag = int(self._dicom_raw['ContentSequence'].tag)
+            for ii, content_sequence_item in enumerate(self._dicom_raw.ContentSequence):
+                self._walk(content_sequence_item, [cs_tag, ii], self._dataset_read_callback)
+            self._emit('[[EndContentSequence]]\n')
+
+    def _saved_parse(self):
+        """ Return the result of parse as a dict which can be saved
+        as JSON, with the path to each element instead of the element.
+        """
+        return { 'text': self.text(),
+            'segments': [ { k:segment[k] for k in ['path', 'offset', 'length'] } for segment in self._segments ] }
+
+    def _restore_parse(self, saved):
+        """ Restore the result of parse from the dict given by _saved_parse
+        by finding the element at each path.
+        Returns False if the dict is None or does not match this file.
+        """
+        if not saved:
+            return False
+        segments = []
+        try:
+            for segment in saved['segments']:
+                dataset = self._dicom_raw
+                path = segment['path']
+                for ii in range(0, len(path)-1, 2):
+                    dataset = dataset[path[ii]].value[path[ii+1]]
+                data_element = dataset[path[-1]]
+                if len(self._element_text(data_element)) != segment['length']:
+                    return False
+                segments.append( { 'element': data_element, 'path': path,
+                    'offset': segment['offset'], 'length': segment['length'] } )
+        except (KeyError, IndexError, TypeError):
+            return False
+        self._p_chunks = [saved['text']]
+        self._segments = segments
+        self._parsed = True
+        return True
 
     def redact_string(self, plaintext, offset, rlen, VR):
         """ Simple function to replace characters from the middle of a string.
@@ -211,86 +717,101 @@ class DicomText:
         rc = plaintext[0:offset] + redact_char.rjust(redact_length, redact_char) + plaintext[offset+rlen:]
         return rc
 
-    def _dataset_redact_callback(self, dataset, data_element):
-        """ Internal function called during a walk of the dataset during redaction.
-        Builds a class-member string _r_text as it goes.
-        Uses the annotation list in self._annotations to redact text.
+    def _redact_segment(self, segment, located, starts):
+        """ Internal function called for each segment during redaction.
+        Uses the list located of (offset, annotation, text), sorted by the
+        annotation offset translated into our text, to redact text within
+        this segment; starts is the list of those offsets so the candidate
+        annotations can be found by bisection. Only the text of this
+        segment is searched, without html and with newlines replaced by spaces.
+        Returns the redacted string.
         """
-
-        rc = ''
-        if data_element.VR in ['SH', 'CS', 'SQ', 'UI']:
-            pass
-        elif data_element.VR == 'LO':
-            rc = rc + ('# %s' % str(data_element.value)) + '\n'
-        else:
-            rc = rc + ('%s' % (str(data_element.value))) + '\n'
-        if rc == '':
-            return
-        # The current string is now len(self._r_text) ..to.. +len(rc)
-        current_start = len(self._r_text)
-        current_end   = current_start + len(rc)
+        data_element = segment['element']
+        rc = self._segment_text(segment)
+        plain = self._plain_text(rc).translate(_crlf_to_space)
+        current_start = segment['offset']
+        current_end = segment['offset'] + segment['length']
+        window = DicomText._redact_offset_window
         replacement = rc
         replacedAny = False
-        #print('At %d = %s' % (current_start, str(data_element.value)))
-        for annot in self._annotations:
-            # Sometimes it reports text:None so ignore
-            if not annot['text'] or (annot['start_char'] == annot['end_char']):
-                annot['replaced'] = True
-                continue
+        # Only annotations within twice the window can possibly match
+        # whatever the current value of _redact_offset
+        first = bisect_left(starts, current_start - 2 * window)
+        last = bisect_left(starts, current_end + 2 * window)
+        for annot_at, annot, text in located[first:last]:
             # If already replaced then ignore
             if 'replaced' in annot:
                 continue
             # Use the previously found offset to check if this annotation is within the current string
-            if ((annot['start_char'] + self._redact_offset >= current_start-32) and
-                    (annot['start_char'] + self._redact_offset < current_end+32)):
-                annot_at = annot['start_char'] - current_start
-                annot_end = annot['end_char'] - current_start
-                replaced = False
-                # SemEHR may have an extra line at the start so start_char offset need adjusting
-                for offset in [self._redact_offset] + list(range(-32, 32)):
-                    # Do the comparison using text without html but replace inside text with html
-                    rc_without_html = redact_html_tags_in_string(rc) if self._replace_HTML_entities else rc
-                    if string_match(rc_without_html[annot_at+offset : annot_end+offset], annot['text']):
-                        replacement = self.redact_string(replacement, annot_at+offset, annot_end-annot_at, data_element.VR)
-                        replaced = replacedAny = True
-                        annot['replaced'] = True
-                        #print('REPLACE: %s in %s at %d (offset %d)' % (repr(annot['text']), repr(replacement), annot_at, offset))
-                        self._redact_offset = offset
-                        break
-                # Only need to report error at the end, no need for Warning here:
-                #if not replaced:
-                #    print('WARNING: offsets slipped:')
-                #    print('  expected to find %s but found %s' % (repr(annot['text']), repr(rc[annot_at:annot_end])))
+            if ((annot_at + self._redact_offset >= current_start-window) and
+                    (annot_at + self._redact_offset < current_end+window)):
+                annot_len = annot['end_char'] - annot['start_char']
+                if len(text) != annot_len:
+                    continue
+                # Try the previously found offset first, otherwise the first
+                # match within the window, keeping within this segment.
+                # Do the comparison using text without html but replace inside text with html
+                # (offsets in plain are relative to the start of this segment)
+                found = annot_at + self._redact_offset
+                if not (found >= current_start and found + annot_len <= current_end and plain.startswith(text, found - current_start)):
+                    found = plain.find(text, max(annot_at - window, current_start) - current_start,
+                        max(min(annot_at + window - 1 + annot_len, current_end) - current_start, 0))
+                    if found >= 0:
+                        found += current_start
+                if found >= 0:
+                    replacement = self.redact_string(replacement, found - current_start, annot_len, data_element.VR)
+                    replacedAny = True
+                    annot['replaced'] = True
+                    self._redact_offset = found - annot_at
         if data_element.VR == 'PN' or data_element.VR == 'DA':
             # Always fully redact the content of PersonName and Date tags
             replacement = self.redact_string(rc, 0, len(rc), data_element.VR)
             replacedAny = True
         if replacedAny:
             data_element.value = replacement
-        self._r_text = self._r_text + rc
-        self._redacted_text = self._redacted_text + replacement
-        return replacement if replacedAny else None
+        return replacement
 
 
-    def redact(self, annot_list):
+    def redact(self, annot_list, semehr_text = None, writer = None):
         """ Redact the text in the DICOM using the annotation list
         which is a list of dicts { start_char, end_char, text }.
-        Uses the annotation list and _p_text to find and redact text
-        so parse must already have been called.
+        Uses the annotation list and the segments found by parse
+        to find and redact text so parse must already have been called.
+        The offsets in the annotations can drift from ours, eg. SemEHR
+        may have an extra line at the start, so they are first aligned
+        with our text: if semehr_text, the text which SemEHR annotated,
+        is given then by matching its lines with ours, otherwise by using
+        the annotations whose text only occurs once as anchors.
+        If a writer is given then the redacted text is written to it
+        in chunks instead of being kept for redacted_text().
         Modifies the actual state of the DICOM dataset _dicom_raw.
         Returns False if not all redactions could be done.
         """
-        assert(self._p_text) # you must have called parse first
-        self._r_text = ''    # XXX could start with '\n' to match semehr behaviour
-        self._redacted_text = ''
+        assert(self._parsed) # you must have called parse first
         self._annotations = annot_list
-        # A 'TextValue' element is not a sequence so manually call the callback
-        if 'TextValue' in self._dicom_raw:
-            self._dataset_redact_callback(None, self._dicom_raw['TextValue'])
-        # A 'ContentSequence' needs to be walked
-        if 'ContentSequence' in self._dicom_raw:
-            for content_sequence_item in self._dicom_raw.ContentSequence:
-                content_sequence_item.walk(self._dataset_redact_callback)
+        # Sometimes it reports text:None so ignore
+        for annot in self._annotations:
+            if not annot['text'] or (annot['start_char'] == annot['end_char']):
+                annot['replaced'] = True
+        annots = [annot for annot in self._annotations if 'replaced' not in annot]
+        # The text of each segment is read from its element when needed,
+        # one segment at a time, so the whole text is never held here
+        if semehr_text is not None:
+            alignment = text_alignment(semehr_text, self._segment_windows(crlf_to_space = False))
+        else:
+            alignment = annotation_alignment(annots, self._segment_windows())
+        located = sorted([ (translate_offset(alignment, annot['start_char']), annot, annot['text'].translate(_crlf_to_space))
+            for annot in annots ], key=itemgetter(0))
+        starts = [annot_at for annot_at, _, _ in located]
+        # Each segment is a 'TextValue' element or an element within the 'ContentSequence'
+        # (the redacted text could start with '\n' to match semehr behaviour)
+        self._redacted_chunks = []
+        for segment in self._segments:
+            redacted = self._redact_segment(segment, located, starts)
+            if writer:
+                writer.write(redacted)
+            else:
+                self._redacted_chunks.append(redacted)
         rc = True
         # Now check that all annotations were redacted, return False if not
         for annot in self._annotations:
@@ -308,34 +829,232 @@ class DicomText:
     def text(self):
         """ Returns the text after parse() has been called.
         """
-        return self._p_text
+        if len(self._p_chunks) > 1:
+            self._p_chunks = [''.join(self._p_chunks)]
+        return self._p_chunks[0] if self._p_chunks else ''
 
     def redacted_text(self):
         """ Returns the redacted text after redact() has been called.
         """
-        return self._redacted_text
+        if len(self._redacted_chunks) > 1:
+            self._redacted_chunks = [''.join(self._redacted_chunks)]
+        return self._redacted_chunks[0] if self._redacted_chunks else ''
+
+    def text_elements(self):
+        """ Yield (keyword, offset, value) for each text element found by
+        parse, where value is the element's text without HTML and offset
+        is its position in the text used by redact, so that annotations
+        found in the value can be redacted after adding the offset.
+        """
+        for segment in self._segments:
+            prefix = 2 if segment['element'].VR == 'LO' else 0 # '# '
+            yield (segment['element'].keyword, segment['offset'] + prefix,
+                self._plain_text(self._segment_text(segment))[prefix:-1])
+
+    def _copy_text_into(self, dicom_dest):
+        """ Copy the (redacted) text elements into another dataset.
+        """
+        if 'TextValue' in self._dicom_raw:
+            dicom_dest.TextValue = self._dicom_raw.TextValue
+        if 'ContentSequence' in self._dicom_raw:
+            dicom_dest.ContentSequence = self._dicom_raw.ContentSequence
 
     def write(self, newfile):
         """ Save the (redacted) DICOM as a new file.
+        If lazily loaded then the rest of the original file is read
+        because only part of it is held in memory.
         """
-        self._dicom_raw.save_as(newfile)
+        if self._lazy:
+            dicom_full = pydicom.dcmread(self._filename)
+            self._copy_text_into(dicom_full)
+            dicom_full.save_as(newfile)
+        else:
+            self._dicom_raw.save_as(newfile)
 
     def write_redacted_text_into_dicom_file(self, destfile):
         """ Open the specified file (must exist) and copy our redacted
         text into that file. The intention is that the redacted text
         from DICOM file A can be inserted into an already-anonymised
         DICOM file B.
+        If the redacted values are the same length as those already in
+        the file then they are overwritten in place, otherwise the
+        whole file is rewritten.
+        """
+        if DicomText._patch_in_place and self._patch_redacted_text_into_dicom_file(destfile):
+            return
+        self._rewrite_redacted_text_into_dicom_file(destfile)
+
+    def verify_redacted_dicom_file(self, destfile):
+        """ Check that none of the annotated text remains anywhere in
+        destfile, eg. after write_redacted_text_into_dicom_file.
+        Returns a dict { filename, annotations, not_found, leaks } where
+        not_found is the text of the annotations which redact could not
+        find and leaks is the list returned by redaction_leaks.
+        """
+        dataset = pydicom.dcmread(destfile, stop_before_pixels = True)
+        return { 'filename': destfile, 'annotations': len(self._annotations),
+            'not_found': [annot['text'] for annot in self._annotations if not annot.get('replaced')],
+            'leaks': redaction_leaks(dataset, self._annotations) }
+
+    def _rewrite_redacted_text_into_dicom_file(self, destfile):
+        """ Read the whole of destfile, copy our redacted text into it,
+        and write the whole file.
         """
         dicom_dest = pydicom.dcmread(destfile)
-        if 'TextValue' in self._dicom_raw:
-            dicom_dest.TextValue = self._dicom_raw.TextValue
-        if 'ContentSequence' in self._dicom_raw:
-            dicom_dest.ContentSequence = self._dicom_raw.ContentSequence
+        self._copy_text_into(dicom_dest)
         # Redact names and dates in case CTP didn't do it
         dicom_dest.walk(self.redact_PN_DA_callback)
         # Save the modified file
         dicom_dest.save_as(destfile)
 
+    def _patch_redacted_text_into_dicom_file(self, destfile):
+        """ Make the same changes to destfile as the rewrite above would
+        but only overwrite the bytes of the values which have changed.
+        Only possible if the transfer syntax is uncompressed little endian,
+        the structure of the text is the same in both files, and the
+        encoded length of every changed value is the same as the original.
+        Returns True if done, False if the file must be rewritten instead.
+        """
+        dicom_dest = pydicom.dcmread(destfile, stop_before_pixels = True)
+        if dicom_dest.file_meta.get('TransferSyntaxUID') not in [pydicom.uid.ImplicitVRLittleEndian, pydicom.uid.ExplicitVRLittleEndian]:
+            return False
+        raw_values = {}
+        _dataset_raw_values(dicom_dest, (), raw_values)
+        # Make the changes in memory
+        text_tags = [tag for tag in ['TextValue', 'ContentSequence'] if tag in self._dicom_raw]
+        text_tags = [pydicom.datadict.tag_for_keyword(tag) for tag in text_tags]
+        self._copy_text_into(dicom_dest)
+        dicom_dest.walk(self.redact_PN_DA_callback)
+        changed_values = {}
+        encodings = pydicom.charset.convert_encodings(dicom_dest.get('SpecificCharacterSet', None))
+        _dataset_changed_values(dicom_dest, (), text_tags, encodings, changed_values)
+        # Find the new values which differ, giving up if any cannot be patched
+        patches = []
+        for path, value in changed_values.items():
+            if path not in raw_values:
+                if value is None:
+                    continue # a sequence
+                return False
+            value_tell, raw_value = raw_values[path]
+            if value == raw_value:
+                continue
+            if value_tell is None or len(value) != len(raw_value):
+                return False
+            patches.append( (value_tell, raw_value, value) )
+        # Also give up if the original has text elements which the new does not
+        for path in raw_values:
+            if path[0] in text_tags and path not in changed_values:
+                return False
+        if not patches:
+            return True
+        with open(destfile, 'r+b') as fd:
+            with mmap.mmap(fd.fileno(), 0) as mm:
+                # Check every offset before changing anything
+                for value_tell, raw_value, value in patches:
+                    if mm[value_tell : value_tell + len(raw_value)] != raw_value:
+                        return False
+                for value_tell, raw_value, value in patches:
+                    mm[value_tell : value_tell + len(value)] = value
+                mm.flush()
+        return True
+
+# ---------------------------------------------------------------------
+
+class ParseCache:
+    """ An on-disk cache of the results of DicomText.parse so that
+    separate programs, eg. CTP_DicomToText then CTP_XMLToDicom,
+    or repeated runs, don't have to parse the same file again.
+    Each entry is a JSON file named by a hash of the DICOM file path,
+    size, modification time and SOPInstanceUID plus the parse options.
+    When the total size exceeds max_bytes the least recently used
+    entries are removed. The total is kept in memory between scans of the
+    directory so entries stored by other processes are only counted at
+    the next scan, when this process's total exceeds max_bytes.
+    The entries hold the unredacted text, i.e. PHI, so a new directory is
+    created readable only by its owner, and should be removed after use.
+    Typical usage:
+    cache = ParseCache('/tmp/cache')
+    dicomtext.parse(cache)
+    """
+    _version = 2                 # change if the format of an entry changes
+    _max_bytes = 64*1024*1024    # total size of all entries
+
+    def __init__(self, cache_dir, max_bytes = _max_bytes):
+        self._cache_dir = cache_dir
+        self._max_bytes = max_bytes
+        self._total = None # total size of entries, None until scanned
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, mode = 0o700, exist_ok = True)
+
+    def key(self, dicomtext):
+        """ Return the key for the entry for the given DicomText
+        """
+        stat = os.stat(dicomtext._filename)
+        key_str = '%d|%s|%d|%d|%s|%s|%s|%s' % (ParseCache._version,
+            os.path.abspath(dicomtext._filename), stat.st_size, stat.st_mtime_ns,
+            dicomtext.SOPInstanceUID(), dicomtext._include_header,
+            dicomtext._replace_HTML_entities, DicomText._include_unexpected_tags)
+        return hashlib.sha1(key_str.encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self._cache_dir, key + '.json')
+
+    def load(self, key):
+        """ Return the dict stored with the given key, or None.
+        """
+        try:
+            with open(self._path(key)) as fd:
+                saved = json.load(fd)
+            os.utime(self._path(key)) # it's now the most recently used
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return saved
+
+    def store(self, key, saved):
+        """ Store the dict with the given key, removing old entries
+        if the cache is too big.
+        Writes to a temporary file then renames it so that other processes
+        never read a partial file.
+        """
+        tmpname = '%s.%d.tmp' % (self._path(key), os.getpid())
+        saved_str = json.dumps(saved) # ASCII so the length is the size
+        with open(tmpname, 'w') as fd:
+            fd.write(saved_str)
+        os.replace(tmpname, self._path(key))
+        # Only scan the directory when it may have become too big
+        if self._total is None or self._total + len(saved_str) > self._max_bytes:
+            self._evict()
+        else:
+            self._total += len(saved_str)
+
+    def _evict(self):
+        """ Remove the least recently used entries until the total
+        size is within the limit, and remember the new total.
+        """
+        entries = []
+        total = 0
+        for entry in os.scandir(self._cache_dir):
+            if entry.name.endswith('.json'):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue # removed by another process
+                entries.append( (stat.st_mtime, stat.st_size, entry.path) )
+                total += stat.st_size
+        for mtime, size, path in sorted(entries):
+            if total <= self._max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+        self._total = total
+
+
 def test_DicomText():
     """ The test function requires a specially-crafted DICOM file
     as provided with SRAnonTool that has been modified to include HTML.
@@ -421,3 +1140,214 @@ Internal derangement of the right knee with marked injury and with partial tear
     dt = DicomText(dcm, include_header = False, replace_HTML_entities = False)
     dt.parse()
     assert(dt.text() == expected_without_header_with_html)
+
+def test_DicomText_redact():
+    """ Redact using annotations found in the text which SemEHR would see,
+    i.e. the ContentSequence without the [[markers]], with offsets which
+    have slipped by a few characters as sometimes happens with SemEHR.
+    """
+    dcm = os.path.join(os.path.dirname(__file__), '../../../applications/SRAnonTool/test/report10html.dcm')
+    dt = DicomText(dcm, include_header = False)
+    dt.parse()
+    semehr_text = dt.text().replace('[[ContentSequence]]\n', '').replace('[[EndContentSequence]]\n', '')
+    annots = [ { 'start_char': m.start()+3, 'end_char': m.end()+3, 'text': 'Baker' } for m in re.finditer('Baker', semehr_text) ]
+    annots.append( { 'start_char': 10, 'end_char': 10, 'text': None } )
+    assert(len(annots) == 4)
+    assert(dt.redact(annots))
+    assert('Baker' not in dt.redacted_text())
+    assert(dt.redacted_text().count('XXXXX') == 3)
+    assert(len(dt.redacted_text()) == len(semehr_text))
+    # An annotation which is not in the document is reported
+    dt = DicomText(dcm, include_header = False)
+    dt.parse()
+    assert(not dt.redact( [ { 'start_char': 10, 'end_char': 17, 'text': 'missing' } ] ))
+
+def test_DicomText_redact_aligned():
+    """ Redact using annotations whose offsets have drifted by more than
+    the window, eg. because SemEHR saw the header lines too.
+    """
+    dcm = os.path.join(os.path.dirname(__file__), '../../../applications/SRAnonTool/test/report10html.dcm')
+    dt = DicomText(dcm)
+    dt.parse()
+    semehr_text = dt.text()
+    # Baker is not unique so only aligned by using the text SemEHR saw
+    annots = [ { 'start_char': m.start(), 'end_char': m.end(), 'text': 'Baker' } for m in re.finditer('Baker', semehr_text) ]
+    assert(dt.redact(annots, semehr_text = semehr_text))
+    assert(dt.redacted_text().count('XXXXX') == 3)
+    # A unique annotation anchors the others
+    dt = DicomText(dcm)
+    dt.parse()
+    annots = [ { 'start_char': m.start(), 'end_char': m.end(), 'text': m.group(0) } for m in re.finditer('Baker|suprapatellar', semehr_text) ]
+    assert(dt.redact(annots))
+    assert('Baker' not in dt.redacted_text())
+    assert('suprapatellar' not in dt.redacted_text())
+
+def test_DicomText_lazy():
+    """ Lazy loading, with or without memory-mapping, must give the same text
+    """
+    dcm = os.path.join(os.path.dirname(__file__), '../../../applications/SRAnonTool/test/report10html.dcm')
+    dt = DicomText(dcm)
+    dt.parse()
+    for memory_map in [False, True]:
+        dt_lazy = DicomText(dcm, lazy = True, memory_map = memory_map)
+        assert('InstanceCreatorUID' not in dt_lazy._dicom_raw)
+        dt_lazy.parse()
+        assert(dt_lazy.text() == dt.text())
+        assert(dt_lazy.SOPInstanceUID() == dt.SOPInstanceUID())
+        # A tag which was not read is read when requested
+        assert(dt_lazy.tag('InstanceCreatorUID') == '1.2.276.0.7230010.3.0.3.5.3')
+        assert(dt_lazy.tag('Manufacturer') == '')
+        assert(dt_lazy.tag('PatientID') == 'PIKR752962')
+        dt_lazy.close()
+    # The memory map is closed at the end of a with block
+    with DicomText(dcm, lazy = True, memory_map = True) as dt_lazy:
+        dt_lazy.parse()
+        assert(dt_lazy._mmap is not None)
+    assert(dt_lazy._mmap is None)
+
+def test_DicomText_stream():
+    """ Streaming the text to a writer must give the same text
+    """
+    import io
+    dcm = os.path.join(os.path.dirname(__file__), '../../../applications/SRAnonTool/test/report10html.dcm')
+    dt = DicomText(dcm)
+    dt.parse()
+    annots = [ { 'start_char': m.start(), 'end_char': m.end(), 'text': 'Baker' } for m in re.finditer('Baker', dt.text()) ]
+    assert(dt.redact(copy.deepcopy(annots), semehr_text = dt.text()))
+    dt_stream = DicomText(dcm)
+    fd = io.StringIO()
+    dt_stream.parse(writer = fd)
+    assert(fd.getvalue() == dt.text())
+    assert(dt_stream.text() == '')
+    fd = io.StringIO()
+    assert(dt_stream.redact(copy.deepcopy(annots), semehr_text = dt.text(), writer = fd))
+    assert(fd.getvalue() == dt.redacted_text())
+    assert(dt_stream.redacted_text() == '')
+
+def test_DicomText_stats():
+    """ Collecting statistics must not change the text
+    """
+    from SmiServices.StructuredReport import SRStats
+    dcm = os.path.join(os.path.dirname(__file__), '../../../applications/SRAnonTool/test/report10html.dcm')
+    dt = DicomText(dcm)
+    dt.parse()
+    stats = SRStats()
+    dt_stats = DicomText(dcm)
+    dt_stats.parse(stats = stats)
+    assert(dt_stats.text() == dt.text())
+    assert(stats.documents == 1)
+    assert(stats.counters['VR']['UT']['count'] > 0)
+    assert(stats.counters['VR']['SQ']['count'] > 0)
+    # A lazy load, which skips unexpected tags, must still count them
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmpdir:
+        ds = pydicom.dcmread(dcm)
+        ds.TimezoneOffsetFromUTC = '+0000'
+        dcm_tz = os.path.join(tmpdir, 'tz.dcm')
+        ds.save_as(dcm_tz)
+        stats, stats_lazy = SRStats(), SRStats()
+        DicomText(dcm_tz).parse(stats = stats)
+        with DicomText(dcm_tz, lazy = True) as dt_lazy:
+            dt_lazy.parse(stats = stats_lazy)
+    assert(stats.unexpected['tag']['TimezoneOffsetFromUTC']['count'] == 1)
+    assert(stats_lazy.unexpected == stats.unexpected)
+
+def test_DicomText_write_in_place():
+    """ Redacted text which is the same length is patched into the file
+    giving the same result as rewriting the whole file.
+    """
+    import shutil, tempfile
+    dcm = os.path.join(os.path.dirname(__file__), '../../../applications/SRAnonTool/test/report10html.dcm')
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # Dates and names must be non-empty otherwise redacting them changes their length
+        src = os.path.join(tmpdir, 'src.dcm')
+        dicom_src = pydicom.dcmread(dcm)
+        dicom_src.StudyDate = '20050530'
+        dicom_src.ReferringPhysicianName = 'Doctor^Who'
+        dicom_src.save_as(src)
+        dt = DicomText(src, include_header = False)
+        dt.parse()
+        semehr_text = dt.text().replace('[[ContentSequence]]\n', '').replace('[[EndContentSequence]]\n', '')
+        assert(dt.redact([ { 'start_char': m.start(), 'end_char': m.end(), 'text': 'Baker' } for m in re.finditer('Baker', semehr_text) ]))
+        patched = os.path.join(tmpdir, 'patched.dcm')
+        rewritten = os.path.join(tmpdir, 'rewritten.dcm')
+        shutil.copy(src, patched)
+        shutil.copy(src, rewritten)
+        assert(dt._patch_redacted_text_into_dicom_file(patched))
+        dt._rewrite_redacted_text_into_dicom_file(rewritten)
+        assert(os.path.getsize(patched) == os.path.getsize(src))
+        assert(pydicom.dcmread(patched) == pydicom.dcmread(rewritten))
+        assert(b'Baker' not in open(patched, 'rb').read())
+        # Names inside other sequences are keyed by their full path, not just their tag
+        dicom_src.PatientName = 'Smith^John'
+        other_patient = pydicom.Dataset()
+        other_patient.PatientName = 'Jones^Fred'
+        dicom_src.OtherPatientIDsSequence = pydicom.Sequence([other_patient])
+        dicom_src.save_as(src)
+        shutil.copy(src, patched)
+        shutil.copy(src, rewritten)
+        assert(dt._patch_redacted_text_into_dicom_file(patched))
+        dt._rewrite_redacted_text_into_dicom_file(rewritten)
+        assert(pydicom.dcmread(patched) == pydicom.dcmread(rewritten))
+        assert(b'Jones^Fred' not in open(patched, 'rb').read())
+        assert(b'Smith^John' not in open(patched, 'rb').read())
+        # Empty dates become 19000101 so the file must be rewritten
+        dt = DicomText(dcm)
+        dt.parse()
+        dt.redact([])
+        shutil.copy(dcm, rewritten)
+        assert(not dt._patch_redacted_text_into_dicom_file(rewritten))
+
+def test_redaction_leaks():
+    """ Annotations which were not redacted are found in the output file
+    """
+    import shutil, tempfile
+    dcm = os.path.join(os.path.dirname(__file__), '../../../applications/SRAnonTool/test/report10html.dcm')
+    with tempfile.TemporaryDirectory() as tmpdir:
+        dest = os.path.join(tmpdir, 'redacted.dcm')
+        shutil.copy(dcm, dest)
+        dt = DicomText(dcm)
+        dt.parse()
+        annots = [ { 'start_char': m.start(), 'end_char': m.end(), 'text': m.group(0) } for m in re.finditer('Baker|Walz|XXX', dt.text()) ]
+        # Leave out the last Baker, the name in the header is redacted anyway
+        assert(dt.redact(annots[1:3], semehr_text = dt.text()))
+        dt.write_redacted_text_into_dicom_file(dest)
+        dt._annotations = annots
+        report = dt.verify_redacted_dicom_file(dest)
+        assert(report['not_found'] == ['Walz', 'Baker'])
+        assert([ (leak['element'], leak['text']) for leak in report['leaks'] ] ==
+            [ ('ContentSequence[2].ContentSequence[2].TextValue', 'Baker') ])
+        assert(redaction_leaks(pydicom.dcmread(dcm), [ { 'text': 'XXXXX' }, { 'text': None } ]) == [])
+
+def test_ParseCache():
+    """ A second parse of the same file is taken from the cache
+    and can be redacted just the same.
+    """
+    import tempfile
+    dcm = os.path.join(os.path.dirname(__file__), '../../../applications/SRAnonTool/test/report10html.dcm')
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cache = ParseCache(tmpdir)
+        dt = DicomText(dcm)
+        dt.parse(cache)
+        assert(cache.misses == 1 and cache.hits == 0)
+        dt_cached = DicomText(dcm, lazy = True)
+        dt_cached.parse(cache)
+        assert(cache.hits == 1)
+        assert(dt_cached.text() == dt.text())
+        annots = [ { 'start_char': 722, 'end_char': 727, 'text': 'Baker' } ]
+        assert(dt.redact(annots))
+        annots = [ { 'start_char': 722, 'end_char': 727, 'text': 'Baker' } ]
+        assert(dt_cached.redact(annots))
+        assert(dt_cached.redacted_text() == dt.redacted_text())
+        # Different options need a different entry
+        DicomText(dcm, include_header = False).parse(cache)
+        assert(cache.misses == 2)
+        # The total is kept without scanning the directory each time
+        assert(cache._total == sum(entry.stat().st_size for entry in os.scandir(tmpdir)))
+        # Entries are removed when the cache is too big
+        cache = ParseCache(tmpdir, max_bytes = 1)
+        DicomText(dcm, replace_HTML_entities = False).parse(cache)
+        assert(len(os.listdir(tmpdir)) == 0)
+        # A new directory is only readable by its owner as the text is not redacted
+        ParseCache(os.path.join(tmpdir, 'private'))
+        assert(os.stat(os.path.join(tmpdir, 'private')).st_mode & 0o077 == 0)
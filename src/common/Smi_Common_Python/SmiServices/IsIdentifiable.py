@@ -0,0 +1,296 @@
+""" Apply the rules used by the IsIdentifiable service, as found in
+data/IsIdentifiableRules/*.yaml, to the text in DICOM files, giving
+annotations in the same format as Knowtator.annotation_xml_to_dict
+so that the text can be redacted without waiting for SemEHR.
+"""
+
+import glob
+import os
+import re
+import sys
+import yaml
+
+
+# ---------------------------------------------------------------------
+# Aho-Corasick automaton to find all occurrences of many literal words
+# in a single pass over a string, eg. a deny-list of surnames.
+# Matching ignores case, unless requested, and only whole words are reported.
+
+class AhoCorasick:
+    """ Build with a dict of { word: value } then call finditer(text)
+    to get (start, end, value) for every whole-word occurrence
+    (or every occurrence if not whole_words).
+    """
+    def __init__(self, words = None, ignore_case = True, whole_words = True):
+        self._ignore_case = ignore_case
+        self._whole_words = whole_words
+        self._goto = [{}]     # transitions from each state
+        self._fail = [0]      # longest proper suffix which is also a state
+        self._words = [[]]    # (length, value) of the words ending at each state
+        self._out = [[]]      # and of the words which are suffixes of those
+        self._built = True
+        for word, value in (words or {}).items():
+            self.add(word, value)
+
+    def add(self, word, value):
+        """ Add a word, after which the automaton is rebuilt when next used.
+        """
+        state = 0
+        # Lower-case each character separately so that the number of
+        # states passed through is the number of characters in the text
+        for ch in word:
+            if self._ignore_case:
+                ch = ch.lower()
+            if ch not in self._goto[state]:
+                self._goto.append({})
+                self._fail.append(0)
+                self._words.append([])
+                self._goto[state][ch] = len(self._goto) - 1
+            state = self._goto[state][ch]
+        if word:
+            self._words[state].append((len(word), value))
+            self._built = False
+
+    def _build(self):
+        """ Compute the failure links breadth-first.
+        """
+        self._out = [list(words) for words in self._words]
+        queue = list(self._goto[0].values())
+        for state in queue:
+            self._fail[state] = 0
+        for state in queue:
+            for ch, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(ch, 0)
+                self._out[next_state] = self._out[next_state] + self._out[self._fail[next_state]]
+        self._built = True
+
+    def __len__(self):
+        return len(self._goto) - 1
+
+    def finditer(self, text):
+        """ Yield (start, end, value) for each whole word found in text,
+        or for each occurrence, including overlapping ones, if not whole_words.
+        """
+        if not self._built:
+            self._build()
+        goto = self._goto
+        fail = self._fail
+        whole_words = self._whole_words
+        state = 0
+        for ii, ch in enumerate(map(str.lower, text) if self._ignore_case else text):
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            for length, value in self._out[state]:
+                start = ii + 1 - length
+                if not whole_words or ((start == 0 or not text[start-1].isalnum()) and (ii+1 == len(text) or not text[ii+1].isalnum())):
+                    yield (start, ii + 1, value)
+
+
+def test_AhoCorasick():
+    ac = AhoCorasick({ 'Baker': 'Person', 'he': 'Pronoun', 'she': 'Pronoun', 'hers': 'Pronoun' })
+    assert(list(ac.finditer('ushers')) == [])
+    assert(list(ac.finditer('she said hers was BAKER\'s')) == [(0, 3, 'Pronoun'), (9, 13, 'Pronoun'), (18, 23, 'Person')])
+    assert(list(AhoCorasick().finditer('anything')) == [])
+    assert(list(AhoCorasick({ 'Baker': 1 }, ignore_case = False).finditer('BAKER Baker')) == [(6, 11, 1)])
+    assert(list(AhoCorasick({ 'he': 1, 'she': 2, 'hers': 3 }, whole_words = False).finditer('ushers')) == [(1, 4, 2), (2, 4, 1), (2, 6, 3)])
+
+
+# ---------------------------------------------------------------------
+# The rules. Each file has BasicRules, SocketRules and WhiteListRules;
+# BasicRules are applied in order to a value in a column (i.e. a tag)
+# and the first one whose IfColumn and IfPattern match decides whether
+# to Ignore the value or to Report the matching parts As a classification.
+# WhiteListRules then remove any reported part which matches IfPartPattern.
+# SocketRules connect to a Named Entity Recogniser which is not used here,
+# but a deny-list of words can be given instead.
+
+class IsIdentifiableRules:
+    """ Load the rules from the yaml files in rules_dir, or a list of files,
+    then call annotations(dicomtext) to find text which is identifiable.
+    The rules which apply to each column are compiled, when first needed,
+    into one regex for each run of Ignore rules, and one for each Report
+    rule because only the matches of the first Report rule which matches
+    are reported, as IsIdentifiable does.
+    """
+    _deny_classification = 'Person' # classification of words in a deny-list
+
+    def __init__(self, rules_dir = None, filenames = None):
+        self._basic_rules = []
+        self._whitelist_rules = []
+        self._columns = {}    # compiled rules for each column
+        self._deny = AhoCorasick()
+        if rules_dir:
+            filenames = sorted(glob.glob(os.path.join(rules_dir, '*.yaml'))) + (filenames or [])
+        for filename in filenames or []:
+            self.load(filename)
+
+    def load(self, filename):
+        """ Add the rules from a yaml file.
+        """
+        with open(filename, encoding = 'utf-8-sig') as fd:
+            rules = yaml.safe_load(fd) or {}
+        self._basic_rules += [rule for rule in rules.get('BasicRules') or [] if self._valid(rule, filename)]
+        self._whitelist_rules += [rule for rule in rules.get('WhiteListRules') or [] if self._valid(rule, filename)]
+        self._columns = {}
+
+    def add_deny_list(self, words, classification = _deny_classification):
+        """ Add a list of words, eg. surnames, which are always reported
+        (unless ignored by the rules) wherever they occur in a value.
+        """
+        for word in words:
+            self._deny.add(word, classification)
+
+    def _valid(self, rule, filename):
+        """ Check that the patterns in a rule can be compiled by Python
+        (they are written for .NET), otherwise report and ignore the rule.
+        """
+        for key in ['IfPattern', 'IfPartPattern']:
+            if key in rule:
+                try:
+                    re.compile(rule[key])
+                except re.error as e:
+                    print('WARNING: ignoring rule in %s with %s "%s" (%s)' % (filename, key, rule[key], e), file=sys.stderr)
+                    return False
+        return True
+
+    # A numbered backreference would refer to the wrong group once merged
+    _backreference_re = re.compile(r'\\[1-9]')
+
+    def _compiled_run(self, action, flags, patterns, classifications):
+        """ Return a list of (action, regex, list of classifications) for a
+        run of rules, merged into one regex if possible, where the regex has
+        a group named rN for the Nth rule, otherwise one regex for each rule,
+        eg. if a pattern has a global flag such as (?i) which is only
+        allowed at the start of a regex.
+        """
+        if len(patterns) > 1 and not any(self._backreference_re.search(p) for p in patterns):
+            try:
+                return [ (action, re.compile('|'.join('(?P<r%d>%s)' % (ii, pattern)
+                    for ii, pattern in enumerate(patterns)), flags), classifications) ]
+            except re.error:
+                pass
+        return [ (action, re.compile(pattern, flags), [classification])
+            for pattern, classification in zip(patterns, classifications) ]
+
+    def _compiled(self, column):
+        """ Return the rules for column as a tuple of
+        (list of runs of basic rules, list of whitelist rules)
+        where each run is (action, regex, list of classifications),
+        see _compiled_run, and only Ignore rules are merged into runs,
+        and each whitelist rule is (part regex, value regex, classification).
+        """
+        if column in self._columns:
+            return self._columns[column]
+        runs = []
+        key = None
+        for rule in self._basic_rules:
+            if rule.get('IfColumn', column) != column:
+                continue
+            # A rule without a pattern applies to the whole value
+            pattern = rule.get('IfPattern', '(?s:.*)')
+            flags = 0 if rule.get('CaseSensitive') else re.IGNORECASE
+            if key != (rule['Action'], flags) or rule['Action'] != 'Ignore':
+                key = (rule['Action'], flags)
+                runs.append( (rule['Action'], flags, [], []) )
+            runs[-1][2].append(pattern)
+            runs[-1][3].append(rule.get('As'))
+        runs = [ compiled for run in runs for compiled in self._compiled_run(*run) ]
+        whitelist = []
+        for rule in self._whitelist_rules:
+            if rule.get('IfColumn', column) != column:
+                continue
+            flags = 0 if rule.get('CaseSensitive') else re.IGNORECASE
+            whitelist.append( (re.compile(rule['IfPartPattern'], flags) if 'IfPartPattern' in rule else None,
+                re.compile(rule['IfPattern'], flags) if 'IfPattern' in rule else None,
+                rule.get('As')) )
+        self._columns[column] = (runs, whitelist)
+        return self._columns[column]
+
+    def classify(self, column, value):
+        """ Apply the rules to the value of a column (the keyword of a tag).
+        Returns a list of (start, end, classification) for each part of
+        the value which should be reported, empty if none or ignored.
+        Words in the deny-list are reported as well as the matches of
+        the first Report rule, unless an Ignore rule matched first.
+        """
+        runs, whitelist = self._compiled(column)
+        failures = []
+        for action, regex, classifications in runs:
+            if action == 'Ignore':
+                if regex.search(value):
+                    return []
+            elif action == 'Report':
+                failures = [ (m.start(), m.end(), classifications[int(m.lastgroup[1:]) if len(classifications) > 1 else 0])
+                    for m in regex.finditer(value) if m.end() > m.start() ]
+                if failures:
+                    break
+        failures = sorted(failures + list(self._deny.finditer(value)))
+        return [ (start, end, classification) for start, end, classification in failures
+            if not any( (part_re is None or part_re.search(value[start:end])) and
+                (value_re is None or value_re.search(value)) and
+                (wl_class is None or wl_class == classification)
+                for part_re, value_re, wl_class in whitelist ) ]
+
+    def annotations(self, dicomtext):
+        """ Apply the rules to the text elements of a DicomText which must
+        already have been parsed. Returns a list of dicts
+        { start_char, end_char, text, As } which can be given to redact.
+        """
+        annots = []
+        for keyword, offset, value in dicomtext.text_elements():
+            for start, end, classification in self.classify(keyword, value):
+                annots.append( { 'start_char': offset + start, 'end_char': offset + end,
+                    'text': value[start:end], 'As': classification } )
+        return annots
+
+
+def test_IsIdentifiableRules():
+    rules_dir = os.path.join(os.path.dirname(__file__), '../../../../data/IsIdentifiableRules')
+    rules = IsIdentifiableRules(rules_dir)
+    # Rules without IfColumn apply to all columns
+    assert(rules.classify('TextValue', '0123456789ABCDEF0123456789ABCDEF') == [])
+    # Rules from SurnameFirstnameTitle.yaml
+    assert(rules.classify('ProtocolName', 'SMITHJOHNMR1') == [(0, 12, 'Person')])
+    assert(rules.classify('ProtocolName', 'smithjohnmr1') == [])
+    # Words in the deny-list are reported unless whitelisted
+    rules.add_deny_list(['Baker', 'Topogram'])
+    assert(rules.classify('TextValue', 'There is a Baker\'s cyst') == [(11, 16, 'Person')])
+    assert(rules.classify('TextValue', 'Topogram') == [])
+    # Only the matches of the first Report rule which matches are reported
+    rules = IsIdentifiableRules()
+    rules._basic_rules = [ { 'Action': 'Report', 'IfPattern': 'abc', 'As': 'First' },
+        { 'Action': 'Report', 'IfPattern': 'xab|def', 'As': 'Second' } ]
+    assert(rules.classify('TextValue', 'xabc def') == [(1, 4, 'First')])
+    assert(rules.classify('TextValue', 'xab def') == [(0, 3, 'Second'), (4, 7, 'Second')])
+    # Words in the deny-list are reported as well as those of a Report rule
+    rules_deny = IsIdentifiableRules()
+    rules_deny._basic_rules = [ { 'Action': 'Report', 'IfPattern': r'\b\d{10}\b', 'As': 'CHI' } ]
+    rules_deny.add_deny_list(['Baker'])
+    assert(rules_deny.classify('TextValue', 'Mr Baker CHI 0101011234') == [(3, 8, 'Person'), (13, 23, 'CHI')])
+    # Ignore rules with global flags or backreferences are not merged
+    rules._basic_rules = [ { 'Action': 'Ignore', 'IfPattern': '(?i)^ok$', 'CaseSensitive': True },
+        { 'Action': 'Ignore', 'IfPattern': r'^(a)\1$', 'CaseSensitive': True },
+        { 'Action': 'Report', 'IfPattern': '.+', 'As': 'Any' } ]
+    rules._columns = {}
+    assert(len(rules._compiled('TextValue')[0]) == 3)
+    assert(rules.classify('TextValue', 'OK') == [])
+    assert(rules.classify('TextValue', 'aa') == [])
+    assert(rules.classify('TextValue', 'ab') == [(0, 2, 'Any')])
+    # No rules, nothing reported
+    rules = IsIdentifiableRules()
+    assert(rules.classify('ProtocolName', 'SMITHJOHNMR1') == [])
+    # Annotations found in a DicomText can be redacted
+    from SmiServices.DicomText import DicomText
+    dcm = os.path.join(os.path.dirname(__file__), '../../../applications/SRAnonTool/test/report10html.dcm')
+    dt = DicomText(dcm)
+    dt.parse()
+    rules.add_deny_list(['Baker', 'basketball'])
+    annots = rules.annotations(dt)
+    assert([annot['text'] for annot in annots] == ['basketball', 'Baker', 'Baker', 'Baker'])
+    assert(dt.redact(annots))
+    assert('Baker' not in dt.redacted_text() and 'basketball' not in dt.redacted_text())
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+#
+# Logging from a pool of worker processes. The processes cannot safely
+# share a RotatingFileHandler so the workers send their log records
+# through a queue to the parent process, whose handlers write them:
+#   queue, listener = Logger.start_queue_listener()
+#   try:
+#       with multiprocessing.Pool(jobs, initializer = Logger.init_worker_logging,
+#               initargs = (queue, logging.getLogger().level)) as pool:
+#           ...
+#   finally:
+#       listener.stop()
+
+import logging, logging.handlers
+import multiprocessing
+
+
+def start_queue_listener():
+    """ Return (queue, listener) where the listener, which has been started,
+    passes the records from the queue to the handlers of the root logger.
+    Call listener.stop() when the workers have finished.
+    """
+    queue = multiprocessing.Queue()
+    listener = logging.handlers.QueueListener(queue, *logging.getLogger().handlers, respect_handler_level = True)
+    listener.start()
+    return queue, listener
+
+
+def init_worker_logging(queue, level):
+    """ Pool initializer which sends the log records of a worker process
+    through the queue to the parent process instead of to the handlers
+    inherited from the parent.
+    """
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(queue))
+    root.setLevel(level)
+
+
+def _log_in_worker(message):
+    logging.getLogger().warning(message)
+
+
+def test_init_worker_logging():
+    class ListHandler(logging.Handler):
+        def __init__(self):
+            super().__init__()
+            self.messages = []
+        def emit(self, record):
+            self.messages.append(record.getMessage())
+    root = logging.getLogger()
+    handler = ListHandler()
+    root.addHandler(handler)
+    try:
+        queue, listener = start_queue_listener()
+        try:
+            with multiprocessing.Pool(2, initializer = init_worker_logging,
+                    initargs = (queue, logging.WARNING)) as pool:
+                pool.map(_log_in_worker, ['one', 'two'])
+        finally:
+            listener.stop()
+    finally:
+        root.removeHandler(handler)
+    assert(sorted(handler.messages) == ['one', 'two'])
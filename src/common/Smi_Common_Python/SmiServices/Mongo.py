@@ -1,6 +1,9 @@
-from pymongo import MongoClient
+from pymongo import MongoClient, ASCENDING
 import re
 
+# Everything up to PACS is stripped off a DicomFilePath so it starts with the year
+_pacs_prefix_re = re.compile('^.*PACS/')
+
 class SmiPyMongoCollection:
     """Python class to help get records from a specific collection in a MongoDB.
     Typical usage:
@@ -9,6 +12,13 @@ class SmiPyMongoCollection:
     mongojson = mongodb.DicomFilePathToJSON('/path/file2')
     print('MONGO: %s' % mongojson)
     """
+    _batch_size = 1000  # number of documents fetched from the server at a time
+
+    # A filter for setFilter which only returns documents which contain some text
+    text_filter = { '$or': [ { 'ContentSequence': { '$exists': True } }, { 'TextValue': { '$exists': True } } ] }
+
+    # The fields which are looked up, and so should be indexed, see ensureIndexes
+    indexed_fields = [ 'SOPInstanceUID', 'StudyDate', 'header.DicomFilePath' ]
 
     def __init__(self, hostname, username = None, password = None):
         """ Initialise the class with the MongoDB hostname username and password """
@@ -18,7 +28,44 @@ class SmiPyMongoCollection:
         else:
             self.mongoConnection = MongoClient(host=hostname)
         self.mongoCollection = None
+        self.projection = None
+        self.filter = None
+
+    def setProjection(self, projection):
+        """ Only return the given fields of the image documents, eg. from
+        StructuredReport.sr_mongo_projection(), or all fields if None.
+        A field can be a dict, eg. header, or within one, eg. header.DicomFilePath """
+
+        self.projection = projection
+
+    def setFilter(self, filter):
+        """ Only return the image documents which also match the given query,
+        eg. text_filter, or all of them if None. """
+
+        self.filter = filter
+
+    def _query(self, query):
+        """ Combine the query with any filter from setFilter """
+
+        if self.filter:
+            return { '$and': [ query, self.filter ] }
+        return query
+
 
+    def ensureIndexes(self, fields = None, create = True):
+        """ Check that each of the fields (default indexed_fields) is the first key
+        of an index in the collection, so that it can be looked up without a scan,
+        and if not then create an ascending index (which needs write permission)
+        unless create is False. Returns a dict of field: index name, or None if
+        the field is not indexed, so it can be reported. """
+
+        indexes = {}
+        for name, info in self.mongoCollection.index_information().items():
+            indexes.setdefault(info['key'][0][0], name)
+        for field in fields or self.indexed_fields:
+            if field not in indexes:
+                indexes[field] = self.mongoCollection.create_index( [ (field, ASCENDING) ] ) if create else None
+        return { field: indexes[field] for field in fields or self.indexed_fields }
 
     def setSemEHRCollection(self, collection_name):
         """ After initialisation set the desired collection using the two-letter modality, eg. SR selects dicom.image_SR """
@@ -34,19 +81,89 @@ class SmiPyMongoCollection:
         """ After setting a collection(modality) you can extract a document given a DICOM path (can be absolute, as everything up to PACS stripped off, or relative to root of collection)"""
 
         # strip off any full path prefix so it starts with the year
-        DicomFilePath = re.sub('^.*PACS/', '', DicomFilePath)
+        DicomFilePath = _pacs_prefix_re.sub('', DicomFilePath)
 
-        return self.mongoCollection.find_one( { "header.DicomFilePath": DicomFilePath } )
+        return self.mongoCollection.find_one( self._query( { "header.DicomFilePath": DicomFilePath } ), self.projection )
 
-    def StudyDateToJSONList(self, StudyDate):
-        """ After setting a collection(modality) you can extract a list of documents for a given date in the form YYYY/MM/DD.
-        Actually it returns a Mongo Cursor generator. """
+    def DicomFilePathsToJSON(self, DicomFilePaths, chunk = 1000):
+        """ As DicomFilePathToJSON but for a list (or any iterable) of paths,
+        using one query for each chunk of paths rather than one per path.
+        Yields (path, document) for each path as given, with a document of None
+        if the path is not found, so the misses can be reported.
+        Documents are yielded as they arrive, and the misses in each chunk
+        after its documents, so the order is not that of the paths.
+        """
+        yield from self._FieldValuesToJSON('header.DicomFilePath', DicomFilePaths, chunk,
+            lambda DicomFilePath: _pacs_prefix_re.sub('', DicomFilePath))
+
+    def _FieldValuesToJSON(self, field, values, chunk, normalise = None):
+        """ Look up the values of a field in chunks, see DicomFilePathsToJSON,
+        where normalise is an optional function to convert a value as given
+        into the value stored in the field.
+        """
+        keys = {}  # normalised value -> list of values as given
+        for value in values:
+            keys.setdefault(normalise(value) if normalise else value, []).append(value)
+            if len(keys) >= chunk:
+                yield from self._FieldChunkToJSON(field, keys)
+                keys = {}
+        if keys:
+            yield from self._FieldChunkToJSON(field, keys)
+
+    def _FieldChunkToJSON(self, field, keys):
+        """ Query for all the values in the dict, see _FieldValuesToJSON.
+        """
+        cursor = self.mongoCollection.find( self._query( { field: { "$in": list(keys) } } ), self.projection ).batch_size(self._batch_size)
+        for mongojson in cursor:
+            key = mongojson
+            for name in field.split('.'):
+                key = key.get(name, {}) if isinstance(key, dict) else {}
+            # Only the first document for a value, as find_one
+            for value in keys.pop(key, []) if isinstance(key, str) else []:
+                yield (value, mongojson)
+        for missing in keys.values():
+            for value in missing:
+                yield (value, None)
+
+    def SOPInstanceUIDToJSON(self, SOPInstanceUID):
+        """ After setting a collection(modality) you can extract a document given its SOPInstanceUID """
+
+        return self.mongoCollection.find_one( self._query( { "SOPInstanceUID": SOPInstanceUID.strip() } ), self.projection )
+
+    def SOPInstanceUIDsToJSON(self, SOPInstanceUIDs, chunk = 1000):
+        """ As SOPInstanceUIDToJSON but for a list (or any iterable),
+        yielding (SOPInstanceUID, document or None) as DicomFilePathsToJSON """
+
+        yield from self._FieldValuesToJSON('SOPInstanceUID', SOPInstanceUIDs, chunk, str.strip)
+
+    def _StudyDateQuery(self, StudyDate, hour = None):
+        """ Return the query for StudyDateToJSONList """
 
         # Remove all spaces and slashes becaise StudyDate is always in YYYYMMDD format
         StudyDate = re.sub('[/ ]*', '', StudyDate)
         assert(len(StudyDate) == 8)
 
-        return self.mongoCollection.find( { "StudyDate" : StudyDate } )
+        query = { "StudyDate" : StudyDate }
+        # StudyTime is HHMMSS.FFFFFF so hours can be compared as strings
+        if hour == 23:
+            query['$nor'] = [ { 'StudyTime': { '$gte': '00', '$lt': '23' } } ]
+        elif hour is not None:
+            query['StudyTime'] = { '$gte': '%02d' % hour, '$lt': '%02d' % (hour + 1) }
+        return self._query(query)
+
+    def StudyDateToJSONList(self, StudyDate, hour = None):
+        """ After setting a collection(modality) you can extract a list of documents for a given date in the form YYYY/MM/DD.
+        If an hour (0 to 23) is given then only those with a StudyTime in that hour are returned,
+        where hour 23 also includes any documents without a valid StudyTime, so that the
+        24 hours together return every document for the date.
+        Actually it returns a Mongo Cursor generator. """
+
+        return self.mongoCollection.find( self._StudyDateQuery(StudyDate, hour), self.projection ).batch_size(self._batch_size)
+
+    def countStudyDate(self, StudyDate, hour = None):
+        """ Return the number of documents which StudyDateToJSONList would return """
+
+        return self.mongoCollection.count_documents( self._StudyDateQuery(StudyDate, hour) )
 
     def findSOPInstanceUID(self, sopinstanceuid):
         """ This is intended to check for the existence of a document having the
@@ -54,3 +171,127 @@ class SmiPyMongoCollection:
         used as a query """
         
         return self.mongoCollection.find_one( { 'SOPInstanceUID': sopinstanceuid } )
+
+    def findSOPInstanceUIDs(self, sopinstanceuids):
+        """ Return the set of those SOPInstanceUIDs in the given list which have
+        a document, using a single query which only returns the SOPInstanceUIDs,
+        instead of calling findSOPInstanceUID for each one.
+        Without an index on SOPInstanceUID (see ensureIndexes) every call
+        is a scan of the whole collection; with one it is a covered query,
+        answered from the index without reading the documents. """
+
+        cursor = self.mongoCollection.find( { 'SOPInstanceUID': { '$in': list(sopinstanceuids) } },
+            { 'SOPInstanceUID': 1, '_id': 0 } ).batch_size(self._batch_size)
+        return set(doc['SOPInstanceUID'] for doc in cursor if 'SOPInstanceUID' in doc)
+
+
+# ---------------------------------------------------------------------
+# Tests using a fake collection, no MongoDB server is needed.
+
+class _FakeCursor(list):
+    def batch_size(self, size):
+        return self
+
+class _FakeCollection:
+    """ Just enough of a pymongo Collection for the tests, with the
+    documents in a list, ignoring any projection. """
+    def __init__(self, documents):
+        self.documents = documents
+        self.indexes = { '_id_': { 'key': [ ('_id', 1) ] } }
+    def find(self, query, projection = None):
+        return _FakeCursor(doc for doc in self.documents if _fake_match(doc, query))
+    def find_one(self, query, projection = None):
+        return next(iter(self.find(query, projection)), None)
+    def count_documents(self, query):
+        return len(self.find(query))
+    def index_information(self):
+        return self.indexes
+    def create_index(self, keys):
+        name = '_'.join('%s_%s' % key for key in keys)
+        self.indexes[name] = { 'key': keys }
+        return name
+
+def _fake_match(doc, query):
+    """ Whether a document matches a query using $and $or $nor $in $exists $gte $lt """
+    for field, cond in query.items():
+        if field in ('$and', '$or', '$nor'):
+            matches = [ _fake_match(doc, q) for q in cond ]
+            if not { '$and': all, '$or': any, '$nor': lambda m: not any(m) }[field](matches):
+                return False
+            continue
+        value = doc
+        for name in field.split('.'):
+            value = value.get(name) if isinstance(value, dict) else None
+        if not isinstance(cond, dict):
+            cond = { '$eq': cond }
+        for op, arg in cond.items():
+            if not { '$eq': lambda: value == arg,
+                     '$in': lambda: value in arg,
+                     '$exists': lambda: (value is not None) == arg,
+                     '$gte': lambda: value is not None and value >= arg,
+                     '$lt': lambda: value is not None and value < arg }[op]():
+                return False
+    return True
+
+def _fake_mongodb(documents):
+    """ A SmiPyMongoCollection of the documents without a MongoClient """
+    mongodb = SmiPyMongoCollection.__new__(SmiPyMongoCollection)
+    mongodb.mongoConnection = None
+    mongodb.mongoCollection = _FakeCollection(documents)
+    mongodb.projection = None
+    mongodb.filter = None
+    return mongodb
+
+
+def test_FieldChunkToJSON():
+    docs = [ { 'SOPInstanceUID': '1.1', 'header': { 'DicomFilePath': '2020/a.dcm' }, 'TextValue': 'x' },
+             { 'SOPInstanceUID': '1.2', 'header': { 'DicomFilePath': '2020/b.dcm' } },
+             { 'SOPInstanceUID': '1.1', 'header': { 'DicomFilePath': '2020/c.dcm' } } ]
+    mongodb = _fake_mongodb(docs)
+    # Nested field, a path given twice in different forms, and a missing path
+    keys = { '2020/a.dcm': ['/PACS/2020/a.dcm', '2020/a.dcm'], '2020/b.dcm': ['2020/b.dcm'], '2020/x.dcm': ['2020/x.dcm'] }
+    assert(list(mongodb._FieldChunkToJSON('header.DicomFilePath', keys)) ==
+        [ ('/PACS/2020/a.dcm', docs[0]), ('2020/a.dcm', docs[0]), ('2020/b.dcm', docs[1]), ('2020/x.dcm', None) ])
+    # Only the first document for a value
+    assert(list(mongodb._FieldChunkToJSON('SOPInstanceUID', { '1.1': [' 1.1'] })) == [ (' 1.1', docs[0]) ])
+    # Combined with the filter
+    mongodb.setFilter(SmiPyMongoCollection.text_filter)
+    assert(list(mongodb.DicomFilePathsToJSON(['/x/PACS/2020/a.dcm', '2020/b.dcm'], chunk = 1)) ==
+        [ ('/x/PACS/2020/a.dcm', docs[0]), ('2020/b.dcm', None) ])
+
+def test_StudyDateQuery():
+    mongodb = _fake_mongodb([])
+    assert(mongodb._StudyDateQuery('2020/01/02') == { 'StudyDate': '20200102' })
+    assert(mongodb._StudyDateQuery('20200102', 0) == { 'StudyDate': '20200102', 'StudyTime': { '$gte': '00', '$lt': '01' } })
+    assert(mongodb._StudyDateQuery('20200102', 9) == { 'StudyDate': '20200102', 'StudyTime': { '$gte': '09', '$lt': '10' } })
+    assert(mongodb._StudyDateQuery('20200102', 23) == { 'StudyDate': '20200102', '$nor': [ { 'StudyTime': { '$gte': '00', '$lt': '23' } } ] })
+    mongodb.setFilter(SmiPyMongoCollection.text_filter)
+    assert(mongodb._StudyDateQuery('20200102') == { '$and': [ { 'StudyDate': '20200102' }, SmiPyMongoCollection.text_filter ] })
+    # The hours together return every document for the date, those without a valid StudyTime in hour 23
+    times = [ '000000', '095959.5', '100000', '225959', '230000', '235959.999999', '', 'x', None ]
+    docs = [ { 'StudyDate': '20200102', 'TextValue': 'x', 'StudyTime': time } for time in times ]
+    docs += [ { 'StudyDate': '20200102', 'TextValue': 'x' }, { 'StudyDate': '20200103', 'TextValue': 'x', 'StudyTime': '120000' } ]
+    mongodb = _fake_mongodb(docs)
+    assert([ mongodb.countStudyDate('20200102', hour) for hour in [ 0, 9, 10, 22, 23 ] ] == [ 1, 1, 1, 1, 6 ])
+    assert(sum(mongodb.countStudyDate('20200102', hour) for hour in range(24)) == mongodb.countStudyDate('20200102') == 10)
+    assert(list(mongodb.StudyDateToJSONList('2020/01/03', 12)) == [ docs[-1] ])
+
+def test_ensureIndexes():
+    mongodb = _fake_mongodb([])
+    mongodb.mongoCollection.indexes['StudyDate_1_StudyTime_1'] = { 'key': [ ('StudyDate', 1), ('StudyTime', 1) ] }
+    mongodb.mongoCollection.indexes['StudyTime_1_SOPInstanceUID_1'] = { 'key': [ ('StudyTime', 1), ('SOPInstanceUID', 1) ] }
+    # Only the first key of an index counts
+    assert(mongodb.ensureIndexes(create = False) ==
+        { 'SOPInstanceUID': None, 'StudyDate': 'StudyDate_1_StudyTime_1', 'header.DicomFilePath': None })
+    assert(len(mongodb.mongoCollection.indexes) == 3)
+    assert(mongodb.ensureIndexes() ==
+        { 'SOPInstanceUID': 'SOPInstanceUID_1', 'StudyDate': 'StudyDate_1_StudyTime_1', 'header.DicomFilePath': 'header.DicomFilePath_1' })
+    assert(mongodb.mongoCollection.indexes['SOPInstanceUID_1'] == { 'key': [ ('SOPInstanceUID', ASCENDING) ] })
+    assert(len(mongodb.mongoCollection.indexes) == 5)
+    assert(mongodb.ensureIndexes(['SOPInstanceUID'], create = False) == { 'SOPInstanceUID': 'SOPInstanceUID_1' })
+    assert(mongodb.ensureIndexes(['_id', 'PatientID']) == { '_id': '_id_', 'PatientID': 'PatientID_1' })
+
+def test_findSOPInstanceUIDs():
+    mongodb = _fake_mongodb([ { 'SOPInstanceUID': '1.1' }, { 'SOPInstanceUID': '1.2' }, { 'PatientID': 'x' } ])
+    assert(mongodb.findSOPInstanceUIDs(uid for uid in [ '1.2', '1.3', '1.1' ]) == { '1.1', '1.2' })
+    assert(mongodb.findSOPInstanceUIDs([]) == set())
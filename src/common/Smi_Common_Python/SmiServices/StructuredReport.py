@@ -1,6 +1,10 @@
+import functools
+import itertools
+import json
 import os
 import re
 import sys
+import time
 from SmiServices import Dicom
 from SmiServices.Dicom import tag_is, tag_val, has_tag
 import pydicom
@@ -238,33 +242,104 @@ sr_keys_to_ignore = [
 ]
 
 
+# ---------------------------------------------------------------------
+# A projection for reading documents from MongoDB which only includes
+# the tags used by SR_parse, plus any extra fields, eg. for metadata,
+# so that large tags which would be ignored, such as PixelData,
+# are not sent by the server. Use with SmiPyMongoCollection.setProjection.
+
+sr_keys_to_parse = [ 'ConceptNameCodeSequence', 'SourceImageSequence', 'ContentSequence' ]
+
+def sr_mongo_projection(fields = []):
+    projection = { 'SOPInstanceUID': 1, 'header': 1 }
+    for field in [ srkey['tag'] for srkey in sr_keys_to_extract ] + sr_keys_to_parse + list(fields):
+        projection[field] = 1
+    return projection
+
+def test_sr_mongo_projection():
+    projection = sr_mongo_projection(['ModalitiesInStudy'])
+    assert(all(projection[field] == 1 for field in ['TextValue', 'ContentSequence', 'PatientName', 'header', 'ModalitiesInStudy']))
+    assert('PixelData' not in projection)
+
+
+# ---------------------------------------------------------------------
+# The lists above compiled into sets of keywords and of integer tags
+# so that each tag in a document can be checked with a single lookup.
+# Create a new SRTagPolicy (or call compile) if the lists are changed.
+
+class SRTagPolicy:
+    """ Decide whether a tag, given by keyword, hex string or integer,
+    has already been output or is of no interest, see sr_key_can_be_ignored.
+    The decision for each tag is remembered.
+    """
+    # Names of tags which we cannot definitively decode, BUT some contain information which is not anywhere else, even person names!
+    # XXX TODO: add the ones we know (study description, hospital name, etc)
+    _private_re = re.compile('-PrivateCreator|-Unknown|-CSA |-Dataset Name') # CSA is SIEMENS CSA HEADER, Dataset Name is GEMS_GENIE_1
+
+    def __init__(self, keys_to_extract = None, keys_to_ignore = None):
+        self.compile(sr_keys_to_extract if keys_to_extract is None else keys_to_extract,
+            sr_keys_to_ignore if keys_to_ignore is None else keys_to_ignore)
+
+    def compile(self, keys_to_extract, keys_to_ignore):
+        """ Build the sets from a list like sr_keys_to_extract
+        and a list like sr_keys_to_ignore.
+        """
+        self.extract_keywords = frozenset(srkey['tag'] for srkey in keys_to_extract)
+        self.ignore_keywords = frozenset(keys_to_ignore) | self.extract_keywords
+        self.ignore_tags = frozenset(tag for tag in map(pydicom.datadict.tag_for_keyword, self.ignore_keywords) if tag is not None)
+        self._keys = {}
+        self._tags = {}
+
+    def key_can_be_ignored(self, keystr):
+        """ True if the tag named keystr (a keyword or 8 hex digits) can be ignored.
+        """
+        rc = self._keys.get(keystr)
+        if rc is None:
+            keyword = keystr
+            if Dicom._hex_tag_re.match(keystr):
+                keyword = pydicom.datadict.keyword_for_tag(keystr)
+            rc = keyword in self.ignore_keywords or bool(self._private_re.search(keyword))
+            self._keys[keystr] = rc
+        return rc
+
+    def tag_can_be_ignored(self, tag):
+        """ True if the integer tag can be ignored, including private tags
+        and tags not in the DICOM dictionary, which have no keyword.
+        """
+        rc = self._tags.get(tag)
+        if rc is None:
+            rc = tag in self.ignore_tags or not pydicom.datadict.keyword_for_tag(tag)
+            self._tags[tag] = rc
+        return rc
+
+
+sr_tag_policy = SRTagPolicy()
+
+
 # ---------------------------------------------------------------------
 # Return True if the DICOM tag named keystr can be ignored, either because
 # it exists at the top level of the document and has already been output,
 # or because it contains nothing of interest,
 # or it is not recognised so cannot be decoded.
-# Uses the global list sr_keys_to_ignore
+# Uses the global lists sr_keys_to_ignore and sr_keys_to_extract via sr_tag_policy
 
 def sr_key_can_be_ignored(keystr):
-    if re.match('^[0-9a-fA-F]{8}$', keystr):
-        keystr = pydicom.datadict.keyword_for_tag(keystr)
-    if keystr in sr_keys_to_ignore:
-        return True
-    # If already handled explicitly elsewhere it can also be ignored
-    for sr_extract_dict in sr_keys_to_extract:
-        if keystr == sr_extract_dict['tag']:
-            return True
-    # We cannot definitively decode private tags, BUT some contain information which is not anywhere else, even person names!
-    # XXX TODO: add the ones we know (study description, hospital name, etc)
-    if '-PrivateCreator' in keystr:
-        return True
-    if '-Unknown' in keystr:
-        return True
-    if '-CSA ' in keystr: # part of SIEMENS CSA HEADER
-        return True
-    if ('-Dataset Name') in keystr: # part of GEMS_GENIE_1
-        return True
-    return False
+    return sr_tag_policy.key_can_be_ignored(keystr)
+
+
+def test_SRTagPolicy():
+    assert(sr_key_can_be_ignored('_id'))
+    assert(sr_key_can_be_ignored('StudyDate'))
+    assert(sr_key_can_be_ignored('00080020'))            # StudyDate
+    assert(sr_key_can_be_ignored('00291010-CSA Image Header Info'))
+    assert(not sr_key_can_be_ignored('ContentSequence'))
+    assert(not sr_key_can_be_ignored('0040a730'))        # ContentSequence
+    policy = SRTagPolicy(keys_to_extract = [], keys_to_ignore = ['StudyDate'])
+    assert(policy.tag_can_be_ignored(0x00080020))
+    assert(policy.tag_can_be_ignored(0x00291010))        # private
+    assert(not policy.tag_can_be_ignored(0x00100010))    # PatientName
+    assert(not policy.key_can_be_ignored('PatientName'))
+    assert(sr_tag_policy.tag_can_be_ignored(0x00100010))
 
 
 # ---------------------------------------------------------------------
@@ -273,105 +348,385 @@ def sr_key_can_be_ignored(keystr):
 # eg.  [[keystr]] valstr
 # Replaces HTML tags <BR> with newlines.
 # Removes multiple line endings for clarity.
+# _SR_format_string appends the output to a list, so that a whole document
+# can be written at once, and _SR_output_string writes it to a file.
 
-def _SR_output_string(keystr, valstr, fp):
-    # If it's a list then print each element (but only expecting a single one line ['Findings'])
+_SR_cr_to_lf = str.maketrans('\r', '\n')
+_SR_newlines_re = re.compile('(?:\n|<[Bb][Rr]>)+')
+
+def _SR_format_string(keystr, valstr, out):
+    # If it's a list then output each element (but only expecting a single one line ['Findings'])
     if isinstance(valstr, list):
-        return [_SR_output_string(keystr,X,fp) for X in valstr]
+        for val in valstr:
+            _SR_format_string(keystr, val, out)
+        return
     # The Key may also be a list but only take first element
     if isinstance(keystr, list):
         keystr = keystr[0]
     # If there is no value the do not print anything at all
     if valstr == None or valstr == '':
         return
-    # Replace CRs with LF
-    valstr = re.sub('\r+', '\n', valstr)
-    # Replace HTML tags such as <br>
-    valstr = re.sub('<[Bb][Rr]>', '\n', valstr)
-    # Remove superfluous LFs
-    valstr = re.sub('\n+', '\n', valstr)
+    # Numbers, eg. PatientWeight, are numeric in JSON from pydicom
+    if not isinstance(valstr, str):
+        valstr = str(valstr)
+    # Replace CRs with LF, then HTML tags such as <br> and runs of LFs with a single LF
+    valstr = _SR_newlines_re.sub('\n', valstr.translate(_SR_cr_to_lf))
     # If there is no key then do not print a prefix
     if keystr == None or keystr == '':
-        fp.write('%s\n' % (valstr))
+        out.append(valstr)
     else:
-        fp.write('[[%s]] %s\n' % (keystr, valstr))
+        out.append('[[%s]] %s' % (keystr, valstr))
+    out.append('\n')
+
+def _SR_output_string(keystr, valstr, fp):
+    out = []
+    _SR_format_string(keystr, valstr, out)
+    if out:
+        fp.write(''.join(out))
+
+
+def test_SR_format_string():
+    out = []
+    _SR_format_string('Key', 'a\r\r\nb<br><BR>\nc<b<br>r>d\n', out)
+    _SR_format_string(['Findings'], ['', None, 'e'], out)
+    _SR_format_string('', 'f', out)
+    _SR_format_string(None, None, out)
+    assert(''.join(out) == '[[Key]] a\nb\nc<b\nr>d\n\n[[Findings]] e\nf\n')
 
 
 # ---------------------------------------------------------------------
-# Internal function to parse a DICOM tag which calls itself recursively
-# when it finds a sequence
-# Uses str_output_string to format the output.
+# Optional statistics about the documents parsed, to find which templates
+# and VRs take the time. Unexpected keys and items are counted, with a few
+# short samples of their values, instead of each being printed to stderr.
 
-def _SR_parse_key(json_dict, json_key, fp):
+class SRStats:
+    """ Pass an instance to SR_parse, SR_iter or DicomText.parse to collect
+    the number of each ValueType (or VR) handled and the time taken,
+    then call dump(fd) to write them as JSON at the end of a run or batch.
+    """
+    _max_samples = 5      # number of values kept for each unexpected key
+    _sample_length = 64   # truncate each sample to this many characters
+
+    def __init__(self):
+        self.documents = 0
+        self.seconds = 0.0
+        self.counters = {}          # { kind: { name: { count, seconds } } }
+        self.unexpected = {}        # { kind: { name: { count, samples } } }
+
+    def count(self, kind, name, seconds):
+        """ Add one of name, eg. kind='ValueType', name='TEXT', taking seconds.
+        """
+        counter = self.counters.setdefault(kind, {}).setdefault(name, { 'count': 0, 'seconds': 0.0 })
+        counter['count'] += 1
+        counter['seconds'] += seconds
+
+    def unexpected_key(self, kind, name, value):
+        """ Tally an unexpected key (or ValueType) and keep a sample of its value.
+        """
+        tally = self.unexpected.setdefault(kind, {}).setdefault(name, { 'count': 0, 'samples': [] })
+        tally['count'] += 1
+        if len(tally['samples']) < SRStats._max_samples:
+            tally['samples'].append(str(value)[0:SRStats._sample_length])
+
+    def merge(self, other):
+        """ Add the statistics from another SRStats, eg. from a worker process.
+        """
+        self.documents += other.documents
+        self.seconds += other.seconds
+        for kind, names in other.counters.items():
+            for name, counter in names.items():
+                total = self.counters.setdefault(kind, {}).setdefault(name, { 'count': 0, 'seconds': 0.0 })
+                total['count'] += counter['count']
+                total['seconds'] += counter['seconds']
+        for kind, names in other.unexpected.items():
+            for name, tally in names.items():
+                total = self.unexpected.setdefault(kind, {}).setdefault(name, { 'count': 0, 'samples': [] })
+                total['count'] += tally['count']
+                total['samples'] = (total['samples'] + tally['samples'])[0:SRStats._max_samples]
+
+    def as_dict(self):
+        return { 'documents': self.documents, 'seconds': self.seconds,
+            'counters': self.counters, 'unexpected': self.unexpected }
+
+    def dump(self, fd):
+        """ Write the statistics as JSON to fd.
+        """
+        json.dump(self.as_dict(), fd, indent = 2, sort_keys = True)
+        fd.write('\n')
+
+
+def test_SRStats():
+    stats = SRStats()
+    stats.count('ValueType', 'TEXT', 0.5)
+    stats.count('ValueType', 'TEXT', 0.25)
+    for ii in range(SRStats._max_samples + 2):
+        stats.unexpected_key('key', 'Odd', 'x' * 100)
+    other = SRStats()
+    other.documents = 2
+    other.count('ValueType', 'TEXT', 0.25)
+    other.unexpected_key('key', 'Odd', 'y')
+    stats.merge(other)
+    stats = json.loads(json.dumps(stats.as_dict()))
+    assert(stats['documents'] == 2)
+    assert(stats['counters']['ValueType']['TEXT'] == { 'count': 3, 'seconds': 1.0 })
+    assert(stats['unexpected']['key']['Odd']['count'] == SRStats._max_samples + 3)
+    assert(stats['unexpected']['key']['Odd']['samples'] == ['x' * SRStats._sample_length] * SRStats._max_samples)
+
+
+# ---------------------------------------------------------------------
+# Handlers for each ValueType of an item in a ContentSequence.
+# Each is called as handler(cs_item) with the canonical item,
+# see Dicom.canonicalise, and returns a list of (label, value) for the
+# text to be output, or None if the item is not as expected. A handler
+# of None means that items of that type are ignored. The items inside a CONTAINER are visited after its label.
+# Use sr_register_value_type to add or replace a handler.
+
+def _SR_concept_name(cs_item):
+    return Dicom.sr_decode_ConceptNameCodeSequence(getattr(cs_item, 'ConceptNameCodeSequence', None))
+
+def _SR_unexpected_item(value_type, cs_item, stats = None):
+    if stats:
+        stats.unexpected_key('ValueType', str(value_type), cs_item)
+    else:
+        print('UNEXPECTED ITEM OF TYPE %s = %s' % (value_type, cs_item), file=sys.stderr)
+
+def _SR_handle_PNAME(cs_item):
+    return [ (_SR_concept_name(cs_item), getattr(cs_item, 'PersonName', None)) ]
+
+def _SR_handle_DATETIME(cs_item):
+    return [ (_SR_concept_name(cs_item), getattr(cs_item, 'DateTime', None)) ]
+
+def _SR_handle_DATE(cs_item):
+    return [ (_SR_concept_name(cs_item), getattr(cs_item, 'Date', None)) ]
+
+def _SR_handle_TEXT(cs_item):
+    return [ (_SR_concept_name(cs_item), getattr(cs_item, 'TextValue', None)) ]
+
+def _SR_handle_NUM(cs_item):
+    if hasattr(cs_item, 'MeasuredValueSequence'):
+        return [ (_SR_concept_name(cs_item), Dicom.sr_decode_MeasuredValueSequence(cs_item.MeasuredValueSequence)) ]
+    elif hasattr(cs_item, 'NumericValue'):
+        return [ (_SR_concept_name(cs_item), cs_item.NumericValue) ]
+    return None
+
+def _SR_handle_CODE(cs_item):
+    return [ (_SR_concept_name(cs_item), Dicom.sr_decode_ConceptNameCodeSequence(getattr(cs_item, 'ConceptCodeSequence', None))) ]
+
+def _SR_handle_UIDREF(cs_item):
+    return [ (_SR_concept_name(cs_item), getattr(cs_item, 'UID', None)) ]
+
+def _SR_handle_IMAGE(cs_item):
+    return [ (Dicom.sr_decode_ConceptNameCodeSequence(getattr(cs_item, 'ReferencedSOPSequence', None)), Dicom.sr_decode_ReferencedSOPSequence(getattr(cs_item, 'ReferencedSOPSequence', None))) ]
+
+def _SR_handle_CONTAINER(cs_item):
+    # Sometimes it has no ContentSequence or is 'null'
+    if getattr(cs_item, 'ContentSequence', None) != None and hasattr(cs_item, 'ConceptNameCodeSequence'):
+        return [ ('', _SR_concept_name(cs_item)) ]
+    return []
+
+sr_value_type_handlers = {
+    'PNAME':     _SR_handle_PNAME,
+    'DATETIME':  _SR_handle_DATETIME,
+    'DATE':      _SR_handle_DATE,
+    'TEXT':      _SR_handle_TEXT,
+    'NUM':       _SR_handle_NUM,
+    'CODE':      _SR_handle_CODE,
+    'UIDREF':    _SR_handle_UIDREF,
+    'IMAGE':     _SR_handle_IMAGE,
+    'CONTAINER': _SR_handle_CONTAINER,
+    # explicitly ignore TIME, SCOORD, TCOORD, COMPOSITE, WAVEFORM
+    # as they have no useful text to return
+    'SCOORD':    None,
+    'TCOORD':    None,
+    'COMPOSITE': None,
+    'TIME':      None,
+    'WAVEFORM':  None,
+}
+
+def sr_register_value_type(value_type, handler):
+    """ Use handler(cs_item) to get the list of (label, value) to output
+    for items of the given ValueType, eg. for private templates, replacing
+    any existing handler. A handler of None ignores the items.
+    Returns the previous handler (or False if there was none) so that it
+    can be restored.
+    """
+    previous = sr_value_type_handlers.get(value_type, False)
+    sr_value_type_handlers[value_type] = handler
+    return previous
+
+def sr_unregister_value_type(value_type):
+    """ Remove the handler for a ValueType so its items are reported as unexpected.
+    """
+    sr_value_type_handlers.pop(value_type, None)
+
+
+# ---------------------------------------------------------------------
+# Internal generator to iterate over a DICOM tag, yielding
+# (label, value, path, value_type) for the text found, see SR_iter.
+# The json_dict must already be canonical, see Dicom.canonicalise,
+# so that it's only rewritten once for all of its keys.
+# Nested CONTAINERs are visited using a stack rather than by recursion
+# so there is no limit to the depth of a document.
+
+def _SR_iter_key(json_dict, json_key, path, stats = None):
     if tag_is(json_key, 'ConceptNameCodeSequence'):
-        _SR_output_string('', Dicom.sr_decode_ConceptNameCodeSequence(tag_val(json_dict, json_key)), fp)
+        yield ('', Dicom.sr_decode_ConceptNameCodeSequence(tag_val(json_dict, json_key)), path + (json_key,), None)
+        return
     elif tag_is(json_key, 'SourceImageSequence'):
-        _SR_output_string('SourceImage', Dicom.sr_decode_SourceImageSequence(tag_val(json_dict, json_key)), fp)
-    elif tag_is(json_key, 'ContentSequence'):
-        for cs_item in tag_val(json_dict, json_key):
-            if has_tag(cs_item, 'RelationshipType') and has_tag(cs_item, 'ValueType'):
-                value_type = tag_val(cs_item, 'ValueType')
-                if value_type == 'PNAME' or value_type == ['PNAME']:
-                    _SR_output_string(Dicom.sr_decode_ConceptNameCodeSequence(tag_val(cs_item, 'ConceptNameCodeSequence')), tag_val(cs_item, 'PersonName'), fp)
-                elif value_type == 'DATETIME' or value_type == ['DATETIME']:
-                    _SR_output_string(Dicom.sr_decode_ConceptNameCodeSequence(tag_val(cs_item, 'ConceptNameCodeSequence')), tag_val(cs_item, 'DateTime'), fp)
-                elif value_type == 'DATE' or value_type == ['DATE']:
-                    _SR_output_string(Dicom.sr_decode_ConceptNameCodeSequence(tag_val(cs_item, 'ConceptNameCodeSequence')), tag_val(cs_item, 'Date'), fp)
-                elif value_type == 'TEXT' or value_type == ['TEXT']:
-                    _SR_output_string(Dicom.sr_decode_ConceptNameCodeSequence(tag_val(cs_item, 'ConceptNameCodeSequence')), tag_val(cs_item, 'TextValue'), fp)
-                elif (value_type == 'NUM' or value_type == ['NUM']) and has_tag(cs_item, 'MeasuredValueSequence'):
-                    _SR_output_string(Dicom.sr_decode_ConceptNameCodeSequence(cs_item['ConceptNameCodeSequence']), Dicom.sr_decode_MeasuredValueSequence(tag_val(cs_item, 'MeasuredValueSequence')), fp)
-                elif (value_type == 'NUM' or value_type == ['NUM']) and has_tag(cs_item, 'NumericValue'):
-                    _SR_output_string(Dicom.sr_decode_ConceptNameCodeSequence(tag_val(cs_item, 'ConceptNameCodeSequence')), tag_val(cs_item, 'NumericValue'), fp)
-                elif value_type == 'CODE' or value_type == ['CODE']:
-                    _SR_output_string(Dicom.sr_decode_ConceptNameCodeSequence(tag_val(cs_item, 'ConceptNameCodeSequence')), Dicom.sr_decode_ConceptNameCodeSequence(tag_val(cs_item, 'ConceptCodeSequence')), fp)
-                elif value_type == 'UIDREF' or value_type == ['UIDREF']:
-                    _SR_output_string(Dicom.sr_decode_ConceptNameCodeSequence(tag_val(cs_item, 'ConceptNameCodeSequence')), tag_val(cs_item, 'UID'), fp)
-                elif value_type == 'IMAGE' or value_type == ['IMAGE']:
-                    _SR_output_string(Dicom.sr_decode_ConceptNameCodeSequence(tag_val(cs_item, 'ReferencedSOPSequence')), Dicom.sr_decode_ReferencedSOPSequence(tag_val(cs_item, 'ReferencedSOPSequence')), fp)
-                elif value_type == 'CONTAINER' or value_type == ['CONTAINER']:
-                    # Sometimes it has no ContentSequence or is 'null'
-                    if has_tag(cs_item, 'ContentSequence') and tag_val(cs_item, 'ContentSequence') != None:
-                        if has_tag(cs_item, 'ConceptNameCodeSequence'):
-                            _SR_output_string('', Dicom.sr_decode_ConceptNameCodeSequence(tag_val(cs_item, 'ConceptNameCodeSequence')), fp)
-                        _SR_parse_key(cs_item, 'ContentSequence', fp)
-                # explicitly ignore TIME, SCOORD, TCOORD, COMPOSITE, IMAGE, WAVEFORM
-                # as they have no useful text to return
-                elif value_type == 'SCOORD' or value_type == ['SCOORD']:
-                    pass
-                elif value_type == 'TCOORD' or value_type == ['TCOORD']:
-                    pass
-                elif value_type == 'COMPOSITE' or value_type == ['COMPOSITE']:
-                    pass
-                elif value_type == 'TIME' or value_type == ['TIME']:
-                    pass
-                elif value_type == 'WAVEFORM' or value_type == ['WAVEFORM']:
-                    pass
+        yield ('SourceImage', Dicom.sr_decode_SourceImageSequence(tag_val(json_dict, json_key)), path + (json_key,), None)
+        return
+    elif not tag_is(json_key, 'ContentSequence'):
+        if sr_key_can_be_ignored(json_key):
+            pass
+        elif stats:
+            stats.unexpected_key('key', json_key, tag_val(json_dict, json_key))
+        else:
+            print('UNEXPECTED KEY %s = %s' % (json_key, tag_val(json_dict, json_key)), file=sys.stderr)
+        return
+    handlers = sr_value_type_handlers
+    # Each entry is (path of the ContentSequence, iterator over its items)
+    stack = [ (path + (json_key,), enumerate(tag_val(json_dict, json_key))) ]
+    while stack:
+        cs_path, items = stack[-1]
+        for ii, cs_item in items:
+            if hasattr(cs_item, 'RelationshipType') and hasattr(cs_item, 'ValueType'):
+                value_type = cs_item.ValueType
+                # May still be a list, eg. ['TEXT'], if not canonical
+                key = value_type[0] if isinstance(value_type, list) and len(value_type) == 1 else value_type
+                if not isinstance(key, str) or key not in handlers:
+                    _SR_unexpected_item(value_type, cs_item, stats)
+                    continue
+                if not handlers[key]:
+                    continue
+                item_path = cs_path + (ii,)
+                if stats:
+                    start = time.perf_counter()
+                    events = handlers[key](cs_item)
+                    stats.count('ValueType', key, time.perf_counter() - start)
                 else:
-                    print('UNEXPECTED ITEM OF TYPE %s = %s' % (value_type, cs_item), file=sys.stderr)
-            #print('ITEM %s' % cs_item)
-    else:
-        if not sr_key_can_be_ignored(json_key):
-            print('UNEXPECTED KEY %s = %s' % (json_key, json_dict[json_key]), file=sys.stderr)
+                    events = handlers[key](cs_item)
+                if events is None:
+                    _SR_unexpected_item(value_type, cs_item, stats)
+                    continue
+                for label, value in events:
+                    yield (label, value, item_path, key)
+                if key == 'CONTAINER' and getattr(cs_item, 'ContentSequence', None) != None:
+                    stack.append( (item_path + ('ContentSequence',), enumerate(cs_item.ContentSequence)) )
+                    break
+        else:
+            stack.pop()
 
 
 # ---------------------------------------------------------------------
-# Main function to parse a DICOM Structured Report in JSON format as
-# output by the MongoDB database.
+# Internal function to output a DICOM tag, and any sequence within it,
+# using _SR_format_string to format the output.
 
-def SR_parse(json_dict, doc_name, fp = sys.stdout):
+def _SR_parse_key(json_dict, json_key, fp):
+    json_dict = Dicom.canonicalise(json_dict)
+    out = []
+    for label, value, path, value_type in _SR_iter_key(json_dict, json_key, ()):
+        _SR_format_string(label, value, out)
+    fp.write(''.join(out))
 
-    _SR_output_string('Document name', doc_name, fp)
+
+# ---------------------------------------------------------------------
+# Iterate over a DICOM Structured Report in JSON format, either as output
+# by the MongoDB database or from pydicom, yielding a tuple
+#   (label, value, path, value_type)
+# for each piece of text in the order that SR_parse outputs it, where
+#  label is the section title (may be empty or a list, see _SR_output_string),
+#  value is the text (may be a list, None or empty),
+#  path is a tuple of keywords and item indexes, eg. ('ContentSequence', 2, 'ContentSequence', 0),
+#  value_type is the ValueType of the content item, or None for other tags.
+# The caller can stop at any time.
+# Optionally counts the ValueTypes into an SRStats, see SRStats.
+
+def SR_iter(json_dict, stats = None):
+
+    # Rewrite the document once so every tag is read directly by name
+    json_dict = Dicom.canonicalise(json_dict)
 
     # Output a set of known tags from the root of the document
-    # This loop does the equivalent of
-    # _SR_output_string('Study Date', sr_decode_date(sr_get_key(json_dict, 'StudyDate')))
     for sr_extract_dict in sr_keys_to_extract:
-        _SR_output_string(sr_extract_dict['label'], sr_extract_dict['decode_func'](Dicom.tag_val(json_dict, sr_extract_dict['tag'])), fp)
+        yield (sr_extract_dict['label'], sr_extract_dict['decode_func'](Dicom.tag_val(json_dict, sr_extract_dict['tag'])), (sr_extract_dict['tag'],), None)
 
     # Now output all the remaining tags which are not ignored
     for json_key in json_dict:
-        _SR_parse_key(json_dict, json_key, fp)
+        yield from _SR_iter_key(json_dict, json_key, (), stats)
+
+
+# ---------------------------------------------------------------------
+# Main function to parse a DICOM Structured Report in JSON format as
+# output by the MongoDB database.
+
+def SR_parse(json_dict, doc_name, fp = sys.stdout, stats = None):
+
+    start = time.perf_counter()
+
+    # Collect the output and write it all at once
+    out = []
+    _SR_format_string('Document name', doc_name, out)
+
+    for label, value, path, value_type in SR_iter(json_dict, stats):
+        _SR_format_string(label, value, out)
+
+    fp.write(''.join(out))
+
+    if stats:
+        stats.documents += 1
+        stats.seconds += time.perf_counter() - start
+
+
+# ---------------------------------------------------------------------
+# Same as SR_parse but returns the text and a list of spans
+#   (label, start, end, value_type)
+# giving the character offsets in the text of the value on each line
+# (after any [[label]] prefix and before the newline), so that the text
+# can be used without looking for the [[label]] markers again.
+
+def SR_render(json_dict, doc_name, stats = None):
+
+    start = time.perf_counter()
+
+    out = []
+    spans = []
+    offset = 0
+    events = SR_iter(json_dict, stats)
+    for label, value, path, value_type in itertools.chain([('Document name', doc_name, (), None)], events):
+        lines = []
+        _SR_format_string(label, value, lines)
+        if not lines:
+            continue
+        if isinstance(label, list):
+            label = label[0]
+        prefix = len('[[%s]] ' % label) if label != None and label != '' else 0
+        # lines holds each line then its newline
+        for line in lines[0::2]:
+            spans.append( (label or '', offset + prefix, offset + len(line), value_type) )
+            offset += len(line) + 1
+        out += lines
+
+    if stats:
+        stats.documents += 1
+        stats.seconds += time.perf_counter() - start
+
+    return (''.join(out), spans)
+
+def test_SR_render():
+    import io
+    dcm = os.path.join(os.path.dirname(__file__), '../../../applications/SRAnonTool/test/report10html.dcm')
+    dataset = pydicom.dcmread(dcm)
+    fd = io.StringIO()
+    SR_parse(dataset, 'report10html', fd)
+    text, spans = SR_render(dataset, 'report10html')
+    assert(text == fd.getvalue())
+    assert(spans[0] == ('Document name', len('[[Document name]] '), len('[[Document name]] report10html'), None))
+    for label, start, end, value_type in spans:
+        assert(text[end] == '\n')
+        if label:
+            assert(text[0:start].endswith('[[%s]] ' % label))
+    assert([ text[start:end] for label, start, end, value_type in spans if label == 'Request' ] == ['MRI: Knee'])
+    assert([ value_type for label, start, end, value_type in spans if label == 'Finding' ] == ['TEXT'] * 3)
 
 
 #
@@ -406,3 +761,235 @@ def test_SR_parse_key():
         result = fd.read()
     os.remove(tmpfile)
     assert(result == '[[Request]] MRI: Knee\n')
+
+
+def test_sr_register_value_type():
+    SR_dict = {
+        "ContentSequence": [
+            { "RelationshipType": "CONTAINS", "ValueType": "PRIVATE", "TextValue": "Private text" },
+            { "RelationshipType": "CONTAINS", "ValueType": "TEXT", "TextValue": "Public text" },
+        ]
+    }
+    def handle_private(cs_item):
+        return [ ('Private', cs_item.TextValue) ]
+    tmpfile = 'tmp_pytest_output.txt'
+    previous = sr_register_value_type('PRIVATE', handle_private)
+    assert(previous == False)
+    try:
+        with open(tmpfile, 'w') as fd:
+            _SR_parse_key(SR_dict, 'ContentSequence', fd)
+        with open(tmpfile, 'r') as fd:
+            result = fd.read()
+        assert(result == '[[Private]] Private text\nPublic text\n')
+        # A handler of None ignores the item
+        sr_register_value_type('PRIVATE', None)
+        with open(tmpfile, 'w') as fd:
+            _SR_parse_key(SR_dict, 'ContentSequence', fd)
+        with open(tmpfile, 'r') as fd:
+            assert(fd.read() == 'Public text\n')
+    finally:
+        sr_unregister_value_type('PRIVATE')
+        os.remove(tmpfile)
+    assert('PRIVATE' not in sr_value_type_handlers)
+
+
+def test_SR_iter():
+    # Nest containers more deeply than the recursion limit
+    depth = sys.getrecursionlimit() + 100
+    item = { 'RelationshipType': 'CONTAINS', 'ValueType': 'TEXT', 'TextValue': 'Deepest' }
+    for ii in range(depth):
+        item = { 'RelationshipType': 'CONTAINS', 'ValueType': 'CONTAINER', 'ContentSequence': [ item ] }
+    SR_dict = { 'StudyDate': '20200101', 'ContentSequence': [ item,
+        { 'RelationshipType': 'CONTAINS', 'ValueType': 'TEXT', 'TextValue': 'Last' } ] }
+    events = [ event for event in SR_iter(SR_dict) if event[1] ]
+    assert(events[0] == ('Study Date', '20200101', ('StudyDate',), None))
+    label, value, path, value_type = events[1]
+    assert((value, value_type, len(path)) == ('Deepest', 'TEXT', 2 * (depth + 1)))
+    assert(path[:4] == ('ContentSequence', 0, 'ContentSequence', 0))
+    assert(events[2] == ('', 'Last', ('ContentSequence', 1), 'TEXT'))
+    # Stop early
+    assert(next(event for event in SR_iter(SR_dict) if event[3] == 'TEXT')[1] == 'Deepest')
+
+
+def test_SR_parse_dataset():
+    # A pydicom Dataset gives the same output as its JSON
+    import io
+    dcm = os.path.join(os.path.dirname(__file__), '../../../applications/SRAnonTool/test/report10html.dcm')
+    dataset = pydicom.dcmread(dcm)
+    from_json = io.StringIO()
+    SR_parse(dataset.to_json_dict(), 'report10html', from_json)
+    from_dataset = io.StringIO()
+    SR_parse(dataset, 'report10html', from_dataset)
+    assert(from_dataset.getvalue() == from_json.getvalue())
+    assert('[[Document name]] report10html\n' in from_dataset.getvalue())
+
+
+# ---------------------------------------------------------------------
+# Queries to find specific content items without formatting the whole
+# document, eg. compile_query('CONTAINER/Findings/TEXT') finds the TEXT
+# items inside the Findings container inside the root container.
+# Each part of the path matches one level of the content tree, starting
+# at the root of the document (which is normally a CONTAINER), and is
+#   a ValueType or a concept name, eg. TEXT or Findings
+#   both, as ValueType:concept name, eg. TEXT:Finding
+#   * to match any item, or ** to match any number of levels.
+# A query can be used with anything SR_parse accepts and only reads
+# the items it needs, so first() stops at the first match.
+# The value of each item is decoded according to its ValueType using
+# the sr_decode functions, see sr_query_decoders.
+
+def _SR_single(value):
+    """ Return the only element of a list, as values are in JSON from pydicom.
+    """
+    if isinstance(value, list) and len(value) == 1:
+        return value[0]
+    return value
+
+def _SR_decode_NUM(cs_item):
+    """ Return (number, units) for a NUM item, the number as a float if possible.
+    """
+    number, units = None, ''
+    mvs = tag_val(cs_item, 'MeasuredValueSequence')
+    for mvs_item in mvs if isinstance(mvs, list) else [{ 'NumericValue': tag_val(cs_item, 'NumericValue') }]:
+        if has_tag(mvs_item, 'NumericValue'):
+            number = _SR_single(tag_val(mvs_item, 'NumericValue'))
+        if has_tag(mvs_item, 'MeasurementUnitsCodeSequence'):
+            units = _SR_single(Dicom.sr_decode_MeasurementUnitsCodeSequence(tag_val(mvs_item, 'MeasurementUnitsCodeSequence')))
+    try:
+        number = float(number)
+    except (TypeError, ValueError):
+        pass
+    return (number, units)
+
+sr_query_decoders = {
+    'PNAME':     lambda cs_item: Dicom.sr_decode_PNAME(tag_val(cs_item, 'PersonName')),
+    'DATETIME':  lambda cs_item: Dicom.sr_decode_plaintext(_SR_single(tag_val(cs_item, 'DateTime'))),
+    'DATE':      lambda cs_item: Dicom.sr_decode_date(_SR_single(tag_val(cs_item, 'Date'))),
+    'TIME':      lambda cs_item: Dicom.sr_decode_plaintext(_SR_single(tag_val(cs_item, 'Time'))),
+    'TEXT':      lambda cs_item: Dicom.sr_decode_plaintext(_SR_single(tag_val(cs_item, 'TextValue'))),
+    'NUM':       _SR_decode_NUM,
+    'CODE':      lambda cs_item: _SR_single(Dicom.sr_decode_ConceptNameCodeSequence(tag_val(cs_item, 'ConceptCodeSequence'))),
+    'UIDREF':    lambda cs_item: Dicom.sr_decode_plaintext(_SR_single(tag_val(cs_item, 'UID'))),
+    'IMAGE':     lambda cs_item: _SR_single(Dicom.sr_decode_ReferencedSOPSequence(tag_val(cs_item, 'ReferencedSOPSequence') or [])),
+    'CONTAINER': lambda cs_item: _SR_single(Dicom.sr_decode_ConceptNameCodeSequence(tag_val(cs_item, 'ConceptNameCodeSequence'))),
+}
+
+
+class SRQuery:
+    """ A compiled query, see compile_query.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._parts = []    # (is_any_depth, value_type or None, concept name or None)
+        for part in path.strip('/').split('/'):
+            if part == '**':
+                self._parts.append( (True, None, None) )
+            elif part == '*':
+                self._parts.append( (False, None, None) )
+            elif ':' in part:
+                value_type, concept = part.split(':', 1)
+                self._parts.append( (False, value_type or None, concept or None) )
+            else:
+                # Either a ValueType or a concept name
+                self._parts.append( (False, part, part) )
+        self._end = len(self._parts)
+
+    def _closure(self, states):
+        """ Add the states reached by ** matching no levels.
+        """
+        states = set(states)
+        for state in sorted(states):
+            while state < self._end and self._parts[state][0]:
+                state += 1
+                states.add(state)
+        return frozenset(states)
+
+    def _advance(self, states, cs_item):
+        """ Return the states after matching one level at cs_item.
+        """
+        value_type = concept = None
+        next_states = set()
+        for state in states:
+            if state == self._end:
+                continue
+            any_depth, want_type, want_concept = self._parts[state]
+            if any_depth:
+                next_states.add(state)
+                continue
+            if want_type is None and want_concept is None:
+                next_states.add(state + 1)
+                continue
+            if value_type is None:
+                value_type = _SR_single(tag_val(cs_item, 'ValueType'))
+                concept = _SR_single(Dicom.sr_decode_ConceptNameCodeSequence(tag_val(cs_item, 'ConceptNameCodeSequence')))
+            if want_type == want_concept:
+                matched = (value_type == want_type or concept == want_concept)
+            else:
+                matched = ((want_type is None or value_type == want_type) and
+                    (want_concept is None or concept == want_concept))
+            if matched:
+                next_states.add(state + 1)
+        return self._closure(next_states)
+
+    def iter(self, json_dict):
+        """ Yield (label, value, path, value_type) for each matching item,
+        in document order, as SR_iter, but with the value decoded
+        according to its ValueType, eg. (number, units) for NUM.
+        """
+        # Depth-first using a stack of (item, path, states)
+        stack = [ (json_dict, (), self._advance(self._closure([0]), json_dict)) ]
+        while stack:
+            cs_item, path, states = stack.pop()
+            if not states:
+                continue
+            if self._end in states:
+                value_type = _SR_single(tag_val(cs_item, 'ValueType'))
+                decoder = sr_query_decoders.get(value_type) if isinstance(value_type, str) else None
+                yield (_SR_single(Dicom.sr_decode_ConceptNameCodeSequence(tag_val(cs_item, 'ConceptNameCodeSequence'))),
+                    decoder(cs_item) if decoder else None, path, value_type)
+            if states == {self._end}:
+                continue
+            children = tag_val(cs_item, 'ContentSequence')
+            if not isinstance(children, list):
+                continue
+            for ii in range(len(children)-1, -1, -1):
+                stack.append( (children[ii], path + ('ContentSequence', ii), self._advance(states, children[ii])) )
+
+    def first(self, json_dict, default = None):
+        """ Return the first (label, value, path, value_type) found, or default.
+        """
+        return next(self.iter(json_dict), default)
+
+    def values(self, json_dict):
+        """ Return a list of the values of all the matching items.
+        """
+        return [ value for label, value, path, value_type in self.iter(json_dict) ]
+
+
+@functools.lru_cache(maxsize = 256)
+def compile_query(path):
+    """ Return an SRQuery for the path, eg. 'CONTAINER/Findings/TEXT',
+    which is only compiled once.
+    """
+    return SRQuery(path)
+
+
+def test_compile_query():
+    dcm = os.path.join(os.path.dirname(__file__), '../../../applications/SRAnonTool/test/report10html.dcm')
+    dataset = pydicom.dcmread(dcm)
+    findings = compile_query('CONTAINER/Findings/TEXT')
+    assert(findings is compile_query('CONTAINER/Findings/TEXT'))
+    for doc in [ dataset, dataset.to_json_dict(), Dicom.canonicalise(dataset) ]:
+        values = findings.values(doc)
+        assert(len(values) == 3)
+        assert(values[1].startswith('There is a tear'))
+        label, value, path, value_type = compile_query('**/TEXT:History').first(doc)
+        assert((label, path, value_type) == ('History', ('ContentSequence', 1), 'TEXT'))
+        assert(compile_query('*/IMAGE').first(doc)[0] == 'Best illustration of finding')
+        assert(compile_query('CONTAINER/NUM').first(doc) == None)
+    # Mongo style, with a measurement
+    doc = { 'ValueType': 'CONTAINER', 'ContentSequence': [
+        { 'RelationshipType': 'CONTAINS', 'ValueType': 'NUM',
+          'ConceptNameCodeSequence': [ { 'CodeMeaning': 'Diameter' } ],
+          'MeasuredValueSequence': [ { 'NumericValue': '23', 'MeasurementUnitsCodeSequence': [ { 'CodeValue': 'mm' } ] } ] } ] }
+    assert(compile_query('CONTAINER/Diameter').values(doc) == [ (23.0, 'mm') ])